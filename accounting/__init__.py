@@ -1,11 +1,135 @@
 # You will need to pip install flask and the sqlalchemy extension for flask.
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+import threading
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile("config.py")
-db = SQLAlchemy(app)
+from flask import Flask, has_app_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.pool import SingletonThreadPool
 
-# Import the views file for routing.
-import views
+
+# Shard each thread works on, set through accounting.shards; unset for the
+# main database. replica is set inside accounting.replica.reading().
+shard_scope = threading.local()
+
+
+def replica_bind(shard):
+    """
+    :return: Bind name of the read replica of a shard, or of the main database.
+    """
+    return "%s_replica" % (shard or "main")
+
+
+class AccountingSession(_SignallingSession):
+    def __init__(self, db, shard=None, replica=False, **options):
+        _SignallingSession.__init__(self, db, **options)
+        self.replica = replica
+        self.bind_engine = None
+        if replica:
+            self.bind_engine = db.get_engine(self.app, bind=replica_bind(shard))
+        elif shard is not None:
+            self.bind_engine = db.get_engine(self.app, bind=shard)
+
+    def get_bind(self, mapper, clause=None):
+        # Every table of a shard's (or replica's) session lives in its database.
+        if self.bind_engine is not None:
+            return self.bind_engine
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class AccountingSQLAlchemy(SQLAlchemy):
+    def get_app(self, reference_app=None):
+        # Scripts, the shell and the tests use db without building an
+        # application first: build one from config.py on first use.
+        if reference_app is None and self.app is None and not has_app_context():
+            with _app_lock:
+                if self.app is None:
+                    create_app()
+        return SQLAlchemy.get_app(self, reference_app)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        # SQLite files otherwise get a NullPool, which reconnects (and starts
+        # with a cold page cache) on every request. Keep one connection per
+        # thread when SQLALCHEMY_POOL_SIZE asks for pooling.
+        if info.drivername == "sqlite" and options.get("pool_size"):
+            options["poolclass"] = SingletonThreadPool
+
+    def create_scoped_session(self, options=None):
+        # One session per thread, shard and replica, bound to its database;
+        # see accounting.shards and accounting.replica.
+        options = dict(options or {})
+        options.pop("scopefunc", None)
+
+        def create_session():
+            shard = getattr(shard_scope, "shard", None)
+            replica = getattr(shard_scope, "replica", False)
+            return AccountingSession(self, shard=shard, replica=replica, **options)
+
+        def scope():
+            shard = getattr(shard_scope, "shard", None)
+            replica = getattr(shard_scope, "replica", False)
+            return (threading.current_thread().ident, shard, replica)
+
+        return orm.scoped_session(create_session, scopefunc=scope)
+
+
+db = AccountingSQLAlchemy()
+_app_lock = threading.RLock()
+
+
+def create_app(config=None):
+    """
+    Builds the application and brings its databases up to the current
+    schema, filling in the pending cancellation index and the payment
+    allocations when they were missing.
+    db is bound to the application created last, which requests and
+    scripts in the process then share (see serve.py); when none was created,
+    db builds one with the default configuration on first use.
+    :param config: Settings overriding config.py, e.g. SQLALCHEMY_DATABASE_URI,
+                   SQLALCHEMY_POOL_SIZE, SHARDS, REPLICA_DIR, the
+                   *_CACHE_SIZE settings or PROFILE_DIR.
+    """
+    app = Flask(__name__)
+    app.config.from_pyfile("config.py")
+    app.config.update(config or {})
+
+    import shards
+
+    db.app = app
+    shards.configure(app.config)
+    if app.config.get("SQLALCHEMY_POOL_SIZE"):
+        # Connections are kept per thread: besides the request threads, the
+        # change feed's log follower (see events) holds one to every
+        # database, and the gather threads one to their shard each.
+        app.config["SQLALCHEMY_POOL_SIZE"] += 1 + (
+            shards.gather_threads if shards.names else 0
+        )
+    db.init_app(app)
+    app.teardown_request(shards.reset)
+
+    # Import the views file for routing.
+    import allocations
+    import billing
+    import cache
+    import delinquency
+    import events
+    import profiling
+    import replica
+    import views
+
+    replica.configure(app.config)
+    billing.configure(app.config)
+    cache.configure(app.config)
+    events.configure(app.config)
+    app.after_request(replica.remember_writes)
+    app.register_blueprint(views.blueprint)
+    profiling.install(app)
+    for shard, created in shards.upgrade_all():
+        # Payments keep these current from now on; fill in the rest.
+        with shards.using(shard):
+            if "delinquency_windows" in created:
+                delinquency.rebuild_delinquency_index()
+            if "invoice_allocations" in created:
+                allocations.rebuild_allocations()
+            db.session.remove()
+    return app
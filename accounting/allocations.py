@@ -0,0 +1,153 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import func, select
+
+from accounting import db
+from models import Invoice, Payment, Policy, invoice_allocations
+import shards
+
+"""
+#######################################################
+Payment to invoice allocation.
+
+Payments are applied in the order they were recorded, each to the oldest
+live invoice (by bill date) that is not fully paid yet; whatever is left
+over stays unallocated until a new invoice can take it. The result is
+stored in invoice_allocations so an invoice's paid amount is one indexed
+lookup instead of a replay of the policy's payments. Anything that
+changes a policy's invoices or payments keeps it current in the same
+transaction.
+#######################################################
+"""
+
+IN_LIST_SIZE = 500
+
+policies = Policy.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+
+
+def allocate(invoice_balances, payment_amounts):
+    """
+    :param invoice_balances: (invoice_id, amount still due) by bill date.
+    :param payment_amounts: (payment_id, amount to allocate) by record order.
+    :return: List of (invoice_id, payment_id, amount).
+    """
+    allocations = []
+    invoice_balances = [list(invoice) for invoice in invoice_balances if invoice[1] > 0]
+    position = 0
+    for payment_id, remaining in payment_amounts:
+        while remaining > 0 and position < len(invoice_balances):
+            invoice = invoice_balances[position]
+            amount = min(remaining, invoice[1])
+            allocations.append((invoice[0], payment_id, amount))
+            invoice[1] -= amount
+            remaining -= amount
+            if not invoice[1]:
+                position += 1
+    return allocations
+
+
+def allocate_payment(policy_id, payment_id, amount):
+    """
+    Allocates a newly recorded payment. The caller is responsible for
+    committing.
+    :param policy_id: Policy the payment was made to.
+    :param payment_id: The payment, already flushed.
+    :param amount: Amount paid.
+    """
+    allocated = (
+        select([func.coalesce(func.sum(invoice_allocations.c.amount), 0)])
+        .where(invoice_allocations.c.invoice_id == invoices.c.id)
+        .as_scalar()
+    )
+    query = (
+        select([invoices.c.id, invoices.c.amount_due - allocated])
+        .where(invoices.c.policy_id == policy_id)
+        .where(invoices.c.deleted == False)
+        .order_by(invoices.c.bill_date, invoices.c.id)
+    )
+    unpaid = db.session.execute(query).fetchall()
+    _insert(policy_id, allocate(unpaid, [(payment_id, amount)]))
+
+
+def refresh_allocations(policy_ids):
+    """
+    Recomputes the allocations of the given policies from scratch.
+    The caller is responsible for committing.
+    :param policy_ids: Policies whose invoices changed.
+    """
+    # Invoices and payments are read with Core, which does not autoflush.
+    db.session.flush()
+    policy_ids = list(policy_ids)
+    for start in range(0, len(policy_ids), IN_LIST_SIZE):
+        chunk = policy_ids[start : start + IN_LIST_SIZE]
+        db.session.execute(
+            invoice_allocations.delete().where(
+                invoice_allocations.c.policy_id.in_(chunk)
+            )
+        )
+        invoice_rows = _by_policy(
+            select([invoices.c.policy_id, invoices.c.id, invoices.c.amount_due])
+            .where(invoices.c.policy_id.in_(chunk))
+            .where(invoices.c.deleted == False)
+            .order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)
+        )
+        payment_rows = _by_policy(
+            select([payments.c.policy_id, payments.c.id, payments.c.amount_paid])
+            .where(payments.c.policy_id.in_(chunk))
+            .order_by(payments.c.policy_id, payments.c.id)
+        )
+        for policy_id, policy_payments in payment_rows.items():
+            _insert(
+                policy_id, allocate(invoice_rows.get(policy_id, []), policy_payments)
+            )
+
+
+def rebuild_allocations(chunk_size=500):
+    """
+    Creates the allocation table if needed and recomputes it for every
+    policy, committing per chunk of policies.
+    :return: Dict with the number of policies processed and allocations stored.
+    """
+    invoice_allocations.create(shards.engine(), checkfirst=True)
+    processed, last_id = 0, 0
+    query = select([policies.c.id]).order_by(policies.c.id).limit(chunk_size)
+    while True:
+        policy_ids = [
+            row[0] for row in db.session.execute(query.where(policies.c.id > last_id))
+        ]
+        if not policy_ids:
+            break
+        last_id = policy_ids[-1]
+        refresh_allocations(policy_ids)
+        db.session.commit()
+        processed += len(policy_ids)
+
+    allocations = db.session.execute(
+        select([func.count(invoice_allocations.c.id)])
+    ).scalar()
+    return {"policies": processed, "allocations": allocations}
+
+
+def _by_policy(query):
+    grouped = {}
+    for policy_id, row_id, amount in db.session.execute(query):
+        grouped.setdefault(policy_id, []).append((row_id, amount))
+    return grouped
+
+
+def _insert(policy_id, allocations):
+    if allocations:
+        db.session.execute(
+            invoice_allocations.insert(),
+            [
+                {
+                    "policy_id": policy_id,
+                    "invoice_id": invoice_id,
+                    "payment_id": payment_id,
+                    "amount": amount,
+                }
+                for invoice_id, payment_id, amount in allocations
+            ],
+        )
@@ -0,0 +1,141 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import exists, func, select
+
+from accounting import db
+from delinquency import drop_delinquency_windows
+from models import (
+    Invoice,
+    Payment,
+    Policy,
+    invoices_archive,
+    payments_archive,
+    policies_archive,
+)
+import shards
+
+"""
+#######################################################
+Archive tier.
+
+Soft-deleted invoices and the whole history of long-closed policies are
+moved, chunk by chunk, from the hot tables into their *_archive copies.
+Hot queries no longer have to skip them; reads that want history union the
+archive back in (see queries).
+#######################################################
+"""
+
+policies = Policy.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+
+CLOSED_STATUSES = ["Canceled", "Expired"]
+
+
+def archive(closed_before, chunk_size=500, dry_run=False):
+    """
+    :param closed_before: Policies canceled or expired before this date are
+                          archived together with their invoices and payments.
+    :param chunk_size: Rows (deleted invoices) or policies moved per commit.
+    :param dry_run: Count what would be moved without writing anything.
+    :return: Dict with the number of policies, invoices and payments moved.
+    """
+    if not dry_run:
+        db.metadata.create_all(
+            shards.engine(),
+            tables=[policies_archive, invoices_archive, payments_archive],
+        )
+
+    # SQLite hands out max(id) + 1 to new rows, so moving the row holding the
+    # current max id would let its id be reused and collide in the archive.
+    # Rows at or above these marks stay hot until newer rows exist.
+    policy_mark = _high_water_mark(policies)
+    invoice_mark = _high_water_mark(invoices)
+    payment_mark = _high_water_mark(payments)
+
+    moved = {"policies": 0, "invoices": 0, "payments": 0, "dry_run": dry_run}
+
+    deleted_invoices = (
+        select([invoices.c.id])
+        .where(invoices.c.deleted == True)
+        .where(invoices.c.id < invoice_mark)
+    )
+    for invoice_ids in _chunks(deleted_invoices, invoices.c.id, chunk_size):
+        condition = invoices.c.id.in_(invoice_ids)
+        moved["invoices"] += _move(invoices, invoices_archive, condition, dry_run)
+        if not dry_run:
+            db.session.commit()
+
+    closed_policies = (
+        select([policies.c.id])
+        .where(policies.c.status.in_(CLOSED_STATUSES))
+        .where(policies.c.status_change_date < closed_before)
+        .where(policies.c.id < policy_mark)
+        .where(
+            ~exists().where(
+                (invoices.c.policy_id == policies.c.id)
+                & (invoices.c.id >= invoice_mark)
+            )
+        )
+        .where(
+            ~exists().where(
+                (payments.c.policy_id == policies.c.id)
+                & (payments.c.id >= payment_mark)
+            )
+        )
+    )
+    for policy_ids in _chunks(closed_policies, policies.c.id, chunk_size):
+        moved["invoices"] += _move(
+            invoices, invoices_archive, invoices.c.policy_id.in_(policy_ids), dry_run
+        )
+        moved["payments"] += _move(
+            payments, payments_archive, payments.c.policy_id.in_(policy_ids), dry_run
+        )
+        moved["policies"] += _move(
+            policies, policies_archive, policies.c.id.in_(policy_ids), dry_run
+        )
+        if not dry_run:
+            drop_delinquency_windows(policy_ids)
+            db.session.commit()
+
+    return moved
+
+
+def _high_water_mark(table):
+    return db.session.execute(select([func.max(table.c.id)])).scalar() or 0
+
+
+def _chunks(query, id_column, chunk_size):
+    """
+    Yields lists of ids from query, paging on id so that it works whether
+    or not the previous chunk has been moved away.
+    """
+    query = query.order_by(id_column).limit(chunk_size)
+    last_id = 0
+    while True:
+        ids = [
+            row[0]
+            for row in db.session.execute(query.where(id_column > last_id))
+        ]
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield ids
+
+
+def _move(table, archive_table, condition, dry_run):
+    """
+    Copies the rows matching condition into archive_table and deletes them
+    from table. The caller is responsible for committing.
+    :return: Number of rows moved.
+    """
+    if dry_run:
+        return db.session.execute(
+            select([func.count()]).select_from(table).where(condition)
+        ).scalar()
+
+    rows = db.session.execute(select([table]).where(condition)).fetchall()
+    if rows:
+        db.session.execute(archive_table.insert(), [dict(row) for row in rows])
+        db.session.execute(table.delete().where(condition))
+    return len(rows)
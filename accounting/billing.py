@@ -0,0 +1,141 @@
+#!/user/bin/env python2.7
+
+import calendar
+from datetime import datetime, timedelta
+
+import cache
+
+"""
+#######################################################
+Billing plans.
+
+A term's invoices follow from its effective date, billing schedule and
+premium alone. Only the schedule and premium decide how many invoices there
+are, how many months apart and for how much, so that is what is cached; the
+dates are shifted onto each term's effective date. With
+INVOICE_HORIZON_DAYS set, only the invoices billed within that many days of
+today are written; the policy's invoiced_through date records how far the
+plan has been materialized, and everything after it is worked out from the
+plan when needed (see ledger and horizon).
+#######################################################
+"""
+
+# Number of invoices per term and months between them.
+BILLING_SCHEDULES = {"Annual": 1, "Two-Pay": 2, "Quarterly": 4, "Monthly": 12}
+MONTHS_BETWEEN_INVOICES = {"Annual": 12, "Two-Pay": 6, "Quarterly": 3, "Monthly": 1}
+
+# Days ahead of today that invoices are materialized for; None writes whole
+# terms up front.
+horizon_days = None
+
+
+def configure(config):
+    """
+    :param config: Mapping with INVOICE_HORIZON_DAYS.
+    """
+    global horizon_days
+    horizon_days = config.get("INVOICE_HORIZON_DAYS")
+
+
+def plan_invoices(effective_date, billing_schedule, annual_premium):
+    """
+    Works out a term's invoices without touching the session.
+    An unknown billing schedule gets a single invoice for the whole premium.
+    :param effective_date: Start of the term.
+    :param billing_schedule: One of BILLING_SCHEDULES.
+    :param annual_premium: Premium split across the invoices.
+    :return: List of (bill_date, due_date, cancel_date, amount_due) tuples.
+    """
+    invoices = []
+    for months, amount_due in plan_template(billing_schedule, annual_premium):
+        bill_date = add_months(effective_date, months)
+        due_date = add_months(bill_date, 1)
+        cancel_date = due_date + timedelta(days=14)
+        invoices.append((bill_date, due_date, cancel_date, amount_due))
+    return invoices
+
+
+def plan_template(billing_schedule, annual_premium):
+    """
+    The part of a plan that does not depend on the effective date.
+    :return: Tuple of (months after the effective date, amount_due) per invoice.
+    """
+    key = (billing_schedule, annual_premium)
+    template = cache.invoice_plans.get(key)
+    if template is None:
+        invoices_quantity = BILLING_SCHEDULES.get(billing_schedule, 1)
+        months_between_invoices = MONTHS_BETWEEN_INVOICES.get(billing_schedule, 12)
+        template = cache.invoice_plans.put(
+            key,
+            tuple(
+                (i * months_between_invoices, annual_premium / invoices_quantity)
+                for i in range(invoices_quantity)
+            ),
+        )
+    return template
+
+
+def add_months(day, months):
+    """
+    Same as day + relativedelta(months=months): the day of the month is
+    kept, or moved back to the last day of a shorter month.
+    """
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return day.replace(
+        year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1])
+    )
+
+
+def invoice_horizon(date_cursor=None, days=None):
+    """
+    :param date_cursor: Date the horizon is counted from, defaults to today.
+    :param days: Horizon in days, defaults to INVOICE_HORIZON_DAYS.
+    :return: Last bill date to materialize, or None to materialize everything.
+    """
+    if days is None:
+        days = horizon_days
+    if days is None:
+        return None
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    return date_cursor + timedelta(days=days)
+
+
+def materialize(invoices, through, first=True):
+    """
+    Splits planned invoices at the horizon.
+    :param invoices: Planned invoices, by ascending bill date.
+    :param through: Horizon as returned by invoice_horizon().
+    :param first: Always write the first invoice, so that a newly billed
+                  policy never has an empty invoice list.
+    :return: (invoices to write, invoiced_through to store on the policy);
+             invoiced_through is None once nothing is left to write.
+    """
+    if through is None:
+        return invoices, None
+    written = [invoice for invoice in invoices if invoice[0] <= through]
+    if first and not written and invoices:
+        written = invoices[:1]
+    if len(written) == len(invoices):
+        return written, None
+    if written:
+        through = max(through, written[-1][0])
+    return written, through
+
+
+def pending_invoices(
+    effective_date, billing_schedule, annual_premium, invoiced_through
+):
+    """
+    :param invoiced_through: The policy's invoiced_through date.
+    :return: Planned invoices not written yet, by ascending bill date.
+    """
+    if invoiced_through is None:
+        return []
+    return [
+        invoice
+        for invoice in plan_invoices(effective_date, billing_schedule, annual_premium)
+        if invoice[0] > invoiced_through
+    ]
@@ -0,0 +1,232 @@
+#!/user/bin/env python2.7
+
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, select
+
+from accounting import db
+from models import Contact, Policy, changes
+import billing
+import changelog
+import queries
+import shards
+
+"""
+#######################################################
+Per-process caches.
+
+Hot policy rows and invoice plans are kept in memory for the lifetime of
+the process. Policy rows are kept coherent across processes through the
+change log: every request about a policy first drops the rows of the
+policies changed since the last such request (see sync), and of those
+whose named insured or agent was renamed, wherever the change was made.
+Each shard has its own change log, followed separately and only by the
+requests routed to it; the process saves a cursor on it now and then so
+that trimming the log waits for it (see changelog).
+#######################################################
+"""
+
+IN_LIST_SIZE = 500
+
+policies = Policy.__table__
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that forgets the least recently used key first.
+    A size of 0 disables the cache. Safe to share between threads.
+    """
+
+    __slots__ = ("size", "entries", "lock")
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return value
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+policy_rows = LRUCache(0)
+invoice_plans = LRUCache(0)
+
+# Id of the last change log entry applied to policy_rows, by shard (None
+# for the main database).
+_last_change_ids = {}
+
+
+def configure(config):
+    """
+    Sizes the caches from the application's configuration, emptying them.
+    :param config: Mapping with POLICY_CACHE_SIZE and INVOICE_PLAN_CACHE_SIZE.
+    """
+    policy_rows.size = config.get("POLICY_CACHE_SIZE", 0)
+    invoice_plans.size = config.get("INVOICE_PLAN_CACHE_SIZE", 0)
+    policy_rows.clear()
+    invoice_plans.clear()
+    _last_change_ids.clear()
+    changelog.forget_process_cursors()
+
+
+def sync(databases=None):
+    """
+    Drops the cached rows of policies changed since the previous call.
+    Called at the start of every request about a policy, for its shard.
+    :param databases: Shards to follow, None for the main database;
+                      defaults to all of them.
+    """
+    if policy_rows.size <= 0:
+        return
+    if databases is None:
+        databases = shards.names or [None]
+    for shard in databases:
+        with shards.using(shard):
+            _sync(shard)
+
+
+def _sync(shard):
+    # Read the mark first: changes logged after it are left for the next call.
+    first_id, mark = changelog.bounds()
+    last_change_id = _last_change_ids.get(shard)
+    if last_change_id is None or changelog.behind(last_change_id, first_id):
+        # Not followed yet, or entries were trimmed before this process read
+        # them: start over from here.
+        _discard_shard(shard)
+    else:
+        query = (
+            select([changes.c.table_name, changes.c.row_id])
+            .where(changes.c.id > last_change_id)
+            .where(changes.c.id <= mark)
+            .where(changes.c.table_name.in_(["policies", "contacts"]))
+        )
+        contact_ids = set()
+        for table_name, row_id in db.session.execute(query):
+            if table_name == "policies":
+                policy_rows.discard(row_id)
+            else:
+                contact_ids.add(row_id)
+        _discard_contacts(list(contact_ids))
+    _last_change_ids[shard] = mark
+    changelog.save_process_cursor("cache", mark, shard)
+
+
+def _discard_contacts(contact_ids):
+    # Policy rows carry their named insured's and agent's names.
+    for start in range(0, len(contact_ids), IN_LIST_SIZE):
+        chunk = contact_ids[start : start + IN_LIST_SIZE]
+        query = select([policies.c.id]).where(
+            policies.c.named_insured.in_(chunk) | policies.c.agent.in_(chunk)
+        )
+        for (policy_id,) in db.session.execute(query):
+            policy_rows.discard(policy_id)
+
+
+def _discard_shard(shard):
+    if not shards.names:
+        policy_rows.clear()
+        return
+    with policy_rows.lock:
+        for policy_id in list(policy_rows.entries):
+            if shards.shard_for(policy_id) == shard:
+                del policy_rows.entries[policy_id]
+
+
+def policy_row(policy_id):
+    """
+    Cached queries.policy_row for hot (non-history) reads.
+    :return: The policy row or None if it does not exist.
+    """
+    row = policy_rows.get(policy_id)
+    if row is None:
+        with shards.using_policy(policy_id):
+            row = queries.policy_row(policy_id)
+        if row is not None:
+            # Keep a plain tuple rather than the result proxy row.
+            row = policy_rows.put(policy_id, tuple(row))
+    return row
+
+
+def warm(hot_policies):
+    """
+    Fills the caches before a process starts serving: the most recently
+    created active policies are loaded along with the invoice plans of
+    their schedules and premiums, and the contacts joined into policy rows
+    are read, which pulls all of their pages into the connection's SQLite
+    page cache.
+    :param hot_policies: How many policies to load, split across shards.
+    :return: Dict with the number of policy rows and invoice plans cached
+             and of contacts read.
+    """
+    sync()
+    warmed = {"policies": 0, "plans": 0, "contacts": 0}
+    hot_policies = min(hot_policies, policy_rows.size)
+    for shard in shards.names or [None]:
+        with shards.using(shard):
+            contacts = _warm(hot_policies // max(len(shards.names), 1))
+            db.session.remove()
+        warmed["contacts"] = max(warmed["contacts"], contacts)
+    warmed["policies"] = len(policy_rows)
+    warmed["plans"] = len(invoice_plans)
+    return warmed
+
+
+def _warm(hot_policies):
+    contacts = Contact.__table__
+    contact_count = sum(
+        1 for _ in db.session.execute(select([contacts.c.name, contacts.c.role]))
+    )
+    if hot_policies <= 0:
+        return contact_count
+    hot = (
+        select([policies.c.id])
+        .where(policies.c.status == "Active")
+        .order_by(policies.c.id.desc())
+        .limit(hot_policies)
+    )
+    policy_ids = [row[0] for row in db.session.execute(hot)]
+    for start in range(0, len(policy_ids), IN_LIST_SIZE):
+        chunk = policy_ids[start : start + IN_LIST_SIZE]
+        for row in queries.policy_rows(policy_ids=chunk):
+            policy_rows.put(row[0], tuple(row))
+
+    # The plans hot policies' renewals and quotes will need, most used first.
+    hot = hot.alias("hot")
+    plans = (
+        select([policies.c.billing_schedule, policies.c.annual_premium])
+        .where(policies.c.id.in_(select([hot.c.id])))
+        .group_by(policies.c.billing_schedule, policies.c.annual_premium)
+        .order_by(func.count().desc())
+        .limit(invoice_plans.size)
+    )
+    for billing_schedule, annual_premium in db.session.execute(plans):
+        billing.plan_template(billing_schedule, annual_premium)
+    return contact_count
@@ -0,0 +1,135 @@
+#!/user/bin/env python2.7
+
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from accounting import db
+from models import change_cursors, changes
+import shards
+
+"""
+#######################################################
+Change log bookkeeping.
+
+The changes table (see models) is followed by snapshot exports and by the
+caches and change feeds of every process. Each reader saves how far it has
+read as a cursor and trim() deletes the entries every live reader is past.
+An exporter's cursor is kept until it moves; a process's cursor expires
+CURSOR_TTL seconds after it was last saved, so a process that went away
+does not hold the log back. A reader whose next entries were trimmed all
+the same (its cursor expired, or it never saved one) finds out with
+behind() and starts over: a full export, an emptied cache.
+#######################################################
+"""
+
+# Seconds a process cursor is kept after it was last saved.
+CURSOR_TTL = 600
+
+# Seconds between two saves of a process cursor.
+CURSOR_SAVE_INTERVAL = 60
+
+# When this process last saved each of its cursors, by (pid, reader, shard).
+_process_cursors_saved = {}
+
+
+def last_id(connection=None):
+    """
+    :param connection: Connection to read the log with, defaults to db.session.
+    :return: Id of the newest entry, 0 if there is none.
+    """
+    connection = connection or db.session
+    return connection.execute(select([func.max(changes.c.id)])).scalar() or 0
+
+
+def bounds(connection=None):
+    """
+    :return: Ids of the oldest and newest entries, (None, 0) if there is none.
+    """
+    connection = connection or db.session
+    first_id, newest_id = connection.execute(
+        select([func.min(changes.c.id), func.max(changes.c.id)])
+    ).fetchone()
+    return first_id, newest_id or 0
+
+
+def behind(change_id, first_id=None, connection=None):
+    """
+    :param change_id: Last entry a reader has applied.
+    :param first_id: Id of the oldest entry, when already read with bounds().
+    :return: True if entries after it were trimmed before it read them.
+    """
+    if first_id is None:
+        first_id = bounds(connection)[0]
+    return first_id is not None and first_id > change_id + 1
+
+
+def save_cursor(name, change_id, ttl=None, connection=None):
+    """
+    Records how far a reader has read.
+    :param name: Reader, e.g. "snapshot:/srv/snapshots".
+    :param change_id: Last entry it has applied.
+    :param ttl: Seconds the cursor is kept unless saved again, None to keep
+                it until it moves.
+    """
+    connection = connection or db.session
+    expires_at = datetime.now() + timedelta(seconds=ttl) if ttl else None
+    connection.execute(
+        change_cursors.insert().prefix_with("OR REPLACE"),
+        {"name": name, "change_id": change_id, "expires_at": expires_at},
+    )
+
+
+def save_process_cursor(reader, change_id, shard=None):
+    """
+    Saves a process's cursor, at most every CURSOR_SAVE_INTERVAL seconds,
+    on a connection of its own outside the current transaction.
+    :param reader: What reads the log in the process, e.g. "cache".
+    :param change_id: Last entry it has applied.
+    :param shard: Shard whose log it reads, None for the main database.
+    """
+    key = (os.getpid(), reader, shard)
+    now = time.time()
+    if now - _process_cursors_saved.get(key, 0) < CURSOR_SAVE_INTERVAL:
+        return
+    _process_cursors_saved[key] = now
+    try:
+        save_cursor(
+            "%s:%s:%d" % (reader, socket.gethostname(), os.getpid()),
+            change_id,
+            ttl=CURSOR_TTL,
+            connection=shards.engine(shard),
+        )
+    except OperationalError:
+        # The database is busy: the cursor only holds back trimming, and an
+        # expired one makes the reader start over at worst. Try again next
+        # time.
+        del _process_cursors_saved[key]
+
+
+def forget_process_cursors():
+    """
+    Makes the next save_process_cursor calls save straight away.
+    """
+    _process_cursors_saved.clear()
+
+
+def trim():
+    """
+    Deletes the entries every live reader has applied, always keeping the
+    newest so that behind() can tell trimmed entries from no entries. The
+    caller is responsible for committing.
+    :return: Number of entries deleted.
+    """
+    db.session.execute(
+        change_cursors.delete().where(change_cursors.c.expires_at < datetime.now())
+    )
+    upto = last_id() - 1
+    oldest = db.session.execute(select([func.min(change_cursors.c.change_id)])).scalar()
+    if oldest is not None:
+        upto = min(upto, oldest)
+    return db.session.execute(changes.delete().where(changes.c.id <= upto)).rowcount
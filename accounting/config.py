@@ -1,3 +1,42 @@
 import os
 
 SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.abspath("accounting.sqlite")
+
+# Rows kept per process by accounting.cache; 0 disables a cache.
+POLICY_CACHE_SIZE = 10000
+INVOICE_PLAN_CACHE_SIZE = 1000
+
+# Only write invoices billed within this many days of today, None to write
+# whole terms up front; run `python jobs.py extend-invoices` daily when set.
+INVOICE_HORIZON_DAYS = None
+
+# Events buffered per change feed subscriber before the oldest are dropped.
+EVENT_BUFFER_SIZE = 100
+
+# Change feed streams a process serves at once, None for no limit. Each holds
+# a request thread for as long as it is open; serve.py leaves its workers at
+# least half their threads for ordinary requests.
+EVENT_MAX_STREAMS = None
+
+# Directory profiled requests (X-Profile: 1 or ?profile=1) are written to and
+# listed from at /debug/profiles; None disables profiling entirely.
+PROFILE_DIR = None
+PROFILE_KEEP = 100
+
+# Database URIs of the shards policies are spread over by id, e.g.
+# ["sqlite:////data/shard0.sqlite", "sqlite:////data/shard1.sqlite"]; the main
+# database then only holds the contacts copied to every shard. None keeps
+# everything in SQLALCHEMY_DATABASE_URI.
+SHARDS = None
+
+# Threads per shard, per process, running the queries reports and the policy
+# list send to every shard.
+SHARD_GATHER_THREADS = 4
+
+# Directory read replicas of the main database (or of every shard) are copied
+# to, by `python jobs.py replica` or serve.py --replica-interval. The policy
+# list, the reports and PolicyAccounting's balance reads use them while they
+# are at most REPLICA_MAX_LAG seconds old. None reads everything from the
+# primary databases.
+REPLICA_DIR = None
+REPLICA_MAX_LAG = 30
@@ -0,0 +1,128 @@
+#!/user/bin/env python2.7
+
+from datetime import date
+
+from sqlalchemy import func, select
+
+from accounting import db
+from ledger import Ledger
+from models import Contact, Policy, delinquency_windows
+import shards
+
+"""
+#######################################################
+Delinquency window index.
+
+For every policy, delinquency_windows holds the date ranges during which
+it is pending cancellation due to non-pay, so "who is pending cancellation
+on date X" is a single range lookup over the whole book. Anything that
+changes a policy's invoices or payments calls refresh_delinquency_windows
+in the same transaction.
+#######################################################
+"""
+
+IN_LIST_SIZE = 500
+
+policies = Policy.__table__
+named_insureds = Contact.__table__.alias("named_insureds")
+agents = Contact.__table__.alias("agents")
+
+
+def refresh_delinquency_windows(policy_ids):
+    """
+    Recomputes the windows of the given policies from their ledgers.
+    The caller is responsible for committing.
+    :param policy_ids: Policies whose invoices or payments changed.
+    """
+    # Ledgers are read with Core, which does not autoflush.
+    db.session.flush()
+    policy_ids = list(policy_ids)
+    for start in range(0, len(policy_ids), IN_LIST_SIZE):
+        chunk = policy_ids[start : start + IN_LIST_SIZE]
+        db.session.execute(
+            delinquency_windows.delete().where(
+                delinquency_windows.c.policy_id.in_(chunk)
+            )
+        )
+        rows = []
+        for policy_id, ledger in Ledger.load_many(chunk).items():
+            for window_start, window_end, amount in ledger.delinquency_windows():
+                rows.append(
+                    {
+                        "policy_id": policy_id,
+                        "start_date": date.fromordinal(window_start),
+                        "end_date": date.fromordinal(window_end),
+                        "amount_outstanding": amount,
+                    }
+                )
+        if rows:
+            db.session.execute(delinquency_windows.insert(), rows)
+
+
+def drop_delinquency_windows(policy_ids):
+    """
+    Removes the windows of policies leaving the hot tables.
+    The caller is responsible for committing.
+    """
+    db.session.execute(
+        delinquency_windows.delete().where(
+            delinquency_windows.c.policy_id.in_(list(policy_ids))
+        )
+    )
+
+
+def rebuild_delinquency_index(chunk_size=500):
+    """
+    Creates the index if needed and recomputes it for every policy,
+    committing per chunk of policies.
+    :return: Dict with the number of policies processed and windows stored.
+    """
+    delinquency_windows.create(shards.engine(), checkfirst=True)
+    processed, last_id = 0, 0
+    query = select([policies.c.id]).order_by(policies.c.id).limit(chunk_size)
+    while True:
+        policy_ids = [
+            row[0] for row in db.session.execute(query.where(policies.c.id > last_id))
+        ]
+        if not policy_ids:
+            break
+        last_id = policy_ids[-1]
+        refresh_delinquency_windows(policy_ids)
+        db.session.commit()
+        processed += len(policy_ids)
+
+    windows = db.session.execute(
+        select([func.count(delinquency_windows.c.id)])
+    ).scalar()
+    return {"policies": processed, "windows": windows}
+
+
+def pending_cancellation(date_cursor):
+    """
+    :param date_cursor: Date to evaluate.
+    :return: One row per policy pending cancellation due to non-pay on that
+             date: (policy_id, policy_number, named_insured, agent,
+             amount_outstanding, start_date, end_date).
+    """
+    query = (
+        select(
+            [
+                policies.c.id,
+                policies.c.policy_number,
+                named_insureds.c.name,
+                agents.c.name,
+                delinquency_windows.c.amount_outstanding,
+                delinquency_windows.c.start_date,
+                delinquency_windows.c.end_date,
+            ],
+            from_obj=delinquency_windows.join(
+                policies, policies.c.id == delinquency_windows.c.policy_id
+            )
+            .outerjoin(named_insureds, named_insureds.c.id == policies.c.named_insured)
+            .outerjoin(agents, agents.c.id == policies.c.agent),
+        )
+        .where(delinquency_windows.c.start_date <= date_cursor)
+        .where(delinquency_windows.c.end_date > date_cursor)
+        .order_by(policies.c.id)
+    )
+    return db.session.execute(query).fetchall()
@@ -0,0 +1,368 @@
+#!/user/bin/env python2.7
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy import select
+
+from accounting import db
+from ledger import Ledger
+from models import Invoice, Payment, changes
+from serializers import (
+    DateFormatter,
+    invoice_serializer,
+    payment_serializer,
+    policy_serializer,
+)
+import changelog
+import queries
+import shards
+
+"""
+#######################################################
+Change feed.
+
+Every committed change to a policy, its invoices or its payments is in the
+change log (see models), whichever process made it: a server worker, a job
+or the shell. While anyone in a process is subscribed, a thread follows
+the log and publishes an event per changed policy and kind ("policy",
+"invoices" or "payment") on the process's broker. Subscribers (the
+server-sent event streams in views) either follow one policy or the whole
+book, each through a bounded buffer: a subscriber that falls behind loses
+its oldest events and is told to resync instead of holding memory, as is
+every subscriber when the log was trimmed past what the process had read.
+
+Each stream holds one of its worker's request threads for as long as it is
+open, so a process serves at most EVENT_MAX_STREAMS of them at once and
+turns the rest away (see open_stream).
+#######################################################
+"""
+
+# Seconds between keep-alive comments on an idle stream.
+HEARTBEAT_SECONDS = 15
+
+# Seconds between two reads of the change log while anyone is subscribed.
+POLL_SECONDS = 1.0
+
+# Event kind of each table in the change log.
+KINDS = {"policies": "policy", "invoices": "invoices", "payments": "payment"}
+
+invoices = Invoice.__table__
+payments = Payment.__table__
+
+
+class Subscription(object):
+    __slots__ = ("policy_id", "events", "dropped", "condition")
+
+    def __init__(self, policy_id, buffer_size):
+        """
+        :param policy_id: Policy followed, None for the whole book.
+        :param buffer_size: Events held before the oldest are dropped.
+        """
+        self.policy_id = policy_id
+        self.events = deque(maxlen=buffer_size)
+        self.dropped = False
+        self.condition = threading.Condition()
+
+    def push(self, event):
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped = True
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for an event.
+        :return: Next event, or None if none came within timeout.
+        """
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            if self.events:
+                return self.events.popleft()
+            return None
+
+    def resync(self):
+        with self.condition:
+            self.dropped = True
+            self.condition.notify()
+
+    def take_dropped(self):
+        """
+        :return: True if events were dropped since the last call.
+        """
+        with self.condition:
+            dropped, self.dropped = self.dropped, False
+            return dropped
+
+
+class Broker(object):
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.last_id = 0
+
+    def subscribe(self, policy_id=None):
+        """
+        :param policy_id: Policy to follow, None for every policy.
+        :return: Subscription; pass it to unsubscribe when done.
+        """
+        subscription = Subscription(policy_id, self.buffer_size)
+        with self.lock:
+            self.subscriptions.setdefault(policy_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.policy_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.policy_id, None)
+
+    def has_subscribers(self, policy_id=None):
+        """
+        Lets publishers skip building events nobody listens to.
+        :param policy_id: Policy the events are about, None for any policy.
+        """
+        if policy_id is None:
+            return bool(self.subscriptions)
+        return policy_id in self.subscriptions or None in self.subscriptions
+
+    def resync(self):
+        """
+        Tells every subscriber it missed events.
+        """
+        with self.lock:
+            targets = [
+                subscription
+                for subscriptions in self.subscriptions.values()
+                for subscription in subscriptions
+            ]
+        for subscription in targets:
+            subscription.resync()
+
+    def publish(self, policy_id, kind, data):
+        """
+        :param policy_id: Policy the event is about.
+        :param kind: Event type, e.g. "payment" or "policy".
+        :param data: JSON-serializable payload; policyId is added to it.
+        :return: Number of subscriptions the event was delivered to.
+        """
+        with self.lock:
+            self.last_id += 1
+            targets = list(self.subscriptions.get(policy_id, ()))
+            targets.extend(self.subscriptions.get(None, ()))
+            event = (self.last_id, kind, dict(data, policyId=policy_id))
+        for subscription in targets:
+            subscription.push(event)
+        return len(targets)
+
+
+broker = Broker()
+
+# Streams this process may serve at once, None for no limit.
+max_streams = None
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+# Last change log entry published, by shard (None for the main database).
+_marks = {}
+_poll_lock = threading.Lock()
+
+# The process's log follower, restarted in children after a fork.
+_follower_pid = None
+
+
+def configure(config):
+    """
+    :param config: Mapping with EVENT_BUFFER_SIZE and EVENT_MAX_STREAMS.
+    """
+    global max_streams
+    broker.buffer_size = config.get("EVENT_BUFFER_SIZE", broker.buffer_size)
+    max_streams = config.get("EVENT_MAX_STREAMS")
+
+
+def open_stream():
+    """
+    Takes one of the process's stream slots.
+    :return: False when all of them are taken; otherwise call close_stream
+             once the stream ends.
+    """
+    global _open_streams
+    with _streams_lock:
+        if max_streams is not None and _open_streams >= max_streams:
+            return False
+        _open_streams += 1
+        return True
+
+
+def close_stream():
+    global _open_streams
+    with _streams_lock:
+        _open_streams -= 1
+
+
+def poll(shard=None):
+    """
+    Publishes the changes logged on the current database since the previous
+    poll; the first poll only finds where the log ends.
+    :param shard: Shard being polled, None for the main database.
+    :return: Number of events published.
+    """
+    with _poll_lock:
+        first_id, last_id = changelog.bounds()
+        mark, _marks[shard] = _marks.get(shard), last_id
+        if mark is None or last_id <= mark:
+            return 0
+        if changelog.behind(mark, first_id):
+            broker.resync()
+            return 0
+
+        # Rows changed per policy and kind, in the order they were logged.
+        changed = OrderedDict()
+        rows = db.session.execute(
+            select([changes.c.table_name, changes.c.row_id])
+            .where(changes.c.id > mark)
+            .where(changes.c.id <= last_id)
+            .where(changes.c.table_name.in_(list(KINDS)))
+            .order_by(changes.c.id)
+        ).fetchall()
+        owners = _owners(rows)
+        for table_name, row_id in rows:
+            policy_id = row_id if table_name == "policies" else owners.get(
+                (table_name, row_id)
+            )
+            if policy_id is None or not broker.has_subscribers(policy_id):
+                # Deleted since, or nobody listens.
+                continue
+            kinds = changed.setdefault(policy_id, OrderedDict())
+            kinds.setdefault(KINDS[table_name], set()).add(row_id)
+
+        published = 0
+        format_date = DateFormatter()
+        for policy_id, kinds in changed.items():
+            balance = Ledger.load(policy_id).balance()
+            for kind, row_ids in kinds.items():
+                for data in _events(policy_id, kind, row_ids, format_date):
+                    data["accountBalance"] = balance
+                    broker.publish(policy_id, kind, data)
+                    published += 1
+        return published
+
+
+def _owners(rows):
+    """
+    :return: Dict of (table name, row id) to the policy of invoice and
+             payment rows that still exist.
+    """
+    owners = {}
+    for table_name, table in [("invoices", invoices), ("payments", payments)]:
+        row_ids = list(set(row_id for name, row_id in rows if name == table_name))
+        for start in range(0, len(row_ids), 500):
+            query = select([table.c.id, table.c.policy_id]).where(
+                table.c.id.in_(row_ids[start : start + 500])
+            )
+            for row_id, policy_id in db.session.execute(query):
+                owners[(table_name, row_id)] = policy_id
+    return owners
+
+
+def _events(policy_id, kind, row_ids, format_date):
+    """
+    :return: Payloads of the events about a policy's changed rows: its row,
+             all its invoices, or each changed payment that still exists.
+    """
+    if kind == "policy":
+        row = queries.policy_row(policy_id)
+        return [policy_serializer(row, format_date)] if row is not None else []
+    if kind == "invoices":
+        return [
+            {
+                "invoices": [
+                    invoice_serializer(invoice_row, format_date)
+                    for invoice_row in queries.invoice_rows(policy_id)
+                ]
+            }
+        ]
+    query = (
+        select([payments.c.id, payments.c.amount_paid, payments.c.transaction_date])
+        .where(payments.c.policy_id == policy_id)
+        .where(payments.c.id.in_(list(row_ids)))
+        .order_by(payments.c.id)
+    )
+    return [
+        {"payment": payment_serializer(payment_row, format_date)}
+        for payment_row in db.session.execute(query)
+    ]
+
+
+def follow():
+    """
+    Starts the process's change log follower unless it is running; it
+    polls every database while anyone in the process is subscribed.
+    """
+    global _follower_pid
+    with _poll_lock:
+        if _follower_pid == os.getpid():
+            return
+        # Threads do not survive fork; serve.py workers start their own.
+        _follower_pid = os.getpid()
+        _marks.clear()
+    thread = threading.Thread(target=_follow)
+    thread.daemon = True
+    thread.start()
+
+
+def _follow():
+    while True:
+        if not broker.has_subscribers():
+            # Nobody to tell: pick up from the end of the log later on.
+            with _poll_lock:
+                _marks.clear()
+        for shard in shards.names or [None]:
+            if not broker.has_subscribers():
+                break
+            try:
+                with shards.using(shard):
+                    poll(shard)
+                    changelog.save_process_cursor("events", _marks[shard], shard)
+            except Exception as e:
+                sys.stderr.write("change feed poll failed: %s\n" % e)
+            finally:
+                with shards.using(shard):
+                    db.session.remove()
+        time.sleep(POLL_SECONDS)
+
+
+def stream(policy_id=None, heartbeat=HEARTBEAT_SECONDS):
+    """
+    Subscribes and formats the events as a text/event-stream body.
+    Unsubscribes when the client goes away and the server closes the
+    iterator.
+    :param policy_id: Policy to follow, None for every policy.
+    :param heartbeat: Seconds between keep-alive comments.
+    """
+    subscription = broker.subscribe(policy_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            event = subscription.get(heartbeat)
+            if subscription.take_dropped():
+                yield "event: resync\ndata: {}\n\n"
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            event_id, kind, data = event
+            yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+                event_id,
+                kind,
+                json.dumps(data),
+            )
+    finally:
+        broker.unsubscribe(subscription)
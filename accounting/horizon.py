@@ -0,0 +1,88 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+
+from sqlalchemy import bindparam, select
+
+from accounting import db
+from allocations import refresh_allocations
+from billing import invoice_horizon, materialize, pending_invoices
+from models import Policy
+from utils import insert_invoices
+
+"""
+#######################################################
+Rolling invoice horizon extender.
+
+Policies billed with a rolling horizon only have the invoices up to their
+invoiced_through date written. This job, run daily, writes the next ones
+for every policy whose horizon has fallen behind, in chunks: one
+executemany for the invoices and one for the new invoiced_through dates.
+#######################################################
+"""
+
+policies = Policy.__table__
+
+HORIZON_COLUMNS = [
+    policies.c.id,
+    policies.c.effective_date,
+    policies.c.billing_schedule,
+    policies.c.annual_premium,
+    policies.c.invoiced_through,
+]
+
+
+def extend_invoices(date_cursor=None, horizon_days=None, dry_run=False, chunk_size=500):
+    """
+    :param date_cursor: Date the horizon is counted from, defaults to today.
+    :param horizon_days: Horizon in days, defaults to INVOICE_HORIZON_DAYS.
+    :param dry_run: Count what would be written without writing anything.
+    :param chunk_size: Policies extended per commit.
+    :return: Dict with the number of policies extended and invoices created.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    through = invoice_horizon(date_cursor, horizon_days)
+    if through is None:
+        raise ValueError("No invoice horizon configured (INVOICE_HORIZON_DAYS).")
+
+    query = (
+        select(HORIZON_COLUMNS)
+        .where(policies.c.invoiced_through != None)
+        .where(policies.c.invoiced_through < through)
+        .order_by(policies.c.id)
+        .limit(chunk_size)
+    )
+
+    extended, invoiced, last_id = 0, 0, 0
+    while True:
+        chunk = db.session.execute(query.where(policies.c.id > last_id)).fetchall()
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+
+        invoices, horizons = [], []
+        for row in chunk:
+            written, invoiced_through = materialize(
+                pending_invoices(*row[1:]), through, first=False
+            )
+            invoices.extend((row[0],) + invoice for invoice in written)
+            horizons.append({"policy": row[0], "through": invoiced_through})
+        extended += len(chunk)
+        invoiced += len(invoices)
+
+        if not dry_run:
+            insert_invoices(invoices)
+            db.session.execute(
+                policies.update()
+                .where(policies.c.id == bindparam("policy"))
+                .values(invoiced_through=bindparam("through")),
+                horizons,
+            )
+            # Ledgers already counted these invoices from the plan, so the
+            # delinquency windows do not change. Allocations only cover
+            # written invoices, so payments made ahead can now be applied.
+            refresh_allocations(set(invoice[0] for invoice in invoices))
+            db.session.commit()
+
+    return {"policies": extended, "invoices": invoiced, "dry_run": dry_run}
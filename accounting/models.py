@@ -1,3 +1,5 @@
+from sqlalchemy import DDL, event
+
 from accounting import db
 
 # from sqlalchemy.ext.declarative import declarative_base
@@ -35,6 +37,9 @@ class Policy(db.Model):
         u"named_insured", db.INTEGER(), db.ForeignKey("contacts.id")
     )
     agent = db.Column(u"agent", db.INTEGER(), db.ForeignKey("contacts.id"))
+    # Last bill date whose invoices have been written when billing with a
+    # rolling horizon; NULL once the whole term is invoiced (see billing).
+    invoiced_through = db.Column(u"invoiced_through", db.DATE())
 
     def __init__(self, policy_number, effective_date, annual_premium):
         self.policy_number = policy_number
@@ -106,3 +111,161 @@ class Payment(db.Model):
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+
+def archive_table(table):
+    """
+    Same columns as table, minus foreign keys, for rows that are only kept
+    around for history. Rows are moved there by accounting.archive.
+    """
+    return db.Table(
+        table.name + "_archive",
+        db.metadata,
+        *[
+            db.Column(
+                column.name,
+                column.type,
+                primary_key=column.primary_key,
+                nullable=column.nullable,
+            )
+            for column in table.columns
+        ]
+    )
+
+
+policies_archive = archive_table(Policy.__table__)
+invoices_archive = archive_table(Invoice.__table__)
+payments_archive = archive_table(Payment.__table__)
+
+
+# Every insert, update and delete on the tracked tables is recorded here by
+# SQLite triggers; the ids give snapshot exports something to resume from.
+changes = db.Table(
+    "changes",
+    db.metadata,
+    db.Column(u"id", db.INTEGER(), primary_key=True, nullable=False),
+    db.Column(u"table_name", db.VARCHAR(length=32), nullable=False),
+    db.Column(u"row_id", db.INTEGER(), nullable=False),
+    sqlite_autoincrement=True,
+)
+
+# How far each reader of the change log has read; see accounting.changelog.
+change_cursors = db.Table(
+    "change_cursors",
+    db.metadata,
+    db.Column(u"name", db.VARCHAR(length=255), primary_key=True, nullable=False),
+    db.Column(u"change_id", db.INTEGER(), nullable=False),
+    db.Column(u"expires_at", db.DATETIME()),
+)
+
+# Contacts are tracked for the contact names cached in policy rows.
+CHANGE_TRACKED_TABLES = ["policies", "invoices", "payments", "contacts"]
+CHANGE_TRIGGER_ROWS = [("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")]
+
+CHANGE_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS %(table)s_%(operation)s_changes "
+    "AFTER %(operation)s ON %(table)s BEGIN "
+    "INSERT INTO changes (table_name, row_id) VALUES ('%(table)s', %(row)s.id); "
+    "END"
+)
+
+
+def install_change_log(target, connection, **kw):
+    """
+    Creates the change log and its triggers if they are missing. Runs after
+    create_all and can be called again on an existing database. The table
+    comes first: a trigger without it would fail every write it fires on.
+    """
+    changes.create(connection, checkfirst=True)
+    change_cursors.create(connection, checkfirst=True)
+    for table_name in CHANGE_TRACKED_TABLES:
+        for operation, row in CHANGE_TRIGGER_ROWS:
+            statement = CHANGE_TRIGGER % {
+                "table": table_name,
+                "operation": operation,
+                "row": row,
+            }
+            connection.execute(DDL(statement))
+
+
+event.listen(db.metadata, "after_create", install_change_log)
+
+
+# Contacts changed on the main database and not copied to a shard yet; see
+# accounting.shards. Only the main database's is used.
+contact_outbox = db.Table(
+    "contact_outbox",
+    db.metadata,
+    db.Column(u"id", db.INTEGER(), primary_key=True, nullable=False),
+    db.Column(u"shard", db.VARCHAR(length=32), nullable=False),
+    db.Column(u"contact_id", db.INTEGER(), nullable=False),
+    db.Index("ix_contact_outbox_shard", "shard", "id"),
+)
+
+
+# Maintained by accounting.delinquency: the days on which each policy is
+# pending cancellation due to non-pay, end_date exclusive.
+delinquency_windows = db.Table(
+    "delinquency_windows",
+    db.metadata,
+    db.Column(u"id", db.INTEGER(), primary_key=True, nullable=False),
+    db.Column(
+        u"policy_id", db.INTEGER(), db.ForeignKey("policies.id"), nullable=False
+    ),
+    db.Column(u"start_date", db.DATE(), nullable=False),
+    db.Column(u"end_date", db.DATE(), nullable=False),
+    db.Column(u"amount_outstanding", db.INTEGER(), nullable=False),
+    db.Index("ix_delinquency_windows_dates", "start_date", "end_date"),
+    db.Index("ix_delinquency_windows_policy_id", "policy_id"),
+)
+
+
+# Maintained by accounting.allocations: how much of each payment went to
+# which invoice. No foreign keys, so that the rows stay valid once their
+# invoices and payments are moved to the archive; deleting them outright
+# deletes their allocations through triggers instead (see below).
+invoice_allocations = db.Table(
+    "invoice_allocations",
+    db.metadata,
+    db.Column(u"id", db.INTEGER(), primary_key=True, nullable=False),
+    db.Column(u"policy_id", db.INTEGER(), nullable=False),
+    db.Column(u"invoice_id", db.INTEGER(), nullable=False),
+    db.Column(u"payment_id", db.INTEGER(), nullable=False),
+    db.Column(u"amount", db.INTEGER(), nullable=False),
+    db.Index("ix_invoice_allocations_invoice_id", "invoice_id"),
+    db.Index("ix_invoice_allocations_policy_id", "policy_id"),
+)
+
+ALLOCATION_CLEANUP_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS %(table)s_delete_allocations "
+    "AFTER DELETE ON %(table)s "
+    "WHEN NOT EXISTS (SELECT 1 FROM %(table)s_archive WHERE id = OLD.id) BEGIN "
+    "DELETE FROM invoice_allocations WHERE %(column)s = OLD.id; "
+    "END"
+)
+
+
+def install_allocation_cleanup(target, connection, **kw):
+    """
+    Deletes the allocations of invoices and payments deleted outright, which
+    would otherwise be picked up by a later row SQLite gives the same id.
+    Rows moved to the archive (copied there before they are deleted) keep
+    theirs. Like install_change_log, creates what the triggers use first.
+    """
+    for table in [invoice_allocations, invoices_archive, payments_archive]:
+        table.create(connection, checkfirst=True)
+    connection.execute(
+        DDL(
+            "CREATE INDEX IF NOT EXISTS ix_invoice_allocations_payment_id "
+            "ON invoice_allocations (payment_id)"
+        )
+    )
+    for table_name, column in [("invoices", "invoice_id"), ("payments", "payment_id")]:
+        statement = ALLOCATION_CLEANUP_TRIGGER % {
+            "table": table_name,
+            "column": column,
+        }
+        connection.execute(DDL(statement))
+
+
+event.listen(db.metadata, "after_create", install_allocation_cleanup)
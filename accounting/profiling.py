@@ -0,0 +1,265 @@
+#!/user/bin/env python2.7
+
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from datetime import datetime
+from urlparse import parse_qs
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+#######################################################
+On-demand request profiling.
+
+With PROFILE_DIR set, a request sent with an `X-Profile: 1` header or a
+`profile=1` query flag runs under cProfile while the SQL statements it
+issues are timed. Each profiled request leaves two files in PROFILE_DIR:
+<id>.prof, loadable with pstats or snakeviz, and <id>.json, the report
+served by /debug/profiles. Without PROFILE_DIR nothing is installed, so
+ordinary requests pay nothing. Only the view runs under the profiler;
+a streamed body (the change feeds) is produced afterwards.
+#######################################################
+"""
+
+# Functions listed in a report, by cumulative time.
+REPORT_FUNCTIONS = 30
+
+# Characters of each statement's parameters kept in a report.
+PARAMETERS_LENGTH = 200
+
+# Report fields listed by /debug/profiles.
+SUMMARY_FIELDS = (
+    "id",
+    "method",
+    "path",
+    "query",
+    "status",
+    "started",
+    "durationMs",
+    "sqlCount",
+    "sqlMs",
+)
+
+PROFILE_ID = re.compile(r"^[0-9]+-[0-9]+-[0-9]+$")
+
+# SQL statements of the request being profiled on this thread, if any.
+_local = threading.local()
+_counter = itertools.count(1)
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def install(app):
+    """
+    Wraps the application in the profiler when PROFILE_DIR is configured.
+    Statements are timed on every engine, shards and read replicas alike,
+    but only on threads profiling a request.
+    :param app: Flask application.
+    """
+    directory = app.config.get("PROFILE_DIR")
+    if not directory:
+        return
+    global _listening
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            _listening = True
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app, directory, app.config.get("PROFILE_KEEP", 100)
+    )
+
+
+def statements():
+    """
+    :return: Statements recorded for the request profiled on this thread,
+             None if it is not profiling one.
+    """
+    return getattr(_local, "statements", None)
+
+
+def record_into(recorded):
+    """
+    Records this thread's statements into a profiled request's, for threads
+    working on its behalf (see shards.gather).
+    :param recorded: statements() of the request's thread; None stops.
+    """
+    _local.statements = recorded
+
+
+def requested(environ):
+    """
+    :return: True if the request asks to be profiled.
+    """
+    if environ.get("HTTP_X_PROFILE") in ("1", "true"):
+        return True
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    return query.get("profile", [""])[-1] in ("1", "true")
+
+
+class ProfilingMiddleware(object):
+    def __init__(self, wsgi_app, directory, keep=100):
+        """
+        :param wsgi_app: Application to profile.
+        :param directory: Where reports are written.
+        :param keep: Reports kept before the oldest are removed.
+        """
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.keep = keep
+
+    def __call__(self, environ, start_response):
+        if not requested(environ):
+            return self.wsgi_app(environ, start_response)
+
+        statuses = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        profiler = cProfile.Profile()
+        _local.statements = []
+        started = datetime.now()
+        start = time.time()
+        try:
+            body = profiler.runcall(self.wsgi_app, environ, recording_start_response)
+        finally:
+            duration = time.time() - start
+            statements, _local.statements = _local.statements, None
+        self.write(
+            profiler,
+            {
+                "method": environ.get("REQUEST_METHOD"),
+                "path": environ.get("PATH_INFO"),
+                "query": environ.get("QUERY_STRING", ""),
+                "status": int(statuses[-1].split()[0]) if statuses else None,
+                "started": started.isoformat(),
+                "durationMs": round(duration * 1000, 3),
+            },
+            statements,
+        )
+        return body
+
+    def write(self, profiler, report, statements):
+        """
+        Writes the <id>.prof and <id>.json files of a profiled request.
+        """
+        profile_id = "%s-%d-%d" % (
+            time.strftime("%Y%m%d%H%M%S"),
+            os.getpid(),
+            next(_counter),
+        )
+        path = os.path.join(self.directory, profile_id)
+        profiler.dump_stats(path + ".prof")
+
+        report["id"] = profile_id
+        report["sqlCount"] = len(statements)
+        report["sqlMs"] = round(sum(statement[2] for statement in statements), 3)
+        report["sql"] = [
+            {
+                "statement": statement,
+                "parameters": parameters,
+                "durationMs": round(duration, 3),
+            }
+            for statement, parameters, duration in statements
+        ]
+        report["functions"] = top_functions(pstats.Stats(profiler))
+        with open(path + ".json", "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        self.prune()
+
+    def prune(self):
+        """
+        Removes the oldest reports beyond the ones kept.
+        """
+        profile_ids = sorted(list_ids(self.directory), key=_sort_key)
+        for profile_id in profile_ids[: max(len(profile_ids) - self.keep, 0)]:
+            for extension in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+                except OSError:
+                    pass
+
+
+def top_functions(stats, limit=REPORT_FUNCTIONS):
+    """
+    :param stats: pstats.Stats of a request.
+    :return: The functions with the most cumulative time, as dicts.
+    """
+    rows = sorted(
+        stats.stats.items(), key=lambda item: item[1][3], reverse=True
+    )[:limit]
+    return [
+        {
+            "function": "%s:%d(%s)" % function,
+            "calls": calls,
+            "totalMs": round(total * 1000, 3),
+            "cumulativeMs": round(cumulative * 1000, 3),
+        }
+        for function, (_, calls, total, cumulative, _) in rows
+    ]
+
+
+def list_ids(directory):
+    return [
+        name[: -len(".json")]
+        for name in os.listdir(directory)
+        if name.endswith(".json") and PROFILE_ID.match(name[: -len(".json")])
+    ]
+
+
+def list_profiles(directory):
+    """
+    :param directory: PROFILE_DIR.
+    :return: Summaries of the stored reports, newest first.
+    """
+    profiles = []
+    for profile_id in sorted(list_ids(directory), key=_sort_key, reverse=True):
+        report = load_profile(directory, profile_id)
+        if report is not None:
+            profiles.append(dict((key, report.get(key)) for key in SUMMARY_FIELDS))
+    return profiles
+
+
+def load_profile(directory, profile_id):
+    """
+    :return: The report, or None if there is no such profile.
+    """
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(directory, profile_id + ".json")) as report_file:
+            return json.load(report_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _sort_key(profile_id):
+    return tuple(int(part) for part in profile_id.split("-"))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, "statements", None) is not None:
+        _local.started = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    statements = getattr(_local, "statements", None)
+    if statements is not None:
+        statements.append(
+            (
+                statement,
+                repr(parameters)[:PARAMETERS_LENGTH],
+                (time.time() - _local.started) * 1000,
+            )
+        )
@@ -0,0 +1,249 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import func, select, union_all
+
+from accounting import db
+import billing
+from models import (
+    Contact,
+    Invoice,
+    Payment,
+    Policy,
+    invoice_allocations,
+    invoices_archive,
+    payments_archive,
+    policies_archive,
+)
+
+"""
+#######################################################
+ORM-free read path.
+
+These helpers select only the columns the read endpoints need through
+SQLAlchemy Core and return plain row tuples, so no mapped instances are
+built, instrumented or tracked in the session's identity map.
+#######################################################
+"""
+
+policies = Policy.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+named_insureds = Contact.__table__.alias("named_insureds")
+agents = Contact.__table__.alias("agents")
+
+# Row layout: (id, policy_number, effective_date, status,
+#              status_change_description, status_change_date,
+#              billing_schedule, annual_premium, invoiced_through,
+#              named_insured, agent)
+POLICY_FIELDS = [
+    "id",
+    "policy_number",
+    "effective_date",
+    "status",
+    "status_change_description",
+    "status_change_date",
+    "billing_schedule",
+    "annual_premium",
+    "invoiced_through",
+]
+
+# Row layout: (id, bill_date, due_date, cancel_date, amount_due, deleted,
+#              amount_paid)
+INVOICE_FIELDS = ["id", "bill_date", "due_date", "cancel_date", "amount_due", "deleted"]
+
+# Row layout: (id, amount_paid, transaction_date)
+PAYMENT_FIELDS = ["id", "amount_paid", "transaction_date"]
+
+
+def _policy_query(table):
+    return select(
+        [table.c[field].label(field) for field in POLICY_FIELDS]
+        + [named_insureds.c.name.label("named_insured"), agents.c.name.label("agent")],
+        from_obj=table.outerjoin(
+            named_insureds, named_insureds.c.id == table.c.named_insured
+        ).outerjoin(agents, agents.c.id == table.c.agent),
+    )
+
+
+def _invoice_columns(table):
+    # Paid amounts come from the allocations kept by accounting.allocations,
+    # one indexed lookup per invoice.
+    amount_paid = (
+        select([func.coalesce(func.sum(invoice_allocations.c.amount), 0)])
+        .where(invoice_allocations.c.invoice_id == table.c.id)
+        .as_scalar()
+    )
+    return [table.c[field].label(field) for field in INVOICE_FIELDS] + [
+        amount_paid.label("amount_paid")
+    ]
+
+
+def _with_history(query_for, table, archive, history):
+    """
+    :param query_for: Builds the select for a given table.
+    :param table: Hot table.
+    :param archive: Its archive table, unioned in when history is asked for.
+    :param history: Whether archived rows are included.
+    """
+    if not history:
+        return query_for(table)
+    return union_all(query_for(table), query_for(archive))
+
+
+def policy_rows(history=False, policy_ids=None):
+    """
+    :param history: Include policies moved to the archive.
+    :param policy_ids: Only fetch these policies; keep it to a few hundred ids.
+    :return: Every policy row, contact names already joined in.
+    """
+
+    def query_for(table):
+        query = _policy_query(table)
+        if policy_ids is not None:
+            query = query.where(table.c.id.in_(list(policy_ids)))
+        return query
+
+    query = _with_history(query_for, policies, policies_archive, history)
+    return db.session.execute(query.order_by("id")).fetchall()
+
+
+def policy_row(policy_id, history=False):
+    """
+    :param policy_id: Policy to fetch.
+    :param history: Also look for the policy in the archive.
+    :return: The policy row or None if it does not exist.
+    """
+
+    def query_for(table):
+        return _policy_query(table).where(table.c.id == policy_id)
+
+    query = _with_history(query_for, policies, policies_archive, history)
+    return db.session.execute(query).first()
+
+
+def invoice_rows(policy_id, history=False):
+    """
+    :param policy_id: Policy whose invoices are fetched.
+    :param history: Include invoices moved to the archive.
+    :return: All invoice rows for the policy, deleted ones included.
+    """
+
+    def query_for(table):
+        columns = _invoice_columns(table)
+        return select(columns).where(table.c.policy_id == policy_id)
+
+    query = _with_history(query_for, invoices, invoices_archive, history)
+    query = query.order_by("bill_date", "id")
+    return db.session.execute(query).fetchall()
+
+
+def payment_rows(policy_id, history=False):
+    """
+    :param policy_id: Policy whose payments are fetched.
+    :param history: Include payments moved to the archive.
+    :return: All payment rows for the policy.
+    """
+
+    def query_for(table):
+        columns = [table.c[field].label(field) for field in PAYMENT_FIELDS]
+        return select(columns).where(table.c.policy_id == policy_id)
+
+    query = _with_history(query_for, payments, payments_archive, history)
+    query = query.order_by("transaction_date", "id")
+    return db.session.execute(query).fetchall()
+
+
+def invoice_rows_by_policy(policy_ids, history=False):
+    """
+    Batched invoice_rows(), with a single IN-list query.
+    :param policy_ids: Policies whose invoices are fetched (at most a few hundred).
+    :param history: Include invoices moved to the archive.
+    :return: Dict of policy id to its invoice rows, in invoice_rows() order.
+             Policies without invoices are left out.
+    """
+
+    def query_for(table):
+        columns = _invoice_columns(table)
+        return select([table.c.policy_id.label("policy_id")] + columns).where(
+            table.c.policy_id.in_(list(policy_ids))
+        )
+
+    query = _with_history(query_for, invoices, invoices_archive, history)
+    return _group_by_policy(query.order_by("policy_id", "bill_date", "id"))
+
+
+def payment_rows_by_policy(policy_ids, history=False):
+    """
+    Batched payment_rows(), with a single IN-list query.
+    :param policy_ids: Policies whose payments are fetched (at most a few hundred).
+    :param history: Include payments moved to the archive.
+    :return: Dict of policy id to its payment rows, in payment_rows() order.
+             Policies without payments are left out.
+    """
+
+    def query_for(table):
+        columns = [table.c[field].label(field) for field in PAYMENT_FIELDS]
+        return select([table.c.policy_id.label("policy_id")] + columns).where(
+            table.c.policy_id.in_(list(policy_ids))
+        )
+
+    query = _with_history(query_for, payments, payments_archive, history)
+    return _group_by_policy(query.order_by("policy_id", "transaction_date", "id"))
+
+
+def _group_by_policy(query):
+    """
+    :param query: Select whose first column is the policy id, ordered by it.
+    :return: Dict of policy id to its rows, without the policy id column.
+    """
+    grouped = {}
+    for row in db.session.execute(query):
+        grouped.setdefault(row[0], []).append(tuple(row)[1:])
+    return grouped
+
+
+def pending_invoices(policy_row):
+    """
+    :param policy_row: Row as returned by policy_row().
+    :return: The policy's invoices that a rolling horizon has not written yet,
+             as (bill_date, due_date, cancel_date, amount_due) tuples.
+    """
+    (
+        _,
+        _,
+        effective_date,
+        _,
+        _,
+        _,
+        billing_schedule,
+        annual_premium,
+        invoiced_through,
+        _,
+        _,
+    ) = policy_row
+    return billing.pending_invoices(
+        effective_date, billing_schedule, annual_premium, invoiced_through
+    )
+
+
+def account_balance(invoice_rows, payment_rows, date_cursor, pending=()):
+    """
+    Same result as PolicyAccounting.return_account_balance, computed over
+    rows that have already been fetched for display.
+    :param invoice_rows: Rows as returned by invoice_rows().
+    :param payment_rows: Rows as returned by payment_rows().
+    :param date_cursor: Date (not datetime) at which the balance is calculated.
+    :param pending: Invoices not written yet, as returned by pending_invoices().
+    :return: Account balance / How much is left to pay.
+    """
+    due_now = 0
+    for _, bill_date, _, _, amount_due, deleted, _ in invoice_rows:
+        if not deleted and bill_date <= date_cursor:
+            due_now += amount_due
+    for bill_date, _, _, amount_due in pending:
+        if bill_date <= date_cursor:
+            due_now += amount_due
+    for _, amount_paid, transaction_date in payment_rows:
+        if transaction_date <= date_cursor:
+            due_now -= amount_paid
+    return due_now
@@ -0,0 +1,133 @@
+#!/user/bin/env python2.7
+
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from accounting import db
+from billing import BILLING_SCHEDULES, plan_invoices
+from ledger import Ledger
+from models import Policy
+from serializers import DateFormatter, policy_serializer, quote_serializer
+import queries
+
+"""
+#######################################################
+Billing schedule quotes.
+
+What a policy would be billed under each billing schedule, and how its
+balance would move, if change_billing_schedule were called today: the
+term's invoices are worked out with plan_invoices, as make_invoices does,
+and replayed against the payments already made in an in-memory Ledger.
+Nothing is added to or written through the session.
+#######################################################
+"""
+
+IN_LIST_SIZE = 500
+
+# Order in which schedules are quoted.
+SCHEDULES = sorted(BILLING_SCHEDULES, key=BILLING_SCHEDULES.get)
+
+policies = Policy.__table__
+
+
+def quote(policy_row, payment_rows, date_cursor=None, schedules=SCHEDULES):
+    """
+    :param policy_row: Policy row as returned by queries.policy_row().
+    :param payment_rows: Its payment rows as returned by queries.payment_rows().
+    :param date_cursor: Date the account balance is quoted at, defaults to today.
+    :param schedules: Billing schedules to quote.
+    :return: List of (billing_schedule, invoices, account_balance), invoices
+             being (bill_date, due_date, cancel_date, amount_due, balance)
+             tuples where balance is what would be owed on the bill date.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    policy_id, effective_date = policy_row[0], policy_row[2]
+    annual_premium = policy_row[7]
+    payments = [
+        (transaction_date, amount_paid)
+        for _, amount_paid, transaction_date in payment_rows
+    ]
+
+    quotes = []
+    for billing_schedule in schedules:
+        invoices = plan_invoices(effective_date, billing_schedule, annual_premium)
+        ledger = Ledger(policy_id, invoices, payments)
+        quotes.append(
+            (
+                billing_schedule,
+                [invoice + (ledger.balance(invoice[0]),) for invoice in invoices],
+                ledger.balance(date_cursor),
+            )
+        )
+    return quotes
+
+
+def quote_policies(policy_ids, date_cursor=None, schedules=SCHEDULES):
+    """
+    Batched quote(), with two IN-list queries per few hundred policies.
+    :param policy_ids: Policies to quote.
+    :return: Dict of policy id to (policy_row, quotes). Unknown policies are
+             left out.
+    """
+    policy_ids = list(policy_ids)
+    quoted = {}
+    for start in range(0, len(policy_ids), IN_LIST_SIZE):
+        chunk = policy_ids[start : start + IN_LIST_SIZE]
+        payment_rows = queries.payment_rows_by_policy(chunk)
+        for row in queries.policy_rows(policy_ids=chunk):
+            quoted[row[0]] = (
+                row,
+                quote(row, payment_rows.get(row[0], []), date_cursor, schedules),
+            )
+    return quoted
+
+
+def quote_book(date_cursor=None, status="Active", chunk_size=500):
+    """
+    Quotes every policy with the given status, a chunk at a time.
+    :param date_cursor: Date balances are quoted at, defaults to today.
+    :param status: Status of the policies quoted, None for all.
+    :param chunk_size: Policies read per chunk.
+    :return: Iterator of (policy_row, quotes) by policy id.
+    """
+    query = select([policies.c.id]).order_by(policies.c.id).limit(chunk_size)
+    if status:
+        query = query.where(policies.c.status == status)
+    last_id = 0
+    while True:
+        policy_ids = [
+            row[0] for row in db.session.execute(query.where(policies.c.id > last_id))
+        ]
+        if not policy_ids:
+            break
+        last_id = policy_ids[-1]
+        quoted = quote_policies(policy_ids, date_cursor)
+        for policy_id in policy_ids:
+            if policy_id in quoted:
+                yield quoted[policy_id]
+
+
+def export_quotes(output, date_cursor=None, status="Active", chunk_size=500):
+    """
+    Writes the quotes of every policy with the given status as JSON lines,
+    one policy per line, e.g. for a mailing campaign.
+    :param output: Path of the file written.
+    :return: Dict with the number of policies quoted.
+    """
+    format_date = DateFormatter()
+    quoted = 0
+    with open(output, "w") as output_file:
+        for policy_row, quotes in quote_book(date_cursor, status, chunk_size):
+            record = {
+                "policy": policy_serializer(policy_row, format_date),
+                "quotes": [
+                    quote_serializer(policy_quote, format_date, policy_row[6])
+                    for policy_quote in quotes
+                ],
+            }
+            output_file.write(json.dumps(record, sort_keys=True) + "\n")
+            quoted += 1
+    return {"policies": quoted, "output": output}
@@ -0,0 +1,151 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+from sqlalchemy import func, select
+
+from accounting import db
+from billing import invoice_horizon, materialize, plan_invoices
+from delinquency import refresh_delinquency_windows
+from models import Policy
+from utils import insert_invoices
+import shards
+
+"""
+#######################################################
+Bulk policy term renewal.
+
+Policies are read and written through SQLAlchemy Core in chunks: renewal
+terms are inserted with one executemany, under ids assigned up front, their
+invoices go through insert_invoices and the old terms are expired with one
+UPDATE per chunk. Terms created by a run are never renewed by the same run.
+#######################################################
+"""
+
+TERM = relativedelta(years=1)
+RENEWED_DESCRIPTION = "Term renewed"
+
+policies = Policy.__table__
+
+RENEWAL_COLUMNS = [
+    policies.c.id,
+    policies.c.policy_number,
+    policies.c.effective_date,
+    policies.c.billing_schedule,
+    policies.c.annual_premium,
+    policies.c.named_insured,
+    policies.c.agent,
+]
+
+
+def renew_policies(
+    term_end_from, term_end_to, date_cursor=None, dry_run=False, chunk_size=500
+):
+    """
+    Renews every active policy whose term ends between term_end_from and
+    term_end_to (both inclusive). Each renewal is a new policy with the same
+    number, schedule, premium and contacts, effective on the old term's end.
+    :param term_end_from: First term end date in the window.
+    :param term_end_to: Last term end date in the window.
+    :param date_cursor: Date recorded as the old terms' status change date,
+                        defaults to today.
+    :param dry_run: Count what would be renewed without writing anything.
+    :param chunk_size: Policies renewed per commit.
+    :return: Dict with the number of policies renewed and invoices created.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    through = invoice_horizon(date_cursor)
+
+    # Renewals get ids above every existing one: stop there, or a window
+    # longer than a term would renew them again.
+    top_id = db.session.execute(select([func.max(policies.c.id)])).scalar() or 0
+    # Half-open, as TERM clamps month ends: a term starting on February 29
+    # ends on February 28, which term_end_to - TERM would miss.
+    query = (
+        select(RENEWAL_COLUMNS)
+        .where(policies.c.status == "Active")
+        .where(policies.c.id <= top_id)
+        .where(policies.c.effective_date >= term_end_from - TERM)
+        .where(
+            policies.c.effective_date < term_end_to + timedelta(days=1) - TERM
+        )
+        .order_by(policies.c.id)
+        .limit(chunk_size)
+    )
+
+    renewed, invoiced, last_id = 0, 0, 0
+    while True:
+        chunk = db.session.execute(query.where(policies.c.id > last_id)).fetchall()
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+
+        renewals = [_renewal(row) for row in chunk]
+        plans = []
+        for renewal in renewals:
+            plan, renewal["invoiced_through"] = materialize(
+                plan_invoices(
+                    renewal["effective_date"],
+                    renewal["billing_schedule"],
+                    renewal["annual_premium"],
+                ),
+                through,
+            )
+            plans.append(plan)
+        renewed += len(renewals)
+        invoiced += sum(len(plan) for plan in plans)
+
+        if not dry_run:
+            _write_chunk(chunk, renewals, plans, date_cursor)
+            db.session.commit()
+
+    return {"policies": renewed, "invoices": invoiced, "dry_run": dry_run}
+
+
+def _renewal(row):
+    (
+        _,
+        policy_number,
+        effective_date,
+        billing_schedule,
+        annual_premium,
+        named_insured,
+        agent,
+    ) = row
+    return {
+        "policy_number": policy_number,
+        "effective_date": effective_date + TERM,
+        "status": "Active",
+        "billing_schedule": billing_schedule,
+        "annual_premium": annual_premium,
+        "named_insured": named_insured,
+        "agent": agent,
+    }
+
+
+def _write_chunk(chunk, renewals, plans, date_cursor):
+    # SQLite's executemany does not hand back the new ids, and policy numbers
+    # are not unique, so the ids are assigned before the insert (on the shard
+    # of the terms renewed when sharded).
+    new_ids = shards.new_policy_ids(len(renewals))
+    for renewal, policy_id in zip(renewals, new_ids):
+        renewal["id"] = policy_id
+    db.session.execute(policies.insert(), renewals)
+
+    invoices = []
+    for policy_id, plan in zip(new_ids, plans):
+        invoices.extend((policy_id,) + invoice for invoice in plan)
+    insert_invoices(invoices)
+    refresh_delinquency_windows(new_ids)
+
+    db.session.execute(
+        policies.update()
+        .where(policies.c.id.in_([row[0] for row in chunk]))
+        .values(
+            status="Expired",
+            status_change_date=date_cursor,
+            status_change_description=RENEWED_DESCRIPTION,
+        )
+    )
@@ -0,0 +1,311 @@
+#!/user/bin/env python2.7
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, exc
+
+from accounting import AccountingSession, db, replica_bind, shard_scope
+import shards
+
+"""
+#######################################################
+Read replicas.
+
+With REPLICA_DIR set, refresh() copies the main database, or every shard,
+into REPLICA_DIR with VACUUM INTO: SQLite's online copy, made from a single
+read transaction, so a replica holds exactly what was committed when its
+copy started. The copy is renamed over the previous one, and connections
+still open on an older copy reconnect before their next use.
+
+Reads that can live with a little staleness (the policy list, the reports,
+PolicyAccounting's balances) run inside reading(). It points db.session at
+the replicas while the oldest is at most REPLICA_MAX_LAG seconds old and
+was copied after the client's last write, so clients read their own
+writes. A response to a request that committed hands the client the time
+of the commit, in a cookie and the X-Written-At header (see
+remember_writes); its next requests send it back, whichever thread or
+worker serves them. Outside requests (jobs, the shell) the thread's own
+last commit counts instead. Writes, and every other read, stay on the
+primary databases.
+#######################################################
+"""
+
+# Directory replicas are copied to; None when they are disabled.
+directory = None
+max_lag = 30
+
+# Reads in this process by where they went: "replica", "stale" (the
+# replicas were too old or missing) or "ownWrites".
+reads = Counter()
+_reads_lock = threading.Lock()
+
+# Cookie and header carrying the time of a client's last write.
+WRITTEN_AT_COOKIE = "accounting_written_at"
+WRITTEN_AT_HEADER = "X-Written-At"
+
+# Time of the thread's last commit to a primary database, outside requests.
+_local = threading.local()
+
+# Replica engines that reconnect after a refresh.
+_watched = set()
+_watched_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Registers the replicas as Flask-SQLAlchemy binds; call after
+    shards.configure.
+    :param config: Mapping with REPLICA_DIR and REPLICA_MAX_LAG.
+    """
+    global directory, max_lag
+    directory = config.get("REPLICA_DIR")
+    max_lag = config.get("REPLICA_MAX_LAG", 30)
+    reads.clear()
+    if directory:
+        binds = dict(config.get("SQLALCHEMY_BINDS") or {})
+        for shard in databases():
+            binds[replica_bind(shard)] = "sqlite:///" + path(shard)
+        config["SQLALCHEMY_BINDS"] = binds
+
+
+def databases():
+    """
+    :return: Shards that have a replica, [None] for the main database when
+             not sharded.
+    """
+    return shards.names or [None]
+
+
+def path(shard=None):
+    """
+    :return: Path of the replica of a shard, or of the main database.
+    """
+    return os.path.join(os.path.abspath(directory), "%s.sqlite" % (shard or "main"))
+
+
+def refresh(shard=None):
+    """
+    Copies a primary database over its replica. Needs SQLite 3.27 or later
+    for VACUUM INTO; only one refresh should run at a time.
+    :param shard: Shard to copy, None for the main database.
+    :return: Dict with the replica's path and the seconds the copy took.
+    """
+    if not directory:
+        raise RuntimeError("Replicas are disabled: set REPLICA_DIR.")
+    source = shards.engine(shard).url.database
+    target = path(shard)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    copy = target + ".copy"
+    if os.path.exists(copy):
+        os.remove(copy)
+
+    started = time.time()
+    connection = sqlite3.connect(source, isolation_level=None)
+    try:
+        connection.execute("VACUUM INTO ?", (copy,))
+    finally:
+        connection.close()
+    # The file's mtime tells every process what the replica is as of.
+    os.utime(copy, (started, started))
+    os.rename(copy, target)
+    return {"replica": target, "seconds": round(time.time() - started, 3)}
+
+
+def refresh_all():
+    """
+    :return: Dict of database name to refresh()'s result.
+    """
+    return dict((shard or "main", refresh(shard)) for shard in databases())
+
+
+def refreshed_at(shard=None):
+    """
+    :return: Time the replica was copied at, None if there is none.
+    """
+    try:
+        return os.stat(path(shard)).st_mtime
+    except OSError:
+        return None
+
+
+def lag():
+    """
+    :return: Seconds since the oldest replica was copied, None if one is
+             missing or replicas are disabled.
+    """
+    if not directory:
+        return None
+    copied = [refreshed_at(shard) for shard in databases()]
+    if None in copied:
+        return None
+    return max(time.time() - min(copied), 0)
+
+
+@contextmanager
+def reading():
+    """
+    Runs the block's queries on the replicas when they are fresh enough,
+    on the primary databases otherwise. Blocks may nest.
+    """
+    if not directory or getattr(shard_scope, "replica", False):
+        yield
+        return
+    route = _route()
+    with _reads_lock:
+        reads[route] += 1
+    if route != "replica":
+        yield
+        return
+
+    _watch()
+    shard_scope.replica = True
+    try:
+        yield
+    finally:
+        for shard in databases():
+            with shards.using(shard):
+                db.session.remove()
+        shard_scope.replica = False
+
+
+def reads_replica(method):
+    """
+    Runs a PolicyAccounting read method inside reading().
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with reading():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def remember_writes(response):
+    """
+    After request hook: hands the client the time of the request's last
+    commit, which it sends back on its next requests (see _written_at).
+    """
+    written_at = getattr(g, "replica_written_at", None)
+    if directory and written_at is not None:
+        value = "%.6f" % written_at
+        # Older writes are in every replica fresh enough to be read.
+        response.set_cookie(
+            WRITTEN_AT_COOKIE, value, max_age=int(math.ceil(max_lag)) + 1
+        )
+        response.headers[WRITTEN_AT_HEADER] = value
+    return response
+
+
+def status():
+    """
+    :return: Lag of each replica and the reads routed in this process.
+    """
+    now = time.time()
+    replicas = []
+    for shard in databases():
+        copied = refreshed_at(shard)
+        replicas.append(
+            {
+                "database": shard or "main",
+                "refreshedAt": datetime.fromtimestamp(copied).isoformat()
+                if copied is not None
+                else None,
+                "lagSeconds": round(max(now - copied, 0), 3)
+                if copied is not None
+                else None,
+            }
+        )
+    replica_lag = lag()
+    with _reads_lock:
+        routed = dict(reads)
+    return {
+        "maxLagSeconds": max_lag,
+        "lagSeconds": round(replica_lag, 3) if replica_lag is not None else None,
+        "replicas": replicas,
+        "reads": routed,
+    }
+
+
+def _route():
+    replica_lag = lag()
+    if replica_lag is None or replica_lag > max_lag:
+        return "stale"
+    written_at = _written_at()
+    if written_at is not None and written_at >= time.time() - replica_lag:
+        return "ownWrites"
+    return "replica"
+
+
+def _written_at():
+    """
+    :return: Time of the client's last write, as sent with the request and
+             including the request's own commits; outside requests, of the
+             thread's last commit. None when unknown.
+    """
+    if not has_request_context():
+        return getattr(_local, "written_at", None)
+    written = []
+    for value in [
+        getattr(g, "replica_written_at", None),
+        request.cookies.get(WRITTEN_AT_COOKIE),
+        request.headers.get(WRITTEN_AT_HEADER),
+    ]:
+        try:
+            written.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    return max(written) if written else None
+
+
+def _copy_id(replica_path):
+    try:
+        stat = os.stat(replica_path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime)
+
+
+def _watch():
+    app = db.get_app()
+    with _watched_lock:
+        for shard in databases():
+            engine = db.get_engine(app, bind=replica_bind(shard))
+            if engine not in _watched:
+                _reconnect_on_refresh(engine, path(shard))
+                _watched.add(engine)
+
+
+def _reconnect_on_refresh(engine, replica_path):
+    def connect(dbapi_connection, connection_record):
+        connection_record.info["replica_copy"] = _copy_id(replica_path)
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get("replica_copy") != _copy_id(replica_path):
+            # The connection still has a copy that was renamed over open.
+            raise exc.DisconnectionError("Replica was refreshed.")
+
+    event.listen(engine, "connect", connect)
+    event.listen(engine, "checkout", checkout)
+
+
+def _committed(session):
+    if session.replica:
+        return
+    if has_request_context():
+        g.replica_written_at = time.time()
+    else:
+        _local.written_at = time.time()
+
+
+event.listen(AccountingSession, "after_commit", _committed)
@@ -1,45 +1,156 @@
-from models import Contact
+DATE_FORMAT = "%d/%m/%Y"
 
 
-def get_policy_name_insured(contact_id):
-    return Contact.query.filter_by(id=contact_id).one()
+class DateFormatter(object):
+    """
+    Formats dates, remembering every result for as long as the instance lives.
+    Create one per request: invoices and payments share a handful of distinct
+    dates, so most calls become a dict lookup instead of a strftime.
+    """
 
+    def __init__(self, date_format=DATE_FORMAT):
+        self.date_format = date_format
+        self.formatted = {}
 
-def get_policy_agent(contact_id):
-    return Contact.query.filter_by(id=contact_id).one()
+    def __call__(self, value):
+        try:
+            return self.formatted[value]
+        except KeyError:
+            result = value.strftime(self.date_format) if value else "None"
+            self.formatted[value] = result
+            return result
 
 
-def policy_serializer(policy, account_balance=None):
-    named_insured = get_policy_name_insured(policy.named_insured)
-    agent = get_policy_agent(policy.agent)
+def policy_serializer(row, format_date, account_balance=None):
+    """
+    :param row: Policy row as returned by queries.policy_row().
+    :param format_date: DateFormatter for the current request.
+    :param account_balance: Balance to include, if it was computed.
+    """
+    (
+        policy_id,
+        policy_number,
+        effective_date,
+        status,
+        status_change_description,
+        status_change_date,
+        billing_schedule,
+        annual_premium,
+        _,
+        named_insured,
+        agent,
+    ) = row
     return {
-        "id": policy.id,
-        "name": policy.policy_number,
-        "effectiveDate": policy.effective_date.strftime("%d/%m/%Y"),
-        "status": policy.status,
-        "statusChangeDescription": policy.status_change_description or "None",
-        "statusChangeDate": policy.status_change_date or "None",
-        "billingSchedule": policy.billing_schedule,
-        "annualPremium": policy.annual_premium,
-        "namedInsured": named_insured.name,
-        "agent": agent.name,
+        "id": policy_id,
+        "name": policy_number,
+        "effectiveDate": format_date(effective_date),
+        "status": status,
+        "statusChangeDescription": status_change_description or "None",
+        "statusChangeDate": format_date(status_change_date),
+        "billingSchedule": billing_schedule,
+        "annualPremium": annual_premium,
+        "namedInsured": named_insured,
+        "agent": agent,
         "accountBalance": account_balance,
     }
 
 
-def invoice_serializer(invoice):
+def invoice_serializer(row, format_date):
+    """
+    :param row: Invoice row as returned by queries.invoice_rows().
+    :param format_date: DateFormatter for the current request.
+    """
+    (
+        invoice_id,
+        bill_date,
+        due_date,
+        cancel_date,
+        amount_due,
+        deleted,
+        amount_paid,
+    ) = row
     return {
-        "id": invoice.id,
-        "billDate": invoice.bill_date.strftime("%d/%m/%Y"),
-        "dueDate": invoice.due_date.strftime("%d/%m/%Y"),
-        "cancelDate": invoice.cancel_date.strftime("%d/%m/%Y"),
-        "amountDue": invoice.amount_due,
+        "id": invoice_id,
+        "billDate": format_date(bill_date),
+        "dueDate": format_date(due_date),
+        "cancelDate": format_date(cancel_date),
+        "amountDue": amount_due,
+        "amountPaid": amount_paid,
+        "status": invoice_status(amount_due, deleted, amount_paid),
     }
 
 
-def payment_serializer(payment):
+def invoice_status(amount_due, deleted, amount_paid):
+    """
+    :return: "Paid", "Partially Paid", "Unpaid", or "Deleted" for invoices
+             replaced by a billing schedule change.
+    """
+    if deleted:
+        return "Deleted"
+    if amount_paid >= amount_due:
+        return "Paid"
+    if amount_paid:
+        return "Partially Paid"
+    return "Unpaid"
+
+
+def payment_serializer(row, format_date):
+    """
+    :param row: Payment row as returned by queries.payment_rows().
+    :param format_date: DateFormatter for the current request.
+    """
+    payment_id, amount_paid, transaction_date = row
+    return {
+        "id": payment_id,
+        "amountPaid": amount_paid,
+        "transactionDate": format_date(transaction_date),
+    }
+
+
+def pending_cancellation_serializer(row, format_date):
+    """
+    :param row: Row as returned by delinquency.pending_cancellation().
+    :param format_date: DateFormatter for the current request.
+    """
+    (
+        policy_id,
+        policy_number,
+        named_insured,
+        agent,
+        amount_outstanding,
+        start_date,
+        end_date,
+    ) = row
     return {
-        "id": payment.id,
-        "amountPaid": payment.amount_paid,
-        "transactionDate": payment.transaction_date.strftime("%d/%m/%Y"),
+        "id": policy_id,
+        "name": policy_number,
+        "namedInsured": named_insured,
+        "agent": agent,
+        "amountOutstanding": amount_outstanding,
+        "pendingSince": format_date(start_date),
+        "pendingUntil": format_date(end_date),
+    }
+
+
+def quote_serializer(quote, format_date, billing_schedule=None):
+    """
+    :param quote: One of the quotes returned by quotes.quote().
+    :param format_date: DateFormatter for the current request.
+    :param billing_schedule: The policy's current billing schedule.
+    """
+    schedule, invoices, account_balance = quote
+    return {
+        "billingSchedule": schedule,
+        "current": schedule == billing_schedule,
+        "accountBalance": account_balance,
+        "invoices": [
+            {
+                "billDate": format_date(bill_date),
+                "dueDate": format_date(due_date),
+                "cancelDate": format_date(cancel_date),
+                "amountDue": amount_due,
+                "balance": balance,
+            }
+            for bill_date, due_date, cancel_date, amount_due, balance in invoices
+        ],
     }
@@ -0,0 +1,430 @@
+#!/user/bin/env python2.7
+
+import heapq
+import itertools
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from Queue import Queue
+
+from sqlalchemy import event, exc, func, orm, select
+
+from accounting import AccountingSession, db, shard_scope
+from models import Contact, Policy, contact_outbox, policies_archive
+import profiling
+
+"""
+#######################################################
+Horizontal sharding by policy id.
+
+With SHARDS set, policies live in several SQLite files, each with the full
+schema: policy p is on shard p % len(SHARDS), together with its invoices,
+payments, change log and indexes, so everything about one policy is still
+read and written through a single database. New policies are placed round
+robin and given an id that maps back to their shard. Contacts are written
+to the main database (SQLALCHEMY_DATABASE_URI) and copied to every shard,
+so the policy queries keep joining them locally: each change queues the
+contact for every shard in contact_outbox, in the same transaction, and
+deliver_contacts() copies what is queued once it is committed. A shard
+that cannot be written keeps its queue until a later delivery (the next
+contact change, serve.py's repair thread or `jobs.py deliver-contacts`).
+
+db.session is scoped to the thread and to the shard it works on: inside
+using(shard) every query, Model.query included, goes to that shard's
+database through a session of its own. PolicyAccounting and the views
+route themselves; reports over the whole book run on every shard in
+parallel (gather, on a few threads per shard) and merge the results.
+Without SHARDS every scope is the main database and nothing here changes
+what runs.
+#######################################################
+"""
+
+# Bind names of the shards, in SHARDS order; empty when not sharded.
+names = []
+
+_placement = itertools.count()
+
+# Threads per shard running gather's work, per process.
+gather_threads = 4
+_workers = {}
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Registers the shards as Flask-SQLAlchemy binds.
+    :param config: Mapping with SHARDS, a list of database URIs, and
+                   SHARD_GATHER_THREADS.
+    """
+    global gather_threads
+    uris = config.get("SHARDS") or []
+    names[:] = ["shard%d" % index for index in range(len(uris))]
+    gather_threads = max(config.get("SHARD_GATHER_THREADS", 4), 1)
+    binds = dict(config.get("SQLALCHEMY_BINDS") or {})
+    binds.update(zip(names, uris))
+    config["SQLALCHEMY_BINDS"] = binds
+
+
+def current():
+    """
+    :return: Shard the thread works on, None for the main database.
+    """
+    return getattr(shard_scope, "shard", None)
+
+
+def shard_for(policy_id):
+    """
+    :return: Shard holding the policy, None when not sharded.
+    """
+    if not names:
+        return None
+    return names[policy_id % len(names)]
+
+
+def place():
+    """
+    :return: Shard the next new policy is created on.
+    """
+    return names[next(_placement) % len(names)] if names else None
+
+
+@contextmanager
+def using(shard):
+    """
+    Points db.session at a shard for the duration of the block.
+    :param shard: Shard name, None for the main database.
+    """
+    previous = current()
+    shard_scope.shard = shard
+    try:
+        yield
+    finally:
+        shard_scope.shard = previous
+
+
+def using_policy(policy_id):
+    return using(shard_for(policy_id))
+
+
+def route(policy_id):
+    """
+    Points the rest of the request at the policy's shard; see reset.
+    """
+    if names:
+        shard_scope.shard = shard_for(policy_id)
+
+
+def reset(exception=None):
+    """
+    Request teardown: back to the main database, dropping the sessions the
+    thread opened on the shards.
+    """
+    if names:
+        for shard in names:
+            with using(shard):
+                db.session.remove()
+        shard_scope.shard = None
+
+
+def routed(method):
+    """
+    Runs a PolicyAccounting method on the shard of its policy.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not names:
+            return method(self, *args, **kwargs)
+        with using(shard_for(self.policy_id)):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def engine(shard=None):
+    """
+    :param shard: Shard name, defaults to the one the thread works on.
+    :return: Engine of the shard, or of the main database.
+    """
+    return db.get_engine(db.get_app(), bind=shard or current())
+
+
+def engines():
+    """
+    :return: Engines of the main database and of every shard.
+    """
+    return [engine(shard) for shard in [None] + names]
+
+
+def each(function, *args):
+    """
+    Runs function on every shard in turn, or once when not sharded.
+    :return: List of (shard, result).
+    """
+    if not names:
+        return [(None, function(*args))]
+    results = []
+    for shard in names:
+        with using(shard):
+            results.append((shard, function(*args)))
+    return results
+
+
+def gather(function, *args):
+    """
+    Runs a read-only function on every shard in parallel, each on a thread
+    and session of the shard's pool, or once on the calling thread when not
+    sharded.
+    Inside replica.reading() the shards' replicas are read instead.
+    :return: List of results, in shard order.
+    """
+    if not names:
+        return [function(*args)]
+    replica = getattr(shard_scope, "replica", False)
+    # A profiled request's statements include the ones run on its behalf.
+    recorded = profiling.statements()
+    results = [Queue(1) for _ in names]
+    for shard, result in zip(names, results):
+        _worker(shard).put((function, args, replica, recorded, result))
+    outcomes = [result.get() for result in results]
+    for failed, outcome in outcomes:
+        if failed:
+            raise outcome[0], outcome[1], outcome[2]
+    return [outcome for _, outcome in outcomes]
+
+
+def merged(results):
+    """
+    :param results: Lists of rows from gather, each sorted (by policy id).
+    :return: One sorted list.
+    """
+    if len(results) == 1:
+        return results[0]
+    return list(heapq.merge(*[[tuple(row) for row in rows] for rows in results]))
+
+
+def _worker(shard):
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid != os.getpid():
+            # Threads do not survive fork; serve.py workers start their own.
+            _workers.clear()
+            _workers_pid = os.getpid()
+        if shard not in _workers:
+            tasks = _workers[shard] = Queue()
+            for _ in range(gather_threads):
+                thread = threading.Thread(target=_run, args=(shard, tasks))
+                thread.daemon = True
+                thread.start()
+        return _workers[shard]
+
+
+def _run(shard, tasks):
+    shard_scope.shard = shard
+    while True:
+        function, args, shard_scope.replica, recorded, result = tasks.get()
+        profiling.record_into(recorded)
+        try:
+            outcome = (False, function(*args))
+        except Exception:
+            outcome = (True, sys.exc_info())
+        finally:
+            db.session.remove()
+            shard_scope.replica = False
+            profiling.record_into(None)
+        result.put(outcome)
+
+
+def new_policy_ids(count, connection=None):
+    """
+    Ids for policies about to be inserted in bulk, above every id the
+    database has used; when sharded they are on the current shard and map
+    back to it.
+    :param count: Number of ids.
+    :param connection: Connection to read the database's ids with, defaults
+                       to db.session.
+    :return: List of ids.
+    """
+    shard = current()
+    if names and shard is None:
+        raise RuntimeError("Policies are created on a shard: use shards.place().")
+    connection = connection or db.session
+    top = max(
+        connection.execute(select([func.max(Policy.__table__.c.id)])).scalar() or 0,
+        connection.execute(select([func.max(policies_archive.c.id)])).scalar() or 0,
+    )
+    if not names:
+        return range(top + 1, top + 1 + count)
+    index, size = names.index(shard), len(names)
+    first = top + 1 + (index - top - 1) % size
+    return range(first, first + count * size, size)
+
+
+def _assign_policy_id(mapper, connection, target):
+    if names and target.id is None:
+        # Several policies may be flushed before any of them is inserted.
+        floor = connection.info.get("last_policy_id", 0)
+        policy_id = new_policy_ids(1, connection)[0]
+        while policy_id <= floor:
+            policy_id += len(names)
+        target.id = connection.info["last_policy_id"] = policy_id
+
+
+event.listen(Policy, "before_insert", _assign_policy_id)
+
+
+def create_all():
+    """
+    Creates the schema on the main database and on every shard.
+    """
+    for bind in engines():
+        db.metadata.create_all(bind=bind)
+
+
+def upgrade_all():
+    """
+    Brings the main database and every shard built by an earlier version
+    up to the current schema: the missing tables (and the change log, see
+    models) are created and the missing columns, all nullable, are added.
+    Run by create_app, so it must stay cheap on an up-to-date database.
+    :return: List of (shard, names of the tables created), None for the main
+             database.
+    """
+    created = []
+    for shard, bind in zip([None] + names, engines()):
+        existing_tables = set(bind.table_names())
+        db.metadata.create_all(bind=bind)
+        created.append(
+            (
+                shard,
+                [
+                    table.name
+                    for table in db.metadata.sorted_tables
+                    if table.name not in existing_tables
+                ],
+            )
+        )
+        for table in db.metadata.sorted_tables:
+            existing = set(
+                row[1] for row in bind.execute("PRAGMA table_info(%s)" % table.name)
+            )
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    raise RuntimeError(
+                        "%s.%s is missing and cannot be added to existing rows."
+                        % (table.name, column.name)
+                    )
+                bind.execute(
+                    "ALTER TABLE %s ADD COLUMN %s %s"
+                    % (table.name, column.name, column.type.compile(bind.dialect))
+                )
+    return created
+
+
+def drop_all():
+    for bind in engines():
+        db.metadata.drop_all(bind=bind)
+
+
+def queue_contacts(contact_ids, connection=None):
+    """
+    Queues contacts changed on the main database for every shard. Call it
+    in the transaction that changes them; contacts changed through the ORM
+    are queued, and delivered on commit, by themselves.
+    :param contact_ids: Ids of the contacts written or deleted.
+    :param connection: Connection of that transaction, defaults to db.session.
+    """
+    contact_ids = list(contact_ids)
+    if names and contact_ids:
+        (connection or db.session).execute(
+            contact_outbox.insert(),
+            [
+                {"shard": shard, "contact_id": contact_id}
+                for shard in names
+                for contact_id in contact_ids
+            ],
+        )
+
+
+def deliver_contacts(to=None, chunk_size=500):
+    """
+    Copies the queued contacts to their shards as they now are on the main
+    database (deleted ones are deleted) and clears what was delivered, so
+    it can run any number of times, from any process. A shard that fails
+    keeps its queue for the next delivery.
+    :param to: Shards to deliver to, defaults to all of them.
+    :return: Dict with the contacts delivered per shard and the shards that
+             failed.
+    """
+    delivered = {"contacts": {}, "failed": []}
+    for shard in names if to is None else to:
+        try:
+            delivered["contacts"][shard] = _deliver_contacts(shard, chunk_size)
+        except exc.DBAPIError as e:
+            sys.stderr.write("copying contacts to %s failed: %s\n" % (shard, e))
+            delivered["failed"].append(shard)
+    return delivered
+
+
+def _deliver_contacts(shard, chunk_size):
+    contacts = Contact.__table__
+    main = engine(None)
+    count = 0
+    while True:
+        queued = main.execute(
+            select([contact_outbox.c.id, contact_outbox.c.contact_id])
+            .where(contact_outbox.c.shard == shard)
+            .order_by(contact_outbox.c.id)
+            .limit(chunk_size)
+        ).fetchall()
+        if not queued:
+            return count
+        contact_ids = set(row[1] for row in queued)
+        rows = [
+            dict(row)
+            for row in main.execute(
+                contacts.select().where(contacts.c.id.in_(contact_ids))
+            )
+        ]
+        deleted = contact_ids - set(row["id"] for row in rows)
+        with engine(shard).begin() as connection:
+            if rows:
+                connection.execute(contacts.insert().prefix_with("OR REPLACE"), rows)
+            if deleted:
+                connection.execute(
+                    contacts.delete().where(contacts.c.id.in_(list(deleted)))
+                )
+        # Contacts queued again meanwhile have higher ids and stay queued.
+        main.execute(
+            contact_outbox.delete()
+            .where(contact_outbox.c.shard == shard)
+            .where(contact_outbox.c.id <= queued[-1][0])
+        )
+        count += len(contact_ids)
+
+
+def _queue_contact(mapper, connection, target):
+    if names:
+        queue_contacts([target.id], connection)
+        orm.object_session(target).contacts_queued = True
+
+
+def _deliver_queued_contacts(session):
+    if getattr(session, "contacts_queued", False):
+        session.contacts_queued = False
+        deliver_contacts()
+
+
+def _forget_contacts(session):
+    session.contacts_queued = False
+
+
+for operation in ("insert", "update", "delete"):
+    event.listen(Contact, "after_" + operation, _queue_contact)
+event.listen(AccountingSession, "after_commit", _deliver_queued_contacts)
+event.listen(AccountingSession, "after_rollback", _forget_contacts)
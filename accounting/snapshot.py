@@ -0,0 +1,485 @@
+#!/user/bin/env python2.7
+
+import ctypes
+import json
+import mmap
+import os
+import shutil
+import struct
+
+from sqlalchemy import select
+
+from accounting import db
+from models import Invoice, Payment, Policy, changes, install_change_log
+import changelog
+
+"""
+#######################################################
+Columnar analytics snapshots.
+
+export_snapshot writes policies, invoices and payments to a directory, one
+file per column, plus a manifest.json. Numeric columns are raw little-endian
+int64 arrays (numpy.memmap(path, dtype="<i8") reads them as is); string
+columns are a UTF-8 blob plus an int64 offsets file.
+
+Exports are incremental: the manifest remembers the last id of the
+changes log, and the next export writes a segment holding only the rows
+changed since then and the ids deleted since then. Snapshot memory-maps
+every segment and lets later segments shadow earlier ones. Once the deltas
+pile up (MAX_DELTAS, or more rows than DELTA_FOLD_RATIO of the base) the
+export folds them into a new full segment instead. Each export saves its
+position as a change log cursor and trims the log behind its readers.
+#######################################################
+"""
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+DELETED = "_deleted"
+INT64 = ctypes.c_int64.__ctype_le__
+WRITE_BATCH = 65536
+IN_LIST_SIZE = 500
+
+# Delta segments kept before the next export rewrites a full one.
+MAX_DELTAS = 8
+DELTA_FOLD_RATIO = 0.5
+
+# Column kinds: "int" is stored as is, "date" as its ordinal, "bool" as 0/1,
+# "enum" as 1 + its index in ENUMS and "str" as UTF-8. NULL is stored as 0
+# (as an empty string for "str").
+SNAPSHOT_TABLES = {
+    "policies": [
+        ("id", "int"),
+        ("policy_number", "str"),
+        ("effective_date", "date"),
+        ("status", "enum"),
+        ("status_change_description", "str"),
+        ("status_change_date", "date"),
+        ("billing_schedule", "enum"),
+        ("annual_premium", "int"),
+        ("named_insured", "int"),
+        ("agent", "int"),
+    ],
+    "invoices": [
+        ("id", "int"),
+        ("policy_id", "int"),
+        ("bill_date", "date"),
+        ("due_date", "date"),
+        ("cancel_date", "date"),
+        ("amount_due", "int"),
+        ("deleted", "bool"),
+    ],
+    "payments": [
+        ("id", "int"),
+        ("policy_id", "int"),
+        ("contact_id", "int"),
+        ("amount_paid", "int"),
+        ("transaction_date", "date"),
+    ],
+}
+
+TABLES = {
+    "policies": Policy.__table__,
+    "invoices": Invoice.__table__,
+    "payments": Payment.__table__,
+}
+
+ENUMS = {
+    "status": list(Policy.__table__.c.status.type.enums),
+    "billing_schedule": list(Policy.__table__.c.billing_schedule.type.enums),
+}
+
+# Aging buckets: (label, most days past due).
+AGING_BUCKETS = [
+    ("current", 0),
+    ("1-30", 30),
+    ("31-60", 60),
+    ("61-90", 90),
+    ("90+", None),
+]
+
+
+def read_manifest(directory):
+    """
+    :return: The snapshot's manifest, or None if there is no snapshot yet.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def export_snapshot(directory, full=False, max_deltas=MAX_DELTAS):
+    """
+    Exports the live tables to a columnar snapshot.
+    :param directory: Snapshot directory, created if missing.
+    :param full: Rewrite the snapshot from scratch instead of appending the
+                 changes since the last export.
+    :param max_deltas: Delta segments kept before they are folded.
+    :return: The manifest as written.
+    """
+    install_change_log(None, db.session.connection())
+    db.session.commit()
+
+    manifest = read_manifest(directory)
+    if manifest is not None and not full:
+        # Entries it has not exported were trimmed, or the deltas piled up.
+        full = changelog.behind(manifest["change_id"]) or _fold(
+            manifest, max_deltas
+        )
+    if manifest is None or full:
+        manifest = {
+            "version": FORMAT_VERSION,
+            "change_id": 0,
+            "enums": ENUMS,
+            "tables": SNAPSHOT_TABLES,
+            "segments": [],
+        }
+        full = True
+
+    # Read the mark before any row: whatever changes after it is exported
+    # again next time, which is harmless since later segments win.
+    change_id = changelog.last_id()
+    if not full and change_id == manifest["change_id"]:
+        return manifest
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = "%010d-%s" % (change_id, "full" if full else "delta")
+    working = os.path.join(directory, name + ".tmp")
+    if os.path.isdir(working):
+        shutil.rmtree(working)
+
+    segment = {"name": name, "change_id": change_id, "tables": {}}
+    for table_name, columns in SNAPSHOT_TABLES.items():
+        table_directory = os.path.join(working, table_name)
+        os.makedirs(table_directory)
+        if full:
+            rows = _all_rows(table_name, columns)
+            deleted = []
+        else:
+            rows, deleted = _changed_rows(table_name, columns, manifest["change_id"])
+        segment["tables"][table_name] = {
+            "rows": _write_table(table_directory, columns, rows),
+            "deleted": len(deleted),
+        }
+        _write_ints(os.path.join(table_directory, DELETED + ".i64"), deleted)
+
+    final = os.path.join(directory, name)
+    if os.path.isdir(final):
+        shutil.rmtree(final)
+    os.rename(working, final)
+
+    manifest["change_id"] = change_id
+    manifest["segments"] = [segment] if full else manifest["segments"] + [segment]
+    _write_manifest(directory, manifest)
+
+    if full:
+        for entry in os.listdir(directory):
+            stale = os.path.join(directory, entry)
+            if entry != name and os.path.isdir(stale):
+                shutil.rmtree(stale)
+
+    changelog.save_cursor("snapshot:" + os.path.abspath(directory), change_id)
+    changelog.trim()
+    db.session.commit()
+    return manifest
+
+
+def _fold(manifest, max_deltas):
+    """
+    :return: True if the delta segments should be folded into a new base.
+    """
+    segments = manifest["segments"]
+    if len(segments) - 1 >= max_deltas:
+        return True
+    rows = [
+        sum(table["rows"] for table in segment["tables"].values())
+        for segment in segments
+    ]
+    return sum(rows[1:]) > DELTA_FOLD_RATIO * max(rows[0], 1)
+
+
+def _all_rows(table_name, columns):
+    table = TABLES[table_name]
+    query = select([table.c[column] for column, _ in columns]).order_by(table.c.id)
+    return db.session.execute(query)
+
+
+def _changed_rows(table_name, columns, since):
+    """
+    :return: Rows changed after change id since, and ids deleted after it.
+    """
+    table = TABLES[table_name]
+    changed = [
+        row_id
+        for (row_id,) in db.session.execute(
+            select([changes.c.row_id])
+            .where(changes.c.table_name == table_name)
+            .where(changes.c.id > since)
+            .distinct()
+        )
+    ]
+    rows = []
+    for start in range(0, len(changed), IN_LIST_SIZE):
+        query = select([table.c[column] for column, _ in columns]).where(
+            table.c.id.in_(changed[start : start + IN_LIST_SIZE])
+        )
+        rows.extend(db.session.execute(query))
+    rows.sort(key=lambda row: row[0])
+    found = set(row[0] for row in rows)
+    deleted = sorted(row_id for row_id in changed if row_id not in found)
+    return rows, deleted
+
+
+def _write_table(table_directory, columns, rows):
+    writers = [
+        _StringWriter(table_directory, column)
+        if kind == "str"
+        else _IntWriter(os.path.join(table_directory, column + ".i64"))
+        for column, kind in columns
+    ]
+    encoders = [_encoder(column, kind) for column, kind in columns]
+    count = 0
+    for row in rows:
+        for writer, encode, value in zip(writers, encoders, row):
+            writer.append(encode(value))
+        count += 1
+    for writer in writers:
+        writer.close()
+    return count
+
+
+def _encoder(column, kind):
+    if kind == "date":
+        return lambda value: value.toordinal() if value else 0
+    if kind == "enum":
+        values = ENUMS[column]
+        return lambda value: values.index(value) + 1 if value else 0
+    if kind == "str":
+        return lambda value: (value or u"").encode("utf-8")
+    return lambda value: int(value or 0)
+
+
+def _write_ints(path, values):
+    writer = _IntWriter(path)
+    for value in values:
+        writer.append(value)
+    writer.close()
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+class _IntWriter(object):
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.pending = []
+
+    def append(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.file.write(struct.pack("<%dq" % len(self.pending), *self.pending))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class _StringWriter(object):
+    def __init__(self, table_directory, column):
+        self.blob = open(os.path.join(table_directory, column + ".utf8"), "wb")
+        self.offsets = _IntWriter(os.path.join(table_directory, column + ".i64"))
+        self.offsets.append(0)
+        self.size = 0
+
+    def append(self, value):
+        self.blob.write(value)
+        self.size += len(value)
+        self.offsets.append(self.size)
+
+    def close(self):
+        self.blob.close()
+        self.offsets.close()
+
+
+def _map(path, access=mmap.ACCESS_READ):
+    if not os.path.getsize(path):
+        return None
+    with open(path, "rb") as column_file:
+        return mmap.mmap(column_file.fileno(), 0, access=access)
+
+
+def _map_ints(path):
+    # ctypes needs a writable buffer; a copy-on-write mapping is never
+    # actually copied as long as nothing writes to it.
+    mapped = _map(path, access=mmap.ACCESS_COPY)
+    if mapped is None:
+        return ()
+    return (INT64 * (len(mapped) // 8)).from_buffer(mapped)
+
+
+class _StringColumn(object):
+    def __init__(self, table_directory, column):
+        self.blob = _map(os.path.join(table_directory, column + ".utf8"))
+        self.offsets = _map_ints(os.path.join(table_directory, column + ".i64"))
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if start == end:
+            return u""
+        return self.blob[start:end].decode("utf-8")
+
+
+class Snapshot(object):
+    """
+    Read-only view of a snapshot directory. Column files are memory-mapped,
+    so scans read straight from the page cache without loading the files.
+    """
+
+    def __init__(self, directory):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise ValueError("No snapshot in %s" % directory)
+        self.directory = directory
+        self.change_id = manifest["change_id"]
+        self.enums = manifest["enums"]
+        self.tables = dict(
+            (table_name, [column for column, _ in columns])
+            for table_name, columns in manifest["tables"].items()
+        )
+        self.kinds = dict(
+            (table_name, dict(columns))
+            for table_name, columns in manifest["tables"].items()
+        )
+        self.segments = manifest["segments"]
+        self._columns = {}
+        self._shadowed = dict(
+            (table_name, self._shadowed_ids(table_name)) for table_name in self.tables
+        )
+
+    def column(self, segment_index, table_name, column):
+        """
+        :return: Memory-mapped column of one segment, indexable and iterable.
+        """
+        key = (segment_index, table_name, column)
+        if key not in self._columns:
+            table_directory = os.path.join(
+                self.directory, self.segments[segment_index]["name"], table_name
+            )
+            if self.kinds[table_name].get(column) == "str":
+                self._columns[key] = _StringColumn(table_directory, column)
+            else:
+                path = os.path.join(table_directory, column + ".i64")
+                self._columns[key] = _map_ints(path)
+        return self._columns[key]
+
+    def scan(self, table_name, columns):
+        """
+        Yields a tuple of the requested columns for every live row, in the
+        stored encoding (dates as ordinals, enums as 1 + index in enums).
+        """
+        for segment_index, segment in enumerate(self.segments):
+            if not segment["tables"][table_name]["rows"]:
+                continue
+            shadowed = self._shadowed[table_name][segment_index]
+            ids = self.column(segment_index, table_name, "id")
+            values = [self.column(segment_index, table_name, c) for c in columns]
+            for index, row_id in enumerate(ids):
+                if shadowed and row_id in shadowed:
+                    continue
+                yield tuple(column[index] for column in values)
+
+    def enum_code(self, column, value):
+        """
+        :return: Stored code of an enum value, for filtering scans.
+        """
+        return self.enums[column].index(value) + 1
+
+    def _shadowed_ids(self, table_name):
+        """
+        :return: Per segment, the ids rewritten or deleted by later segments.
+        """
+        shadowed = [None] * len(self.segments)
+        later = set()
+        for segment_index in reversed(range(1, len(self.segments))):
+            later.update(self.column(segment_index, table_name, "id"))
+            later.update(self.column(segment_index, table_name, DELETED))
+            shadowed[segment_index - 1] = set(later) if later else None
+        return shadowed
+
+
+def balances(snapshot, date_cursor):
+    """
+    Same figures as PolicyAccounting.return_account_balance, for every
+    policy with invoices or payments in the snapshot.
+    :return: Dict of policy id to account balance at date_cursor.
+    """
+    day = date_cursor.toordinal()
+    result = {}
+    for policy_id, bill_date, amount_due, deleted in snapshot.scan(
+        "invoices", ["policy_id", "bill_date", "amount_due", "deleted"]
+    ):
+        if not deleted and bill_date <= day:
+            result[policy_id] = result.get(policy_id, 0) + amount_due
+    for policy_id, transaction_date, amount_paid in snapshot.scan(
+        "payments", ["policy_id", "transaction_date", "amount_paid"]
+    ):
+        if transaction_date <= day:
+            result[policy_id] = result.get(policy_id, 0) - amount_paid
+    return result
+
+
+def aging(snapshot, date_cursor):
+    """
+    Ages what is owed at date_cursor. Payments settle the earliest due
+    invoices first; what is left of each invoice goes to the bucket of its
+    days past due (see AGING_BUCKETS).
+    :return: Dict of policy id to {bucket label: amount}, for policies that
+             owe money.
+    """
+    day = date_cursor.toordinal()
+    invoices = {}
+    for policy_id, bill_date, due_date, amount_due, deleted in snapshot.scan(
+        "invoices", ["policy_id", "bill_date", "due_date", "amount_due", "deleted"]
+    ):
+        if not deleted and bill_date <= day:
+            invoices.setdefault(policy_id, []).append((due_date, amount_due))
+    paid = {}
+    for policy_id, transaction_date, amount_paid in snapshot.scan(
+        "payments", ["policy_id", "transaction_date", "amount_paid"]
+    ):
+        if transaction_date <= day:
+            paid[policy_id] = paid.get(policy_id, 0) + amount_paid
+
+    result = {}
+    for policy_id, policy_invoices in invoices.items():
+        credit = paid.get(policy_id, 0)
+        buckets = {}
+        for due_date, amount_due in sorted(policy_invoices):
+            settled = min(credit, amount_due)
+            credit -= settled
+            if amount_due > settled:
+                label = _aging_bucket(day - due_date)
+                buckets[label] = buckets.get(label, 0) + amount_due - settled
+        if buckets:
+            result[policy_id] = buckets
+    return result
+
+
+def _aging_bucket(days_past_due):
+    for label, most_days in AGING_BUCKETS:
+        if most_days is None or days_past_due <= most_days:
+            return label
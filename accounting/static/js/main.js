@@ -10,6 +10,8 @@ function Invoice(data) {
     this.dueDate = ko.observable(data.dueDate);
     this.cancelDate = ko.observable(data.cancelDate);
     this.amountDue = ko.observable(data.amountDue);
+    this.amountPaid = ko.observable(data.amountPaid);
+    this.status = ko.observable(data.status);
 }
 
 function Policy(data) {
@@ -26,6 +28,18 @@ function Policy(data) {
     this.accountBalance = ko.observable(data.accountBalance);
 }
 
+// Applies a "policy" change feed event to a Policy.
+Policy.prototype.update = function(data) {
+    if ('status' in data) {
+        this.status(data.status);
+        this.statusChange_date(data.statusChangeDate);
+        this.statusChangeDescription(data.statusChangeDescription);
+    }
+    if ('billingSchedule' in data) {
+        this.billingSchedule(data.billingSchedule);
+    }
+}
+
 function PolicyViewModel() {
     var self = this;
 
@@ -37,6 +51,40 @@ function PolicyViewModel() {
     self.dateCursor = ko.observable();
     self.errorMessage = ko.observable();
 
+    // Change feed of the policy shown, or of the whole book on the list.
+    self.events = null;
+
+    self.subscribe = function(url, handlers) {
+        if (self.events) {
+            self.events.close();
+            self.events = null;
+        }
+        if (!window.EventSource) {
+            return;
+        }
+        var events = new EventSource(url);
+        self.events = events;
+        $.each(handlers, function(kind, handler) {
+            events.addEventListener(kind, function(event) {
+                handler(JSON.parse(event.data));
+            });
+        });
+        // A full server answers 503, which EventSource does not retry on its
+        // own: try again later, unless another feed was followed meanwhile.
+        events.onerror = function() {
+            if (events.readyState !== EventSource.CLOSED) {
+                return;
+            }
+            setTimeout(function() {
+                if (self.events === events) {
+                    var policyId = events.policyId;
+                    self.subscribe(url, handlers);
+                    self.events.policyId = policyId;
+                }
+            }, 30000);
+        };
+    }
+
     self.showPolicyDetail = function(){
         self.errorMessage('')
         var data = {
@@ -51,6 +99,7 @@ function PolicyViewModel() {
                     self.invoices(mappedInvoices);
                     var mappedPayments = $.map(allData['payments'], function(item) { return new Payment(item) });
                     self.payments(mappedPayments);
+                    self.followPolicy(allData['policy']['id']);
                 })
             .fail(
                 function(err) {
@@ -58,6 +107,27 @@ function PolicyViewModel() {
                 });
     }
 
+    // Pushed changes replace re-clicking the policy. The balance shown is
+    // at the chosen date, so payments and invoices reload the detail once.
+    self.followPolicy = function(policyId) {
+        if (self.events && self.events.policyId === policyId) {
+            return;
+        }
+        self.subscribe("/policies/" + policyId + "/events", {
+            'policy': function(data) {
+                if (self.policy()) {
+                    self.policy().update(data);
+                }
+            },
+            'payment': self.showPolicyDetail,
+            'invoices': self.showPolicyDetail,
+            'resync': self.showPolicyDetail
+        });
+        if (self.events) {
+            self.events.policyId = policyId;
+        }
+    }
+
     self.showPolicyList = function() {
         self.policyId('')
         self.errorMessage('')
@@ -68,6 +138,20 @@ function PolicyViewModel() {
             self.policy(false)
             var mappedPolicies = $.map(allData['policies'], function(item) { return new Policy(item) });
             self.policyList(mappedPolicies);
+            self.followBook();
+        });
+    }
+
+    self.followBook = function() {
+        self.subscribe("/events", {
+            'policy': function(data) {
+                $.each(self.policyList(), function(i, policy) {
+                    if (policy.id() === data.policyId) {
+                        policy.update(data);
+                    }
+                });
+            },
+            'resync': self.showPolicyList
         });
     }
 
@@ -77,7 +161,7 @@ function PolicyViewModel() {
     }
 
     self.showPolicyList();
-    
+
 }
 
 ko.applyBindings(new PolicyViewModel())
\ No newline at end of file
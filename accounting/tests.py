@@ -1,12 +1,51 @@
 #!/user/bin/env python2.7
 
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine, event, select
 
 from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from accounting import create_app
+from allocations import rebuild_allocations
+from archive import archive
+from cache import LRUCache
+from delinquency import pending_cancellation, rebuild_delinquency_index
+from horizon import extend_invoices
+from ledger import Ledger
+from models import (
+    Contact,
+    Invoice,
+    Payment,
+    Policy,
+    change_cursors,
+    changes,
+    install_change_log,
+    invoice_allocations,
+    invoices_archive,
+    payments_archive,
+    policies_archive,
+)
+from quotes import quote, quote_policies
+from renewals import renew_policies
+from snapshot import Snapshot, aging, balances, export_snapshot
+from serializers import DateFormatter, invoice_serializer, policy_serializer
+from utils import PolicyAccounting, bill_policies, insert_data, plan_invoices
+import billing
+import cache
+import changelog
+import events
+import profiling
+import queries
+import replica
+import shards
 
 """
 #######################################################
@@ -14,6 +53,8 @@ Test Suite for Accounting
 #######################################################
 """
 
+app = create_app()
+
 
 class TestBillingSchedules(unittest.TestCase):
     @classmethod
@@ -455,3 +496,2009 @@ class TestChangePolicyStatus(unittest.TestCase):
             self.assertNotEqual(self.policy.status_change_date, None)
         else:
             self.assertEquals(self.policy.status_change_date, date)
+
+
+class TestReadPath(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy("Test Policy", date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = "Quarterly"
+        db.session.add(cls.policy)
+        db.session.commit()
+
+        cls.pa = PolicyAccounting(cls.policy.id)
+        cls.payment = cls.pa.make_payment(
+            contact_id=cls.policy.named_insured,
+            date_cursor=date(2015, 2, 1),
+            amount=300,
+        )
+        cls.pa.change_billing_schedule("Monthly")
+
+    @classmethod
+    def tearDownClass(cls):
+        for invoice in cls.policy.invoices:
+            db.session.delete(invoice)
+        db.session.delete(cls.payment)
+        db.session.delete(cls.policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def test_balance_matches_policy_accounting(self):
+        invoice_rows = queries.invoice_rows(self.policy.id)
+        payment_rows = queries.payment_rows(self.policy.id)
+        for date_cursor in [
+            date(2015, 1, 1),
+            date(2015, 2, 1),
+            date(2015, 6, 15),
+            date(2016, 1, 1),
+        ]:
+            self.assertEquals(
+                queries.account_balance(invoice_rows, payment_rows, date_cursor),
+                self.pa.return_account_balance(date_cursor),
+            )
+
+    def test_invoice_rows_include_deleted(self):
+        rows = queries.invoice_rows(self.policy.id)
+        self.assertEquals(len(rows), 16)
+        self.assertEquals(len([row for row in rows if row[5]]), 4)
+
+    def test_policy_serializer(self):
+        data = policy_serializer(
+            queries.policy_row(self.policy.id), DateFormatter(), 100
+        )
+        self.assertEquals(data["name"], "Test Policy")
+        self.assertEquals(data["effectiveDate"], "01/01/2015")
+        self.assertEquals(data["statusChangeDate"], "None")
+        self.assertEquals(data["namedInsured"], "Test Insured")
+        self.assertEquals(data["agent"], "Test Agent")
+        self.assertEquals(data["accountBalance"], 100)
+
+    def test_policy_row_missing(self):
+        self.assertEquals(queries.policy_row(-1), None)
+
+    def test_invoice_serializer_shares_formatted_dates(self):
+        format_date = DateFormatter()
+        first, second = [
+            invoice_serializer(row, format_date)
+            for row in queries.invoice_rows(self.policy.id)[:2]
+        ]
+        self.assertEquals(first["billDate"], "01/01/2015")
+        self.assertTrue(first["billDate"] is second["billDate"])
+
+
+class TestLedger(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+
+        self.pa = PolicyAccounting(self.policy.id)
+        self.payments = []
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.delete(self.policy)
+        db.session.commit()
+
+    def test_load_skips_deleted_invoices(self):
+        self.pa.change_billing_schedule("Monthly")
+        ledger = self.pa.ledger()
+        self.assertEquals(len(ledger.bill_dates), 12)
+        self.assertEquals(ledger.balance(date(2016, 1, 1)), 1200)
+
+    def test_balance_on_dates(self):
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=200)
+        )
+        ledger = self.pa.ledger()
+        self.assertEquals(ledger.balance(date(2014, 12, 31)), 0)
+        self.assertEquals(ledger.balance(date(2015, 1, 1)), 300)
+        self.assertEquals(ledger.balance(date(2015, 1, 15)), 100)
+        self.assertEquals(ledger.balance(date(2015, 4, 1)), 400)
+
+    def test_cancellation_pending_window(self):
+        ledger = self.pa.ledger()
+        # The first invoice is due 2/1 and cancels 2/15.
+        self.assertFalse(ledger.is_cancellation_pending(date(2015, 2, 1)))
+        self.assertTrue(ledger.is_cancellation_pending(date(2015, 2, 2)))
+        self.assertTrue(ledger.is_cancellation_pending(date(2015, 2, 14)))
+        self.assertFalse(ledger.is_cancellation_pending(date(2015, 2, 15)))
+        self.assertTrue(
+            self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 2))
+        )
+
+    def test_cancellation_not_pending_when_paid(self):
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 1, 1), amount=300)
+        )
+        self.assertFalse(
+            self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 2))
+        )
+
+    def test_should_cancel(self):
+        ledger = self.pa.ledger()
+        self.assertFalse(ledger.should_cancel(date(2015, 2, 14)))
+        self.assertTrue(ledger.should_cancel(date(2015, 2, 15)))
+
+    def test_load_many(self):
+        ledgers = Ledger.load_many([self.policy.id, -1])
+        self.assertEquals(list(ledgers), [self.policy.id])
+        self.assertEquals(ledgers[self.policy.id].balance(date(2016, 1, 1)), 1200)
+        self.assertEquals(Ledger.load(-1).balance(), 0)
+
+    def test_from_tuples(self):
+        ledger = Ledger(
+            None,
+            invoices=[(date(2015, 2, 1), date(2015, 3, 1), date(2015, 3, 15), 50)],
+            payments=[(date(2015, 2, 10), 20)],
+        )
+        self.assertEquals(ledger.balance(date(2015, 2, 1)), 50)
+        self.assertEquals(ledger.balance(date(2015, 2, 10)), 30)
+
+
+class TestRenewPolicies(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Renewal Policy", date(2013, 3, 1), 1200)
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+        PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        for policy in Policy.query.filter_by(policy_number="Test Renewal Policy"):
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.commit()
+
+    def _terms(self):
+        return (
+            Policy.query.filter_by(policy_number="Test Renewal Policy")
+            .order_by(Policy.effective_date)
+            .all()
+        )
+
+    def test_dry_run_writes_nothing(self):
+        result = renew_policies(date(2014, 3, 1), date(2014, 3, 1), dry_run=True)
+        self.assertEquals(result, {"policies": 1, "invoices": 4, "dry_run": True})
+        self.assertEquals(len(self._terms()), 1)
+        self.assertEquals(self.policy.status, "Active")
+
+    def test_renewal_creates_term_and_expires_old_one(self):
+        result = renew_policies(
+            date(2014, 2, 1), date(2014, 3, 31), date_cursor=date(2014, 2, 15)
+        )
+        self.assertEquals(result, {"policies": 1, "invoices": 4, "dry_run": False})
+        old_term, new_term = self._terms()
+        self.assertEquals(old_term.status, "Expired")
+        self.assertEquals(old_term.status_change_date, date(2014, 2, 15))
+        self.assertEquals(new_term.status, "Active")
+        self.assertEquals(new_term.effective_date, date(2014, 3, 1))
+        self.assertEquals(new_term.billing_schedule, "Quarterly")
+        self.assertEquals(new_term.named_insured, self.test_insured.id)
+        self.assertEquals(
+            sorted(invoice.bill_date for invoice in new_term.invoices),
+            [date(2014, 3, 1), date(2014, 6, 1), date(2014, 9, 1), date(2014, 12, 1)],
+        )
+
+    def test_renewal_is_not_repeated(self):
+        renew_policies(date(2014, 3, 1), date(2014, 3, 1), chunk_size=1)
+        result = renew_policies(date(2014, 3, 1), date(2014, 3, 1), chunk_size=1)
+        self.assertEquals(result["policies"], 0)
+        self.assertEquals(len(self._terms()), 2)
+
+    def test_policies_outside_window_are_skipped(self):
+        result = renew_policies(date(2014, 3, 2), date(2014, 4, 1))
+        self.assertEquals(result["policies"], 0)
+
+    def test_same_number_and_date_renew_separately(self):
+        twin = Policy("Test Renewal Policy", date(2013, 3, 1), 1200)
+        twin.named_insured = self.test_insured.id
+        twin.agent = self.test_agent.id
+        twin.billing_schedule = "Monthly"
+        db.session.add(twin)
+        db.session.commit()
+        PolicyAccounting(twin.id)
+
+        renew_policies(date(2014, 3, 1), date(2014, 3, 1))
+        renewed = [term for term in self._terms() if term.status == "Active"]
+        self.assertEquals(
+            sorted(
+                (term.billing_schedule, len(term.invoices)) for term in renewed
+            ),
+            [("Monthly", 12), ("Quarterly", 4)],
+        )
+
+    def test_leap_day_terms_renew_once(self):
+        self.policy.effective_date = date(2016, 2, 29)
+        db.session.commit()
+        february = renew_policies(date(2017, 2, 1), date(2017, 2, 28), dry_run=True)
+        march = renew_policies(date(2017, 3, 1), date(2017, 3, 31), dry_run=True)
+        self.assertEquals(february["policies"], 1)
+        self.assertEquals(march["policies"], 0)
+
+        renew_policies(date(2017, 2, 1), date(2017, 2, 28))
+        self.assertEquals(self._terms()[-1].effective_date, date(2017, 2, 28))
+
+    def test_renewals_are_not_renewed_in_the_same_run(self):
+        result = renew_policies(date(2014, 3, 1), date(2015, 3, 1))
+        self.assertEquals(result["policies"], 1)
+        self.assertEquals(len(self._terms()), 2)
+
+
+class TestArchive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        db.create_all()
+        self.policies = []
+        for policy_number in ["Test Closed Policy", "Test Open Policy"]:
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            policy.billing_schedule = "Quarterly"
+            db.session.add(policy)
+            db.session.commit()
+            pa = PolicyAccounting(policy.id)
+            pa.make_payment(date_cursor=date(2015, 1, 1), amount=300)
+            self.policies.append(policy)
+        self.closed_id, self.open_id = [policy.id for policy in self.policies]
+
+        PolicyAccounting(self.closed_id).change_policy_status(
+            date(2015, 3, 1), "Canceled"
+        )
+        PolicyAccounting(self.open_id).change_billing_schedule("Monthly")
+
+        # Newer rows, so that the test rows are below the high-water marks.
+        self.newer = Policy("Test Newer Policy", date(2015, 1, 1), 100)
+        self.newer.named_insured = self.test_insured.id
+        self.newer.agent = self.test_agent.id
+        db.session.add(self.newer)
+        db.session.commit()
+        PolicyAccounting(self.newer.id).make_payment(amount=100)
+
+    def tearDown(self):
+        policy_ids = self.closed_id, self.open_id, self.newer.id
+        for table in [
+            Invoice.__table__,
+            Payment.__table__,
+            invoices_archive,
+            payments_archive,
+            invoice_allocations,
+        ]:
+            condition = table.c.policy_id.in_(policy_ids)
+            db.session.execute(table.delete().where(condition))
+        for table in [Policy.__table__, policies_archive]:
+            db.session.execute(table.delete().where(table.c.id.in_(policy_ids)))
+        db.session.commit()
+
+    def test_dry_run_moves_nothing(self):
+        moved = archive(date(2015, 6, 1), dry_run=True)
+        self.assertEquals(moved["policies"], 1)
+        self.assertEquals(moved["payments"], 1)
+        self.assertEquals(moved["invoices"], 8)
+        self.assertEquals(len(queries.invoice_rows(self.closed_id)), 4)
+        self.assertEquals(len(queries.invoice_rows(self.open_id)), 16)
+
+    def test_archive_moves_rows(self):
+        moved = archive(date(2015, 6, 1), chunk_size=3)
+        self.assertEquals(
+            moved, {"policies": 1, "payments": 1, "invoices": 8, "dry_run": False}
+        )
+        self.assertEquals(queries.policy_row(self.closed_id), None)
+        self.assertEquals(queries.invoice_rows(self.closed_id), [])
+        self.assertEquals(queries.payment_rows(self.closed_id), [])
+        self.assertEquals(len(queries.invoice_rows(self.open_id)), 12)
+        pa = PolicyAccounting(self.open_id)
+        self.assertEquals(pa.return_account_balance(date(2016, 1, 1)), 900)
+
+    def test_history_unions_archive(self):
+        allocated = select([invoice_allocations.c.id]).where(
+            invoice_allocations.c.policy_id == self.closed_id
+        )
+        allocations = db.session.execute(allocated).fetchall()
+        self.assertTrue(allocations)
+        archive(date(2015, 6, 1))
+        # Moving rows to the archive keeps their allocations.
+        self.assertEquals(db.session.execute(allocated).fetchall(), allocations)
+        row = queries.policy_row(self.closed_id, history=True)
+        self.assertEquals(row[3], "Canceled")
+        self.assertEquals(len(queries.invoice_rows(self.closed_id, history=True)), 4)
+        self.assertEquals(len(queries.payment_rows(self.closed_id, history=True)), 1)
+        self.assertEquals(len(queries.invoice_rows(self.open_id, history=True)), 16)
+        ids = [row[0] for row in queries.policy_rows(history=True)]
+        self.assertTrue(self.closed_id in ids)
+        self.assertFalse(self.closed_id in [row[0] for row in queries.policy_rows()])
+
+    def test_recently_closed_policies_stay(self):
+        moved = archive(date(2015, 3, 1))
+        self.assertEquals(moved["policies"], 0)
+        self.assertEquals(moved["invoices"], 4)
+
+
+class TestSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.policy = Policy("Test Snapshot Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+        self.payments = [
+            self.pa.make_payment(date_cursor=date(2015, 1, 1), amount=200)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.execute(
+            change_cursors.delete().where(change_cursors.c.name.like("snapshot:%"))
+        )
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.delete(self.policy)
+        db.session.commit()
+
+    def test_full_export_matches_database(self):
+        export_snapshot(self.directory)
+        snapshot = Snapshot(self.directory)
+        for date_cursor in [date(2015, 1, 1), date(2015, 5, 1), date(2016, 1, 1)]:
+            self.assertEquals(
+                balances(snapshot, date_cursor)[self.policy.id],
+                self.pa.return_account_balance(date_cursor),
+            )
+        policies = dict(
+            (row[0], row[1:])
+            for row in snapshot.scan("policies", ["id", "policy_number", "status"])
+        )
+        self.assertEquals(
+            policies[self.policy.id],
+            ("Test Snapshot Policy", snapshot.enum_code("status", "Active")),
+        )
+
+    def test_incremental_export(self):
+        first = export_snapshot(self.directory)
+        unchanged = export_snapshot(self.directory)
+        self.assertEquals(unchanged["segments"], first["segments"])
+
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=100)
+        )
+        self.pa.change_billing_schedule("Monthly")
+        manifest = export_snapshot(self.directory)
+        self.assertEquals(len(manifest["segments"]), 2)
+        self.assertTrue(manifest["change_id"] > first["change_id"])
+
+        snapshot = Snapshot(self.directory)
+        self.assertEquals(
+            balances(snapshot, date(2015, 6, 1))[self.policy.id],
+            self.pa.return_account_balance(date(2015, 6, 1)),
+        )
+        invoice_ids = [
+            invoice_id
+            for invoice_id, policy_id in snapshot.scan("invoices", ["id", "policy_id"])
+            if policy_id == self.policy.id
+        ]
+        self.assertEquals(len(invoice_ids), 16)
+        self.assertEquals(len(set(invoice_ids)), 16)
+
+        manifest = export_snapshot(self.directory, full=True)
+        self.assertEquals(len(manifest["segments"]), 1)
+        self.assertEquals(
+            balances(Snapshot(self.directory), date(2015, 6, 1))[self.policy.id],
+            self.pa.return_account_balance(date(2015, 6, 1)),
+        )
+
+    def test_deleted_rows_are_shadowed(self):
+        export_snapshot(self.directory)
+        payment = self.payments.pop()
+        db.session.delete(payment)
+        db.session.commit()
+        export_snapshot(self.directory)
+        snapshot = Snapshot(self.directory)
+        self.assertEquals(balances(snapshot, date(2015, 1, 1))[self.policy.id], 300)
+
+    def test_export_after_trim_is_full(self):
+        export_snapshot(self.directory)
+        for month in [2, 3]:
+            self.payments.append(
+                self.pa.make_payment(date_cursor=date(2015, month, 1), amount=50)
+            )
+        # As if the exporter's cursor had been lost and the log trimmed.
+        db.session.execute(change_cursors.delete())
+        changelog.trim()
+        db.session.commit()
+        manifest = export_snapshot(self.directory)
+        self.assertEquals(len(manifest["segments"]), 1)
+        self.assertTrue(manifest["segments"][0]["name"].endswith("-full"))
+        self.assertEquals(
+            balances(Snapshot(self.directory), date(2015, 3, 1))[self.policy.id],
+            self.pa.return_account_balance(date(2015, 3, 1)),
+        )
+
+    def test_deltas_are_folded(self):
+        export_snapshot(self.directory)
+        for month in [2, 3]:
+            self.payments.append(
+                self.pa.make_payment(date_cursor=date(2015, month, 1), amount=10)
+            )
+            manifest = export_snapshot(self.directory, max_deltas=1)
+        self.assertEquals(len(manifest["segments"]), 1)
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+        self.assertEquals(
+            balances(Snapshot(self.directory), date(2015, 3, 1))[self.policy.id],
+            self.pa.return_account_balance(date(2015, 3, 1)),
+        )
+
+    def test_export_saves_its_cursor(self):
+        manifest = export_snapshot(self.directory)
+        cursor = db.session.execute(
+            select([change_cursors.c.change_id]).where(
+                change_cursors.c.name == "snapshot:" + self.directory
+            )
+        ).scalar()
+        self.assertEquals(cursor, manifest["change_id"])
+
+    def test_aging(self):
+        export_snapshot(self.directory)
+        buckets = aging(Snapshot(self.directory), date(2015, 5, 15))[self.policy.id]
+        # 300 billed 1/1 (due 2/1) less the 200 payment, 300 billed 4/1 (due 5/1).
+        self.assertEquals(buckets, {"90+": 100, "1-30": 300})
+
+
+class TestDelinquencyWindows(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Delinquent Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+        self.payments = []
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.delete(self.policy)
+        db.session.commit()
+        rebuild_delinquency_index()
+
+    def _pending_ids(self, date_cursor):
+        return [row[0] for row in pending_cancellation(date_cursor)]
+
+    def test_index_matches_policy_accounting(self):
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 2, 5), amount=200)
+        )
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 5, 10), amount=400)
+        )
+        day = date(2015, 1, 1)
+        while day < date(2016, 3, 1):
+            self.assertEquals(
+                self.policy.id in self._pending_ids(day),
+                self.pa.evaluate_cancellation_pending_due_to_non_pay(day),
+                day,
+            )
+            day += relativedelta(days=1)
+
+    def test_payment_closes_window(self):
+        self.assertTrue(self.policy.id in self._pending_ids(date(2015, 2, 10)))
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 2, 5), amount=300)
+        )
+        self.assertTrue(self.policy.id in self._pending_ids(date(2015, 2, 3)))
+        self.assertFalse(self.policy.id in self._pending_ids(date(2015, 2, 10)))
+
+    def test_billing_schedule_change_refreshes_windows(self):
+        self.pa.change_billing_schedule("Monthly")
+        # The first monthly invoice is due 2/1, the second 3/1.
+        self.assertTrue(self.policy.id in self._pending_ids(date(2015, 3, 5)))
+
+    def test_report_endpoint(self):
+        policy_id = self.policy.id
+        client = app.test_client()
+        response = client.get("/reports/pending-cancellation?date=2015-02-10")
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('"pendingSince": "02/02/2015"' in response.data)
+        response = client.get("/reports/pending-cancellation?date=bad")
+        self.assertEquals(response.status_code, 400)
+        # The request teardown removed the session.
+        self.policy = Policy.query.get(policy_id)
+
+
+class TestPostPayment(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy("Test Policy", date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+        PolicyAccounting(cls.policy.id)
+        cls.policy_id = cls.policy.id
+        cls.insured_id = cls.test_insured.id
+        cls.agent_id = cls.test_agent.id
+
+    @classmethod
+    def tearDownClass(cls):
+        for table in [Invoice.__table__, Payment.__table__]:
+            condition = table.c.policy_id == cls.policy_id
+            db.session.execute(table.delete().where(condition))
+        db.session.execute(
+            Policy.__table__.delete().where(Policy.__table__.c.id == cls.policy_id)
+        )
+        db.session.execute(
+            Contact.__table__.delete().where(
+                Contact.__table__.c.id.in_([cls.insured_id, cls.agent_id])
+            )
+        )
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.url = "/policies/%s/payments" % self.policy_id
+
+    def test_payment_is_posted(self):
+        response = self.client.post(
+            self.url, data={"amount": "200", "transactionDate": "2015-01-15"}
+        )
+        self.assertEquals(response.status_code, 201)
+        self.assertTrue('"transactionDate": "15/01/2015"' in response.data)
+        pa = PolicyAccounting(self.policy_id)
+        self.assertEquals(pa.return_account_balance(date(2015, 1, 15)), 1000)
+        payment = Payment.query.filter_by(policy_id=self.policy_id).one()
+        self.assertEquals(payment.contact_id, self.insured_id)
+
+    def test_invalid_amount(self):
+        for amount in ["", "abc", "0", "-5"]:
+            response = self.client.post(self.url, data={"amount": amount})
+            self.assertEquals(response.status_code, 400)
+
+    def test_unknown_policy(self):
+        response = self.client.post("/policies/0/payments", data={"amount": "10"})
+        self.assertEquals(response.status_code, 404)
+
+
+class TestCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.execute(
+            Contact.__table__.delete().where(
+                Contact.__table__.c.id.in_(cls.contact_ids)
+            )
+        )
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured = self.contact_ids[1]
+        self.policy.agent = self.contact_ids[0]
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+
+    def tearDown(self):
+        for invoice in Invoice.query.filter_by(policy_id=self.policy_id).all():
+            db.session.delete(invoice)
+        db.session.delete(Policy.query.get(self.policy_id))
+        db.session.commit()
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        lru.get("a")
+        lru.put("c", 3)
+        self.assertEquals(lru.get("b"), None)
+        self.assertEquals(lru.get("a"), 1)
+        self.assertEquals(len(lru), 2)
+
+        disabled = LRUCache(0)
+        self.assertEquals(disabled.put("a", 1), 1)
+        self.assertEquals(disabled.get("a"), None)
+
+    def test_policy_row_invalidated_through_change_log(self):
+        cache.sync()
+        self.assertEquals(cache.policy_row(self.policy_id)[3], "Active")
+        self.assertTrue(cache.policy_rows.get(self.policy_id) is not None)
+
+        # Written with Core, as another worker process would.
+        policies = Policy.__table__
+        db.session.execute(
+            policies.update()
+            .where(policies.c.id == self.policy_id)
+            .values(status="Canceled")
+        )
+        db.session.commit()
+        self.assertEquals(cache.policy_row(self.policy_id)[3], "Active")
+
+        cache.sync()
+        self.assertEquals(cache.policy_rows.get(self.policy_id), None)
+        self.assertEquals(cache.policy_row(self.policy_id)[3], "Canceled")
+
+    def test_detail_endpoint_sees_changes(self):
+        client = app.test_client()
+        url = "/policies/%s" % self.policy_id
+        data = {"dateCursor": "2015-02-01"}
+        self.assertTrue('"status": "Active"' in client.post(url, data=data).data)
+
+        policies = Policy.__table__
+        db.session.execute(
+            policies.update()
+            .where(policies.c.id == self.policy_id)
+            .values(status="Expired")
+        )
+        db.session.commit()
+        self.assertTrue('"status": "Expired"' in client.post(url, data=data).data)
+
+    def test_renamed_contacts_are_not_served_stale(self):
+        client = app.test_client()
+        url = "/policies/%s" % self.policy_id
+        data = {"dateCursor": "2015-02-01"}
+        self.assertTrue('"Test Insured"' in client.post(url, data=data).data)
+
+        contacts = Contact.__table__
+        try:
+            db.session.execute(
+                contacts.update()
+                .where(contacts.c.id == self.contact_ids[1])
+                .values(name="Renamed Insured")
+            )
+            db.session.commit()
+            self.assertTrue('"Renamed Insured"' in client.post(url, data=data).data)
+        finally:
+            db.session.execute(
+                contacts.update()
+                .where(contacts.c.id == self.contact_ids[1])
+                .values(name="Test Insured")
+            )
+            db.session.commit()
+
+    def test_trimmed_entries_empty_the_cache(self):
+        cache.sync()
+        cache.policy_row(self.policy_id)
+        for status in ["Canceled", "Active"]:
+            db.session.execute(
+                Policy.__table__.update()
+                .where(Policy.__table__.c.id == 1)
+                .values(status=status)
+            )
+            db.session.commit()
+        # Every cursor expired: the log is trimmed past what the cache read.
+        db.session.execute(change_cursors.delete())
+        changelog.trim()
+        db.session.commit()
+        cache.sync()
+        self.assertEquals(cache.policy_rows.get(self.policy_id), None)
+
+    def test_invoice_plans_are_copies(self):
+        plan = plan_invoices(date(2015, 1, 1), "Quarterly", 1200)
+        plan.pop()
+        self.assertEquals(len(plan_invoices(date(2015, 1, 1), "Quarterly", 1200)), 4)
+
+    def test_invoice_plans_shift_onto_the_effective_date(self):
+        cache.invoice_plans.clear()
+        for effective_date in [date(2015, 1, 31), date(2015, 8, 31), date(2016, 2, 29)]:
+            expected = []
+            for i in range(12):
+                bill_date = effective_date + relativedelta(months=i)
+                expected.append(
+                    (
+                        bill_date,
+                        bill_date + relativedelta(months=1),
+                        bill_date + relativedelta(months=1, days=14),
+                        100,
+                    )
+                )
+            self.assertEquals(plan_invoices(effective_date, "Monthly", 1200), expected)
+        # One plan, whatever the effective date.
+        self.assertEquals(len(cache.invoice_plans), 1)
+
+    def test_warm_loads_plans_and_contacts(self):
+        cache.configure(app.config)
+        warmed = cache.warm(10)
+        self.assertTrue(cache.policy_rows.get(self.policy_id))
+        self.assertTrue(warmed["contacts"] >= 2)
+        self.assertEquals(warmed["plans"], len(cache.invoice_plans))
+        self.assertTrue(
+            cache.invoice_plans.get((self.policy.billing_schedule, 1200)) is not None
+        )
+
+
+class TestInvoiceHorizon(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.execute(
+            Contact.__table__.delete().where(
+                Contact.__table__.c.id.in_(cls.contact_ids)
+            )
+        )
+        db.session.commit()
+
+    def setUp(self):
+        # Effective in the future so that the horizon, counted from today,
+        # leaves most of the term unwritten.
+        self.today = datetime.now().date()
+        self.effective_date = self.today + relativedelta(days=10)
+        self.policy_ids = []
+        billing.horizon_days = None
+        self.full_id = self._add_policy("Test Full Policy")
+        billing.horizon_days = 45
+        self.lazy_id = self._add_policy("Test Lazy Policy")
+
+    def tearDown(self):
+        billing.horizon_days = None
+        for table in [Invoice.__table__, Payment.__table__]:
+            db.session.execute(
+                table.delete().where(table.c.policy_id.in_(self.policy_ids))
+            )
+        db.session.execute(
+            Policy.__table__.delete().where(Policy.__table__.c.id.in_(self.policy_ids))
+        )
+        db.session.commit()
+        rebuild_delinquency_index()
+
+    def _add_policy(self, policy_number):
+        policy = Policy(policy_number, self.effective_date, 1200)
+        policy.named_insured = self.contact_ids[1]
+        policy.agent = self.contact_ids[0]
+        policy.billing_schedule = "Monthly"
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_ids.append(policy.id)
+        PolicyAccounting(policy.id)
+        return policy.id
+
+    def _live_invoices(self, policy_id):
+        return Invoice.query.filter_by(policy_id=policy_id, deleted=False).count()
+
+    def _pay(self, days, amount):
+        for policy_id in self.policy_ids:
+            PolicyAccounting(policy_id).make_payment(
+                date_cursor=self.effective_date + relativedelta(days=days),
+                amount=amount,
+            )
+
+    def _assert_same_answers(self):
+        full, lazy = Ledger.load(self.full_id), Ledger.load(self.lazy_id)
+        self.assertEquals(lazy.delinquency_windows(), full.delinquency_windows())
+        day = self.effective_date
+        while day < self.effective_date + relativedelta(months=14):
+            self.assertEquals(lazy.balance(day), full.balance(day), day)
+            self.assertEquals(
+                lazy.is_cancellation_pending(day), full.is_cancellation_pending(day)
+            )
+            self.assertEquals(lazy.should_cancel(day), full.should_cancel(day))
+            day += relativedelta(days=3)
+
+    def test_only_invoices_within_horizon_are_written(self):
+        self.assertEquals(self._live_invoices(self.full_id), 12)
+        # Billed on the effective date and a month later.
+        self.assertEquals(self._live_invoices(self.lazy_id), 2)
+        policy = Policy.query.get(self.lazy_id)
+        self.assertEquals(policy.invoiced_through, self.today + relativedelta(days=45))
+        self.assertEquals(Policy.query.get(self.full_id).invoiced_through, None)
+
+    def test_same_answers_as_full_materialization(self):
+        self._pay(20, 100)
+        self._pay(75, 250)
+        self._assert_same_answers()
+
+        pa = PolicyAccounting(self.lazy_id)
+        year_end = self.effective_date + relativedelta(months=13)
+        self.assertEquals(
+            pa.return_account_balance(year_end),
+            PolicyAccounting(self.full_id).return_account_balance(year_end),
+        )
+
+        client = app.test_client()
+        data = {"dateCursor": year_end.strftime("%Y-%m-%d")}
+        for policy_id in self.policy_ids:
+            response = client.post("/policies/%s" % policy_id, data=data)
+            self.assertTrue('"accountBalance": 850' in response.data)
+
+    def test_extend_invoices(self):
+        self._pay(40, 300)
+        result = extend_invoices(self.today + relativedelta(days=60), horizon_days=45)
+        self.assertEquals(result["policies"], 1)
+        self.assertEquals(self._live_invoices(self.lazy_id), 4)
+        self._assert_same_answers()
+
+        result = extend_invoices(self.today + relativedelta(years=1), horizon_days=45)
+        self.assertEquals(result["invoices"], 8)
+        self.assertEquals(self._live_invoices(self.lazy_id), 12)
+        self.assertEquals(Policy.query.get(self.lazy_id).invoiced_through, None)
+        self._assert_same_answers()
+
+        # Nothing is left to extend.
+        result = extend_invoices(self.today + relativedelta(years=2), horizon_days=45)
+        self.assertEquals(result["policies"], 0)
+
+    def test_billing_schedule_change_writes_within_horizon(self):
+        PolicyAccounting(self.lazy_id).change_billing_schedule("Quarterly")
+        self.assertEquals(self._live_invoices(self.lazy_id), 1)
+        policy = Policy.query.get(self.lazy_id)
+        self.assertEquals(policy.invoiced_through, self.today + relativedelta(days=45))
+        ledger = Ledger.load(self.lazy_id)
+        self.assertEquals(len(ledger.bill_dates), 4)
+        year_end = self.effective_date + relativedelta(years=1)
+        self.assertEquals(ledger.balance(year_end), 1200)
+
+
+class TestChangeFeed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.execute(
+            Contact.__table__.delete().where(
+                Contact.__table__.c.id.in_(cls.contact_ids)
+            )
+        )
+        db.session.commit()
+
+    def setUp(self):
+        policy = Policy("Test Policy", date(2015, 1, 1), 1200)
+        policy.named_insured = self.contact_ids[1]
+        policy.agent = self.contact_ids[0]
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+        self.subscription = events.broker.subscribe(self.policy_id)
+        # Events come from the change log: skip what was logged so far.
+        self._events()
+
+    def tearDown(self):
+        events.broker.unsubscribe(self.subscription)
+        for table in [Invoice.__table__, Payment.__table__]:
+            condition = table.c.policy_id == self.policy_id
+            db.session.execute(table.delete().where(condition))
+        db.session.execute(
+            Policy.__table__.delete().where(Policy.__table__.c.id == self.policy_id)
+        )
+        db.session.commit()
+        rebuild_delinquency_index()
+
+    def _events(self):
+        events.poll()
+        received = []
+        while True:
+            event = self.subscription.get(0)
+            if event is None:
+                return received
+            received.append(event[1:])
+
+    def test_routing(self):
+        broker = events.Broker()
+        one = broker.subscribe(1)
+        book = broker.subscribe()
+        self.assertEquals(broker.publish(1, "policy", {"status": "Canceled"}), 2)
+        self.assertEquals(broker.publish(2, "policy", {"status": "Canceled"}), 1)
+        self.assertEquals(one.get(0)[2], {"status": "Canceled", "policyId": 1})
+        self.assertEquals(one.get(0), None)
+        self.assertEquals([book.get(0)[2]["policyId"] for _ in range(2)], [1, 2])
+
+        broker.unsubscribe(one)
+        broker.unsubscribe(book)
+        self.assertFalse(broker.has_subscribers(1))
+
+    def test_buffer_is_bounded(self):
+        broker = events.Broker(buffer_size=2)
+        subscription = broker.subscribe(1)
+        for amount in [10, 20, 30]:
+            broker.publish(1, "payment", {"amount": amount})
+        self.assertTrue(subscription.take_dropped())
+        self.assertFalse(subscription.take_dropped())
+        self.assertEquals(subscription.get(0)[2]["amount"], 20)
+        self.assertEquals(subscription.get(0)[2]["amount"], 30)
+
+    def test_payment_is_published(self):
+        self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=200)
+        [(kind, data)] = self._events()
+        self.assertEquals(kind, "payment")
+        self.assertEquals(data["policyId"], self.policy_id)
+        self.assertEquals(data["payment"]["amountPaid"], 200)
+        self.assertEquals(data["accountBalance"], 1000)
+
+    def test_status_and_schedule_changes_are_published(self):
+        self.pa.change_policy_status(date(2015, 3, 1), "Canceled", "Non-pay")
+        [(kind, data)] = self._events()
+        self.assertEquals(kind, "policy")
+        self.assertEquals(data["status"], "Canceled")
+        self.assertEquals(data["statusChangeDate"], "01/03/2015")
+
+        self.pa.change_billing_schedule("Quarterly")
+        received = dict(self._events())
+        self.assertEquals(sorted(received), ["invoices", "policy"])
+        self.assertEquals(len(received["invoices"]["invoices"]), 5)
+        self.assertEquals(received["policy"]["billingSchedule"], "Quarterly")
+
+    def test_writes_outside_policy_accounting_are_published(self):
+        # Jobs and other workers write through the same log.
+        db.session.execute(
+            Invoice.__table__.update()
+            .where(Invoice.__table__.c.policy_id == self.policy_id)
+            .values(deleted=True)
+        )
+        db.session.commit()
+        received = dict(self._events())
+        [invoice] = received["invoices"]["invoices"]
+        self.assertEquals(invoice["status"], "Deleted")
+
+        bill_policies(
+            [(self.policy_id, date(2015, 1, 1), "Annual", 1200)], date(2015, 1, 1)
+        )
+        received = dict(self._events())
+        self.assertEquals(len(received["invoices"]["invoices"]), 2)
+        self.assertEquals(received["invoices"]["accountBalance"], 1200)
+
+        other = events.broker.subscribe(0)
+        try:
+            self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=200)
+            self.assertEquals(events.poll(), 1)
+            self.assertEquals(other.get(0), None)
+        finally:
+            events.broker.unsubscribe(other)
+
+    def test_trimmed_log_resyncs(self):
+        for amount in [10, 20]:
+            self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=amount)
+        # Trimmed while the poller was away.
+        db.session.execute(changes.delete().where(changes.c.id < changelog.last_id()))
+        db.session.commit()
+        self.assertEquals(events.poll(), 0)
+        self.assertTrue(self.subscription.take_dropped())
+        self.assertEquals(self._events(), [])
+
+    def test_stream(self):
+        body = events.stream(self.policy_id, heartbeat=0.01)
+        self.assertEquals(next(body), "retry: 5000\n\n")
+        self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=200)
+        events.poll()
+        chunk = next(body)
+        self.assertTrue(chunk.startswith("id: "))
+        self.assertTrue("event: payment\ndata: {" in chunk)
+        self.assertEquals(next(body), ": keep-alive\n\n")
+
+        self.assertEquals(len(events.broker.subscriptions[self.policy_id]), 2)
+        body.close()
+        self.assertEquals(len(events.broker.subscriptions[self.policy_id]), 1)
+
+    def test_endpoints(self):
+        client = app.test_client()
+        response = client.get("/policies/%s/events" % self.policy_id, buffered=False)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.mimetype, "text/event-stream")
+        response.close()
+        self.assertEquals(client.get("/policies/0/events").status_code, 404)
+
+    def test_streams_are_capped(self):
+        client = app.test_client()
+        url = "/policies/%s/events" % self.policy_id
+        events.max_streams = 1
+        try:
+            first = client.get(url, buffered=False)
+            self.assertEquals(first.status_code, 200)
+            second = client.get(url, buffered=False)
+            self.assertEquals(second.status_code, 503)
+            self.assertEquals(second.headers["Retry-After"], "30")
+            first.close()
+            third = client.get(url, buffered=False)
+            self.assertEquals(third.status_code, 200)
+            third.close()
+        finally:
+            events.max_streams = None
+
+
+class TestBatchDetail(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.execute(
+            Contact.__table__.delete().where(
+                Contact.__table__.c.id.in_(cls.contact_ids)
+            )
+        )
+        db.session.commit()
+
+    def setUp(self):
+        self.policy_ids = []
+        for schedule in ["Monthly", "Quarterly", "Two-Pay"]:
+            policy = Policy("Test Policy %s" % schedule, date(2015, 1, 1), 1200)
+            policy.named_insured = self.contact_ids[1]
+            policy.agent = self.contact_ids[0]
+            policy.billing_schedule = schedule
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+        # The last policy is left for the batch endpoint to bill.
+        for policy_id in self.policy_ids[:2]:
+            PolicyAccounting(policy_id).make_payment(
+                date_cursor=date(2015, 2, 1), amount=150
+            )
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for table in [Invoice.__table__, Payment.__table__]:
+            db.session.execute(
+                table.delete().where(table.c.policy_id.in_(self.policy_ids))
+            )
+        db.session.execute(
+            Policy.__table__.delete().where(Policy.__table__.c.id.in_(self.policy_ids))
+        )
+        db.session.commit()
+        rebuild_delinquency_index()
+
+    def _batch(self, policy_ids, date_cursor="2015-06-01"):
+        return self.client.post(
+            "/policies/batch",
+            data={
+                "policyIds": ",".join(str(policy_id) for policy_id in policy_ids),
+                "dateCursor": date_cursor,
+            },
+        )
+
+    def _count_queries(self, policy_ids):
+        statements = []
+
+        # Registered with retval=True so that the function itself is the
+        # listener; event.remove does not accept engines in SQLAlchemy 0.7.
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+            return statement, parameters
+
+        engine = db.engine
+        event.listen(engine, "before_cursor_execute", count, retval=True)
+        try:
+            self.assertEquals(self._batch(policy_ids).status_code, 200)
+            return len(statements)
+        finally:
+            engine.dispatch.before_cursor_execute.remove(count, engine)
+
+    def test_matches_single_policy_endpoint(self):
+        batch = json.loads(self._batch(self.policy_ids).data)
+        self.assertEquals(batch["missing"], [])
+        self.assertEquals(len(batch["policies"]), 3)
+        for policy_id, detail in zip(self.policy_ids, batch["policies"]):
+            single = self.client.post(
+                "/policies/%s" % policy_id, data={"dateCursor": "2015-06-01"}
+            )
+            self.assertEquals(detail, json.loads(single.data))
+
+    def test_bills_never_invoiced_policies(self):
+        batch = json.loads(self._batch(self.policy_ids[2:]).data)
+        self.assertEquals(len(batch["policies"][0]["invoices"]), 2)
+        self.assertEquals(batch["policies"][0]["policy"]["accountBalance"], 600)
+        self.assertEquals(
+            Invoice.query.filter_by(policy_id=self.policy_ids[2]).count(), 2
+        )
+
+    def test_order_duplicates_and_missing(self):
+        policy_ids = [self.policy_ids[1], 0, self.policy_ids[0], self.policy_ids[1]]
+        batch = json.loads(self._batch(policy_ids).data)
+        self.assertEquals(
+            [detail["policy"]["id"] for detail in batch["policies"]],
+            [self.policy_ids[1], self.policy_ids[0]],
+        )
+        self.assertEquals(batch["missing"], [0])
+
+    def test_query_count_is_constant(self):
+        self._batch(self.policy_ids)
+        self.assertEquals(
+            self._count_queries(self.policy_ids[:1]),
+            self._count_queries(self.policy_ids),
+        )
+
+    def test_invalid_requests(self):
+        self.assertEquals(self._batch([]).status_code, 400)
+        self.assertEquals(self._batch(["x"]).status_code, 400)
+        self.assertEquals(self._batch(self.policy_ids, "bad").status_code, 400)
+        self.assertEquals(self._batch(range(1, 502)).status_code, 400)
+
+
+class TestAllocations(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Allocated Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured = self.test_insured.id
+        self.policy.agent = self.test_agent.id
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+        self.payments = []
+
+    def tearDown(self):
+        db.session.execute(
+            invoice_allocations.delete().where(
+                invoice_allocations.c.policy_id == self.policy.id
+            )
+        )
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.delete(self.policy)
+        db.session.commit()
+
+    def _pay(self, amount):
+        self.payments.append(
+            self.pa.make_payment(date_cursor=date(2015, 2, 1), amount=amount)
+        )
+
+    def _statuses(self):
+        format_date = DateFormatter()
+        return [
+            (invoice["amountPaid"], invoice["status"])
+            for invoice in [
+                invoice_serializer(row, format_date)
+                for row in queries.invoice_rows(self.policy.id)
+            ]
+        ]
+
+    def _allocations(self):
+        query = (
+            select(
+                [
+                    invoice_allocations.c.invoice_id,
+                    invoice_allocations.c.payment_id,
+                    invoice_allocations.c.amount,
+                ]
+            )
+            .where(invoice_allocations.c.policy_id == self.policy.id)
+            .order_by(invoice_allocations.c.invoice_id)
+        )
+        return db.session.execute(query).fetchall()
+
+    def test_payments_fill_oldest_invoice_first(self):
+        self.assertEquals(self._statuses(), [(0, "Unpaid")] * 4)
+        self._pay(200)
+        self.assertEquals(
+            self._statuses(), [(200, "Partially Paid")] + [(0, "Unpaid")] * 3
+        )
+        self._pay(250)
+        self.assertEquals(
+            self._statuses(),
+            [(300, "Paid"), (150, "Partially Paid"), (0, "Unpaid"), (0, "Unpaid")],
+        )
+
+    def test_overpayment_is_left_unallocated(self):
+        self._pay(1500)
+        self.assertEquals(self._statuses(), [(300, "Paid")] * 4)
+        self.assertEquals(sum(row[2] for row in self._allocations()), 1200)
+
+    def test_billing_schedule_change_reallocates(self):
+        self._pay(450)
+        self.pa.change_billing_schedule("Monthly")
+        statuses = self._statuses()
+        # Payments move to the new invoices.
+        self.assertEquals(statuses.count((0, "Deleted")), 4)
+        live = [status for status in statuses if status[1] != "Deleted"]
+        self.assertEquals(
+            live,
+            [(100, "Paid")] * 4 + [(50, "Partially Paid")] + [(0, "Unpaid")] * 7,
+        )
+
+    def test_rebuild_matches_incremental(self):
+        self._pay(200)
+        self._pay(250)
+        self._pay(100)
+        incremental = self._allocations()
+        rebuild_allocations()
+        self.assertEquals(self._allocations(), incremental)
+
+    def test_deleting_rows_deletes_their_allocations(self):
+        self._pay(450)
+        first_invoice = self.policy.invoices[0]
+        db.session.delete(first_invoice)
+        db.session.commit()
+        self.assertEquals(
+            [row[0] for row in self._allocations()], [self.policy.invoices[0].id]
+        )
+        db.session.delete(self.payments.pop())
+        db.session.commit()
+        self.assertEquals(self._allocations(), [])
+
+
+class TestProfiling(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.profiled_app = create_app({"PROFILE_DIR": cls.directory, "PROFILE_KEEP": 3})
+
+    @classmethod
+    def tearDownClass(cls):
+        # create_app bound db to the application it built.
+        db.session.remove()
+        db.app = app
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.client = self.profiled_app.test_client()
+
+    def _profiles(self):
+        response = self.client.get("/debug/profiles")
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.data)["profiles"]
+
+    def test_only_flagged_requests_are_profiled(self):
+        before = len(self._profiles())
+        self.client.post("/policies/1", data={"dateCursor": "2015-06-01"})
+        self.assertEquals(len(self._profiles()), before)
+
+    def test_report_has_call_stats_and_sql(self):
+        response = self.client.post(
+            "/policies/1",
+            data={"dateCursor": "2015-06-01"},
+            headers={"X-Profile": "1"},
+        )
+        self.assertEquals(response.status_code, 200)
+        summary = self._profiles()[0]
+        self.assertEquals(summary["path"], "/policies/1")
+        self.assertEquals(summary["status"], 200)
+
+        report = json.loads(
+            self.client.get("/debug/profiles/%s" % summary["id"]).data
+        )
+        self.assertEquals(report["sqlCount"], len(report["sql"]))
+        self.assertTrue(report["sqlCount"] > 0)
+        self.assertTrue(
+            any("FROM invoices" in sql["statement"] for sql in report["sql"])
+        )
+        functions = [function["function"] for function in report["functions"]]
+        self.assertTrue(any("get_policy" in function for function in functions))
+
+        response = self.client.get(
+            "/debug/profiles/%s?format=pstats" % summary["id"]
+        )
+        self.assertEquals(response.status_code, 200)
+
+    def test_query_flag_and_pruning(self):
+        for _ in range(4):
+            self.client.get("/policies?profile=1")
+        profiles = self._profiles()
+        self.assertEquals(len(profiles), 3)
+        self.assertEquals(profiles[0]["query"], "profile=1")
+        self.assertEquals(len(os.listdir(self.directory)), 6)
+
+    def test_replica_reads_are_timed(self):
+        replica_directory = tempfile.mkdtemp()
+        replica_app = create_app(
+            {"PROFILE_DIR": self.directory, "REPLICA_DIR": replica_directory}
+        )
+        try:
+            replica.refresh()
+            replica.reads.clear()
+            client = replica_app.test_client()
+            self.assertEquals(client.get("/policies?profile=1").status_code, 200)
+            self.assertEquals(replica.reads, {"replica": 1})
+            self.assertTrue(self._profiles()[0]["sqlCount"] > 0)
+        finally:
+            db.session.remove()
+            db.app = self.profiled_app
+            replica.configure(self.profiled_app.config)
+            shutil.rmtree(replica_directory)
+
+    def test_unknown_profile(self):
+        self.assertEquals(self.client.get("/debug/profiles/1-2-3").status_code, 404)
+        self.assertEquals(self.client.get("/debug/profiles/..").status_code, 404)
+
+    def test_disabled_without_profile_dir(self):
+        client = app.test_client()
+        self.assertEquals(client.get("/debug/profiles").status_code, 404)
+        self.assertFalse(isinstance(app.wsgi_app, profiling.ProfilingMiddleware))
+
+
+class TestQuotes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact("Test Agent", "Agent")
+        cls.test_insured = Contact("Test Insured", "Named Insured")
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+        # The endpoint test's request removes the session.
+        cls.contact_ids = (cls.test_insured.id, cls.test_agent.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy("Test Quoted Policy", date(2015, 1, 1), 1200)
+        self.policy.named_insured, self.policy.agent = self.contact_ids
+        self.policy.billing_schedule = "Quarterly"
+        db.session.add(self.policy)
+        db.session.commit()
+        self.policy_id = self.policy.id
+        self.pa = PolicyAccounting(self.policy.id)
+        self.pa.make_payment(date_cursor=date(2015, 1, 15), amount=300)
+        self.pa.make_payment(date_cursor=date(2015, 4, 20), amount=250)
+
+    def tearDown(self):
+        Invoice.query.filter_by(policy_id=self.policy_id).delete()
+        Payment.query.filter_by(policy_id=self.policy_id).delete()
+        db.session.execute(
+            invoice_allocations.delete().where(
+                invoice_allocations.c.policy_id == self.policy_id
+            )
+        )
+        Policy.query.filter_by(id=self.policy_id).delete()
+        db.session.commit()
+        rebuild_delinquency_index()
+
+    def _quotes(self, date_cursor):
+        return dict(
+            (schedule, (invoices, balance))
+            for schedule, invoices, balance in quote(
+                queries.policy_row(self.policy.id),
+                queries.payment_rows(self.policy.id),
+                date_cursor,
+            )
+        )
+
+    def test_quotes_every_schedule_without_writing(self):
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id).count()
+        quotes = self._quotes(date(2015, 6, 1))
+        self.assertEquals(sorted(quotes), ["Annual", "Monthly", "Quarterly", "Two-Pay"])
+        self.assertEquals(len(quotes["Monthly"][0]), 12)
+        self.assertEquals(
+            Invoice.query.filter_by(policy_id=self.policy.id).count(), invoices
+        )
+        self.assertFalse(db.session.new or db.session.dirty)
+
+    def test_current_schedule_matches_balance(self):
+        for date_cursor in [date(2015, 1, 1), date(2015, 6, 1), date(2016, 1, 1)]:
+            self.assertEquals(
+                self._quotes(date_cursor)["Quarterly"][1],
+                self.pa.return_account_balance(date_cursor),
+            )
+
+    def test_quote_matches_schedule_change(self):
+        invoices, _ = self._quotes(date(2015, 6, 1))["Monthly"]
+        self.pa.change_billing_schedule("Monthly")
+        self.assertEquals(
+            [(bill_date, balance) for bill_date, _, _, _, balance in invoices],
+            [
+                (bill_date, self.pa.return_account_balance(bill_date))
+                for bill_date, _, _, _, _ in invoices
+            ],
+        )
+
+    def test_batch_matches_single(self):
+        quoted = quote_policies([self.policy.id, 0], date(2015, 6, 1))
+        self.assertEquals(list(quoted), [self.policy.id])
+        self.assertEquals(
+            dict(
+                (schedule, (invoices, balance))
+                for schedule, invoices, balance in quoted[self.policy.id][1]
+            ),
+            self._quotes(date(2015, 6, 1)),
+        )
+
+    def test_endpoint(self):
+        client = app.test_client()
+        url = "/policies/%s/quotes" % self.policy_id
+        response = client.get(
+            url + "?dateCursor=2015-06-01&billingSchedule=Annual"
+            "&billingSchedule=Quarterly"
+        )
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEquals(
+            [(item["billingSchedule"], item["current"]) for item in data["quotes"]],
+            [("Annual", False), ("Quarterly", True)],
+        )
+        self.assertEquals(data["quotes"][0]["accountBalance"], 650)
+        self.assertEquals(data["quotes"][0]["invoices"][0]["balance"], 1200)
+        self.assertEquals(client.get(url + "?dateCursor=bad").status_code, 400)
+        self.assertEquals(client.get(url + "?billingSchedule=Weekly").status_code, 400)
+        self.assertEquals(client.get("/policies/0/quotes").status_code, 404)
+
+
+class TestShards(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # The session open so far is bound to the test database.
+        db.session.remove()
+        cls.config = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+            + os.path.join(cls.directory, "main.sqlite"),
+            "SHARDS": [
+                "sqlite:///" + os.path.join(cls.directory, "shard%d.sqlite" % i)
+                for i in range(2)
+            ],
+        }
+        cls.sharded_app = create_app(cls.config)
+        shards.create_all()
+        insert_data()
+
+    @classmethod
+    def tearDownClass(cls):
+        # create_app bound db to the application it built.
+        shards.reset()
+        db.session.remove()
+        db.app = app
+        shards.configure(app.config)
+        cache.configure(app.config)
+        shutil.rmtree(cls.directory)
+
+    def tearDown(self):
+        shards.reset()
+
+    def _policy_ids(self):
+        return dict(
+            (name, [row[0] for row in rows])
+            for name, rows in shards.each(
+                lambda: db.session.execute(select([Policy.__table__.c.id])).fetchall()
+            )
+        )
+
+    def test_policies_live_on_their_shard(self):
+        self.assertEquals(shards.names, ["shard0", "shard1"])
+        for name, policy_ids in self._policy_ids().items():
+            self.assertTrue(policy_ids)
+            for policy_id in policy_ids:
+                self.assertEquals(shards.shard_for(policy_id), name)
+        self.assertEquals(Policy.query.count(), 0)
+
+    def test_contacts_are_replicated(self):
+        names = sorted(contact.name for contact in Contact.query)
+        self.assertEquals(len(names), 6)
+        for shard in shards.names:
+            with shards.using(shard):
+                self.assertEquals(
+                    sorted(contact.name for contact in Contact.query), names
+                )
+
+    def test_contact_copies_are_retried(self):
+        # Writes to shard1's contacts fail while the table is out of the way.
+        connection = sqlite3.connect(shards.engine("shard1").url.database)
+        connection.execute("ALTER TABLE contacts RENAME TO contacts_away")
+        connection.commit()
+        try:
+            contact = Contact("Test Outbox Contact", "Agent")
+            db.session.add(contact)
+            db.session.commit()
+        finally:
+            connection.execute("ALTER TABLE contacts_away RENAME TO contacts")
+            connection.commit()
+            connection.close()
+        contact_id = contact.id
+
+        counts = {}
+        for shard in shards.names:
+            with shards.using(shard):
+                counts[shard] = Contact.query.filter_by(id=contact_id).count()
+        self.assertEquals(counts, {"shard0": 1, "shard1": 0})
+        self.assertEquals(
+            shards.deliver_contacts(),
+            {"contacts": {"shard0": 0, "shard1": 1}, "failed": []},
+        )
+        with shards.using("shard1"):
+            self.assertEquals(Contact.query.filter_by(id=contact_id).count(), 1)
+
+        db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+        for shard in shards.names:
+            with shards.using(shard):
+                self.assertEquals(Contact.query.filter_by(id=contact_id).count(), 0)
+
+    def test_gather_runs_requests_side_by_side(self):
+        running = []
+        all_running = threading.Event()
+
+        def wait():
+            running.append(shards.current())
+            if len(running) == 2 * len(shards.names):
+                all_running.set()
+            # With one thread per shard, the second call would wait for the first.
+            all_running.wait(5)
+            return all_running.is_set()
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(shards.gather(wait)))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [[True, True]] * 2)
+
+    def test_pool_size_is_worked_out_once(self):
+        config = dict(self.config, SQLALCHEMY_POOL_SIZE=2, SHARD_GATHER_THREADS=3)
+        try:
+            sizes = [
+                create_app(config).config["SQLALCHEMY_POOL_SIZE"] for _ in range(2)
+            ]
+            # Request threads, the change feed follower and the gather threads.
+            self.assertEquals(sizes, [6, 6])
+            self.assertEquals(config["SQLALCHEMY_POOL_SIZE"], 2)
+        finally:
+            shards.reset()
+            db.session.remove()
+            db.app = self.sharded_app
+            shards.configure(self.sharded_app.config)
+
+    def test_profiled_requests_time_every_shard(self):
+        directory = tempfile.mkdtemp()
+        wsgi_app = self.sharded_app.wsgi_app
+        self.sharded_app.config["PROFILE_DIR"] = directory
+        profiling.install(self.sharded_app)
+        try:
+            client = self.sharded_app.test_client()
+            self.assertEquals(client.get("/policies?profile=1").status_code, 200)
+            [summary] = profiling.list_profiles(directory)
+            report = profiling.load_profile(directory, summary["id"])
+        finally:
+            self.sharded_app.wsgi_app = wsgi_app
+            del self.sharded_app.config["PROFILE_DIR"]
+            shutil.rmtree(directory)
+        policy_reads = [
+            sql for sql in report["sql"] if "FROM policies" in sql["statement"]
+        ]
+        self.assertEquals(len(policy_reads), len(shards.names))
+
+    def test_requests_sync_their_shard_only(self):
+        cache.configure(self.sharded_app.config)
+        client = self.sharded_app.test_client()
+        client.get("/policies")
+        self.assertEquals(cache._last_change_ids, {})
+        policy_id = self._policy_ids()["shard1"][0]
+        response = client.post(
+            "/policies/%s" % policy_id, data={"dateCursor": "2015-06-01"}
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(cache._last_change_ids.keys(), ["shard1"])
+
+    def test_policy_accounting_is_routed(self):
+        policy_id = self._policy_ids()["shard1"][0]
+        pa = PolicyAccounting(policy_id)
+        balance = pa.return_account_balance(date(2016, 1, 1))
+        pa.make_payment(date_cursor=date(2015, 12, 1), amount=10)
+        self.assertEquals(pa.return_account_balance(date(2016, 1, 1)), balance - 10)
+        with shards.using("shard1"):
+            self.assertTrue(Payment.query.filter_by(policy_id=policy_id).count())
+        with shards.using("shard0"):
+            self.assertFalse(Payment.query.filter_by(policy_id=policy_id).count())
+
+    def test_views_span_shards(self):
+        client = self.sharded_app.test_client()
+        policy_ids = sorted(sum(self._policy_ids().values(), []))
+        data = json.loads(client.get("/policies").data)
+        self.assertEquals([policy["id"] for policy in data["policies"]], policy_ids)
+
+        for policy_id in policy_ids:
+            response = client.post(
+                "/policies/%s" % policy_id, data={"dateCursor": "2015-06-01"}
+            )
+            self.assertEquals(response.status_code, 200)
+
+        response = client.post(
+            "/policies/batch",
+            data={
+                "policyIds": ",".join(str(policy_id) for policy_id in policy_ids)
+                + ",1000",
+                "dateCursor": "2015-06-01",
+            },
+        )
+        data = json.loads(response.data)
+        self.assertEquals(
+            [detail["policy"]["id"] for detail in data["policies"]], policy_ids
+        )
+        self.assertEquals(data["missing"], [1000])
+
+        response = client.get("/reports/pending-cancellation?date=2015-06-01")
+        self.assertEquals(response.status_code, 200)
+
+    def test_gather_raises_shard_errors(self):
+        def fail():
+            raise ValueError(shards.current())
+
+        self.assertRaises(ValueError, shards.gather, fail)
+        self.assertEquals(shards.gather(shards.current), shards.names)
+
+    def test_renewals_keep_their_shard(self):
+        before = sum(len(ids) for ids in self._policy_ids().values())
+        results = shards.each(renew_policies, date(2016, 1, 1), date(2016, 2, 1))
+        self.assertEquals([name for name, _ in results], shards.names)
+        policy_ids = self._policy_ids()
+        self.assertTrue(sum(len(ids) for ids in policy_ids.values()) > before)
+        for name, shard_policy_ids in policy_ids.items():
+            for policy_id in shard_policy_ids:
+                self.assertEquals(shards.shard_for(policy_id), name)
+
+
+class TestReplica(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # Pooled connections, so refreshes must reopen the replica.
+        cls.replica_app = create_app(
+            {"REPLICA_DIR": cls.directory, "SQLALCHEMY_POOL_SIZE": 2}
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        # create_app bound db to the application it built.
+        db.session.remove()
+        db.app = app
+        replica.configure(app.config)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        replica.reads.clear()
+
+    def tearDown(self):
+        Contact.query.filter_by(name="Replica Contact").delete()
+        db.session.commit()
+        if os.path.exists(replica.path()):
+            os.remove(replica.path())
+
+    def _add_contact_elsewhere(self):
+        # As another process would, so it is not one of this thread's writes.
+        connection = sqlite3.connect(db.engine.url.database)
+        connection.execute(
+            "INSERT INTO contacts (name, role) VALUES ('Replica Contact', 'Agent')"
+        )
+        connection.commit()
+        connection.close()
+
+    def _contacts(self):
+        with replica.reading():
+            return Contact.query.filter_by(name="Replica Contact").count()
+
+    def test_primary_without_replica(self):
+        self._add_contact_elsewhere()
+        self.assertEquals(self._contacts(), 1)
+        self.assertEquals(replica.reads, {"stale": 1})
+
+    def test_replica_until_refreshed(self):
+        replica.refresh()
+        self._add_contact_elsewhere()
+        self.assertEquals(self._contacts(), 0)
+        self.assertEquals(Contact.query.filter_by(name="Replica Contact").count(), 1)
+        replica.refresh()
+        self.assertEquals(self._contacts(), 1)
+        self.assertEquals(replica.reads, {"replica": 2})
+
+    def test_stale_replica_is_bypassed(self):
+        replica.refresh()
+        self._add_contact_elsewhere()
+        copied = time.time() - replica.max_lag - 1
+        os.utime(replica.path(), (copied, copied))
+        self.assertEquals(self._contacts(), 1)
+        self.assertEquals(replica.reads, {"stale": 1})
+
+    def test_reads_own_writes(self):
+        policy = Policy("Test Replica Policy", date(2015, 1, 1), 1200)
+        policy.named_insured = Contact.query.filter_by(name="Anna White").one().id
+        db.session.add(policy)
+        db.session.commit()
+        policy_id = policy.id
+        try:
+            pa = PolicyAccounting(policy_id)
+            replica.refresh()
+            self.assertEquals(pa.return_account_balance(date(2015, 6, 1)), 1200)
+            self.assertEquals(replica.reads, {"replica": 1})
+            pa.make_payment(date_cursor=date(2015, 5, 1), amount=5)
+            self.assertEquals(pa.return_account_balance(date(2015, 6, 1)), 1195)
+            self.assertEquals(replica.reads, {"replica": 1, "ownWrites": 1})
+        finally:
+            for table in [Invoice.__table__, Payment.__table__, invoice_allocations]:
+                db.session.execute(
+                    table.delete().where(table.c.policy_id == policy_id)
+                )
+            Policy.query.filter_by(id=policy_id).delete()
+            db.session.commit()
+            rebuild_delinquency_index()
+
+    def test_client_reads_its_own_writes(self):
+        replica.refresh()
+        # A commit this thread made for someone else does not count.
+        Contact.query.filter_by(name="Replica Contact").delete()
+        db.session.commit()
+        self._add_contact_elsewhere()
+        with self.replica_app.test_request_context("/policies"):
+            self.assertEquals(self._contacts(), 0)
+        written_at = str(time.time())
+        with self.replica_app.test_request_context(
+            "/policies", headers={replica.WRITTEN_AT_HEADER: written_at}
+        ):
+            self.assertEquals(self._contacts(), 1)
+        self.assertEquals(replica.reads, {"replica": 1, "ownWrites": 1})
+
+    def test_writes_hand_out_their_time(self):
+        replica.refresh()
+        with self.replica_app.test_request_context("/policies", method="POST"):
+            self._add_contact_elsewhere()
+            self.assertEquals(self._contacts(), 0)
+            Contact.query.filter_by(name="Replica Contact").delete()
+            db.session.commit()
+            self.assertEquals(self._contacts(), 0)
+            response = replica.remember_writes(self.replica_app.response_class())
+        written_at = response.headers[replica.WRITTEN_AT_HEADER]
+        self.assertTrue(
+            "%s=%s" % (replica.WRITTEN_AT_COOKIE, written_at)
+            in response.headers["Set-Cookie"]
+        )
+        self.assertEquals(replica.reads, {"replica": 1, "ownWrites": 1})
+
+    def test_endpoint(self):
+        client = self.replica_app.test_client()
+        replica.refresh()
+        self.assertEquals(client.get("/policies").status_code, 200)
+        self.assertEquals(
+            client.get("/reports/pending-cancellation?date=2015-06-01").status_code,
+            200,
+        )
+        data = json.loads(client.get("/debug/replica").data)
+        self.assertEquals(data["reads"], {"replica": 2})
+        self.assertEquals(data["replicas"][0]["database"], "main")
+        self.assertTrue(0 <= data["lagSeconds"] <= data["maxLagSeconds"])
+        self.assertEquals(app.test_client().get("/debug/replica").status_code, 404)
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        db.session.execute(change_cursors.delete())
+        db.session.commit()
+
+    def _touch(self):
+        policies = Policy.__table__
+        db.session.execute(
+            policies.update().where(policies.c.id == 1).values(annual_premium=365)
+        )
+        db.session.commit()
+
+    def test_installs_on_database_without_change_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            engine = create_engine("sqlite:///" + os.path.join(directory, "old.sqlite"))
+            for model in [Contact, Policy, Invoice, Payment]:
+                model.__table__.create(engine)
+            connection = engine.connect()
+            install_change_log(None, connection)
+            connection.execute(
+                Policy.__table__.insert(),
+                {
+                    "policy_number": "Old Policy",
+                    "effective_date": date(2015, 1, 1),
+                    "annual_premium": 100,
+                },
+            )
+            self.assertEquals(
+                connection.execute(select([changes.c.table_name])).fetchall(),
+                [("policies",)],
+            )
+            connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_trim_keeps_what_readers_need(self):
+        self._touch()
+        changelog.save_cursor("test:reader", changelog.last_id())
+        changelog.save_cursor("test:gone", 0, ttl=-1)
+        self._touch()
+        self._touch()
+        changelog.trim()
+        db.session.commit()
+        first_id, last_id = changelog.bounds()
+        self.assertEquals(first_id, last_id - 1)
+        self.assertFalse(changelog.behind(first_id - 1))
+        names = [row[0] for row in db.session.execute(select([change_cursors.c.name]))]
+        self.assertEquals(names, ["test:reader"])
+
+        db.session.execute(change_cursors.delete())
+        changelog.trim()
+        db.session.commit()
+        self.assertEquals(changelog.bounds(), (last_id, last_id))
+        self.assertTrue(changelog.behind(last_id - 2))
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "old.sqlite")
+        # The tables as they were before the change log and invoice horizons.
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            """
+            CREATE TABLE contacts (id INTEGER PRIMARY KEY, name VARCHAR(128),
+                role VARCHAR(128));
+            CREATE TABLE policies (id INTEGER PRIMARY KEY,
+                policy_number VARCHAR(128) NOT NULL, effective_date DATE NOT NULL,
+                status VARCHAR(128) NOT NULL, status_change_description VARCHAR(128),
+                status_change_date DATE, billing_schedule VARCHAR(128) NOT NULL,
+                annual_premium INTEGER NOT NULL, named_insured INTEGER,
+                agent INTEGER);
+            CREATE TABLE invoices (id INTEGER PRIMARY KEY,
+                policy_id INTEGER NOT NULL, bill_date DATE NOT NULL,
+                due_date DATE NOT NULL, cancel_date DATE NOT NULL,
+                amount_due INTEGER NOT NULL, deleted BOOLEAN DEFAULT '0' NOT NULL);
+            INSERT INTO invoices VALUES (1, 1, '2015-01-01', '2015-02-01',
+                '2015-02-15', 1200, 0);
+            INSERT INTO contacts VALUES (1, 'Old Insured', 'Named Insured');
+            INSERT INTO policies VALUES (1, 'Old Policy', '2015-01-01', 'Active',
+                NULL, NULL, 'Annual', 1200, 1, NULL);
+            """
+        )
+        connection.close()
+        db.session.remove()
+        self.old_app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+
+    def tearDown(self):
+        db.session.remove()
+        db.app = app
+        shards.configure(app.config)
+        cache.configure(app.config)
+        shutil.rmtree(self.directory)
+
+    def test_app_upgrades_the_schema(self):
+        columns = [row[1] for row in db.engine.execute("PRAGMA table_info(policies)")]
+        self.assertTrue("invoiced_through" in columns)
+        for table in [changes, change_cursors, invoice_allocations]:
+            self.assertTrue(table.exists(db.engine))
+
+        client = self.old_app.test_client()
+        response = client.get("/policies")
+        self.assertEquals(response.status_code, 200)
+        policy = json.loads(response.data)["policies"][0]
+        self.assertEquals(policy["name"], "Old Policy")
+        PolicyAccounting(1).make_payment(date_cursor=date(2015, 2, 1), amount=1200)
+        self.assertEquals(PolicyAccounting(1).return_account_balance(date(2015, 2, 1)), 0)
+
+    def test_pending_cancellation_index_is_backfilled(self):
+        self.assertEquals(
+            [row[0] for row in pending_cancellation(date(2015, 2, 5))], [1]
+        )
@@ -1,10 +1,18 @@
 #!/user/bin/env python2.7
 
 from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
+
+from sqlalchemy import bindparam
 
 from accounting import db
+from allocations import allocate_payment, refresh_allocations
+from billing import BILLING_SCHEDULES, invoice_horizon, materialize, plan_invoices
+from delinquency import refresh_delinquency_windows
+from ledger import Ledger
 from models import Contact, Invoice, Payment, Policy
+from replica import reads_replica
+from shards import routed
+import shards
 
 """
 #######################################################
@@ -16,42 +24,39 @@ This is the base code for the engineer project.
 class PolicyAccounting(object):
     """
      Each policy has its own instance of accounting.
+     Methods run on the policy's shard, see accounting.shards; the balance
+     reads may run on its replica, see accounting.replica.
     """
 
     def __init__(self, policy_id):
-        self.policy = Policy.query.filter_by(id=policy_id).one()
+        self.policy_id = policy_id
+        self.load()
+
+    @routed
+    def load(self):
+        self.policy = Policy.query.filter_by(id=self.policy_id).one()
 
         if not self.policy.invoices:
             self.make_invoices()
 
+    @routed
+    @reads_replica
     def return_account_balance(self, date_cursor=None):
         """
         :param date_cursor: Date at which the account balance is to be calculated.
         :return: Account balance / How much is left to pay.
         """
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        invoices = (
-            Invoice.query.filter_by(policy_id=self.policy.id)
-            .filter(Invoice.bill_date <= date_cursor, Invoice.deleted == False)
-            .order_by(Invoice.bill_date)
-            .all()
-        )
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        payments = (
-            Payment.query.filter_by(policy_id=self.policy.id)
-            .filter(Payment.transaction_date <= date_cursor)
-            .all()
-        )
-        for payment in payments:
-            due_now -= payment.amount_paid
+        return self.ledger().balance(date_cursor)
 
-        return due_now
+    @routed
+    def ledger(self):
+        """
+        :return: Ledger of the policy's live invoices and payments, plus
+                 the invoices left to write under a rolling horizon.
+        """
+        return Ledger.load(self.policy.id)
 
+    @routed
     def change_billing_schedule(self, billing_schedule=None):
         """
         Changes billing schedle of the already existing policy.
@@ -95,6 +100,7 @@ class PolicyAccounting(object):
 
         return True, ""
 
+    @routed
     def make_payment(self, contact_id=None, date_cursor=None, amount=0):
         """
         :param contact_id: Foreign Key to Contact instance, defaults to policy's named_insured.
@@ -113,10 +119,16 @@ class PolicyAccounting(object):
 
         payment = Payment(self.policy.id, contact_id, amount, date_cursor)
         db.session.add(payment)
+        # allocate_payment needs the payment's id.
+        db.session.flush()
+        refresh_delinquency_windows([self.policy.id])
+        allocate_payment(self.policy.id, payment.id, amount)
         db.session.commit()
 
         return payment
 
+    @routed
+    @reads_replica
     def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
         """
          If this function returns true, an invoice
@@ -124,21 +136,9 @@ class PolicyAccounting(object):
          being paid in full. However, it has not necessarily
          made it to the cancel_date yet.
         """
-        if not date_cursor:
-            date_cursor = datetime.now().date()
-
-        if self.return_account_balance(date_cursor) > 0:
-            try:
-                Invoice.query.filter_by(policy_id=self.policy.id).filter(
-                    Invoice.due_date < date_cursor,
-                    date_cursor < Invoice.cancel_date,
-                    Invoice.deleted == False,
-                ).one()
-                return True
-            except:
-                return False
-        return False
+        return self.ledger().is_cancellation_pending(date_cursor)
 
+    @routed
     def change_policy_status(self, date_cursor=None, new_status=None, description=None):
         """
         :param date_cursor: Date at which status update is to be done.
@@ -183,6 +183,7 @@ class PolicyAccounting(object):
 
         return True, ""
 
+    @routed
     def cancel_policy(self, date_cursor=None, description=None):
         """
         Cancels policy if it it meets cancelation requirements.
@@ -196,73 +197,100 @@ class PolicyAccounting(object):
             print ("You cannot cancel a policy in the future!")
             return
 
-        invoices = (
-            Invoice.query.filter_by(policy_id=self.policy.id)
-            .filter(Invoice.cancel_date <= date_cursor, Invoice.deleted == False)
-            .order_by(Invoice.bill_date)
-            .all()
-        )
+        if not self.ledger().should_cancel(date_cursor):
+            print ("Policy should not be canceled")
+            return
 
-        for invoice in invoices:
-            if self.return_account_balance(invoice.cancel_date):
-                status_changed, error = self.change_policy_status(
-                    date_cursor, "Canceled", description
-                )
-                if not status_changed:
-                    print (error)
-                else:
-                    print ("Policy canceled successfully.")
-                return
-        print ("Policy should not be canceled")
-        return
+        status_changed, error = self.change_policy_status(
+            date_cursor, "Canceled", description
+        )
+        if not status_changed:
+            print (error)
+        else:
+            print ("Policy canceled successfully.")
 
-    def make_invoices(self):
+    @routed
+    def make_invoices(self, date_cursor=None):
         """
-        Creates invoices depending on policy's billing_schedule.
+        Creates invoices depending on policy's billing_schedule. With an
+        invoice horizon configured, only the invoices billed within it are
+        created; `python jobs.py extend-invoices` creates the rest over time.
+        :param date_cursor: Date the horizon is counted from, defaults to today.
         """
+        if self.policy.billing_schedule not in BILLING_SCHEDULES:
+            print "You have chosen a bad billing schedule."
 
-        billing_schedules = {"Annual": 1, "Two-Pay": 2, "Quarterly": 4, "Monthly": 12}
-        months_after_eff_date_dict = {
-            "Annual": 12,
-            "Two-Pay": 6,
-            "Quarterly": 3,
-            "Monthly": 1,
-        }
-
-        invoices = []
-        first_invoice = Invoice(
-            self.policy.id,
-            self.policy.effective_date,  # bill_date
-            self.policy.effective_date + relativedelta(months=1),  # due
-            self.policy.effective_date + relativedelta(months=1, days=14),  # cancel
-            self.policy.annual_premium,
+        invoices, invoiced_through = materialize(
+            plan_invoices(
+                self.policy.effective_date,
+                self.policy.billing_schedule,
+                self.policy.annual_premium,
+            ),
+            invoice_horizon(date_cursor),
         )
-        invoices.append(first_invoice)
+        self.policy.invoiced_through = invoiced_through
+        insert_invoices([(self.policy.id,) + invoice for invoice in invoices])
+        refresh_delinquency_windows([self.policy.id])
+        refresh_allocations([self.policy.id])
+        db.session.commit()
 
-        if self.policy.billing_schedule in billing_schedules:
-            invoices_quantity = billing_schedules.get(self.policy.billing_schedule)
-            first_invoice.amount_due = first_invoice.amount_due / invoices_quantity
-            months_between_invoices = months_after_eff_date_dict.get(
-                self.policy.billing_schedule
-            )
-            for i in range(1, invoices_quantity):
-                a = i * months_between_invoices
-                bill_date = self.policy.effective_date + relativedelta(months=a)
-                invoice = Invoice(
-                    self.policy.id,
-                    bill_date,
-                    bill_date + relativedelta(months=1),
-                    bill_date + relativedelta(months=1, days=14),
-                    self.policy.annual_premium
-                    / billing_schedules.get(self.policy.billing_schedule),
-                )
-                invoices.append(invoice)
-        else:
-            print "You have chosen a bad billing schedule."
 
-        for invoice in invoices:
-            db.session.add(invoice)
-        db.session.commit()
+def bill_policies(policies, date_cursor=None):
+    """
+    PolicyAccounting.make_invoices for many never invoiced policies at once,
+    with one executemany for their invoices and one for their
+    invoiced_through dates.
+    :param policies: (policy_id, effective_date, billing_schedule,
+                     annual_premium) tuples, all on the shard being used.
+    :param date_cursor: Date the horizon is counted from, defaults to today.
+    """
+    if not policies:
+        return
+    through = invoice_horizon(date_cursor)
+    invoices, horizons = [], []
+    for policy_id, effective_date, billing_schedule, annual_premium in policies:
+        written, invoiced_through = materialize(
+            plan_invoices(effective_date, billing_schedule, annual_premium), through
+        )
+        invoices.extend((policy_id,) + invoice for invoice in written)
+        horizons.append({"policy": policy_id, "through": invoiced_through})
+
+    insert_invoices(invoices)
+    table = Policy.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == bindparam("policy"))
+        .values(invoiced_through=bindparam("through")),
+        horizons,
+    )
+    policy_ids = [policy[0] for policy in policies]
+    refresh_delinquency_windows(policy_ids)
+    refresh_allocations(policy_ids)
+    db.session.commit()
+
+
+def insert_invoices(invoices):
+    """
+    Bulk inserts invoices with a single executemany, bypassing the ORM.
+    The caller is responsible for committing.
+    :param invoices: (policy_id, bill_date, due_date, cancel_date, amount_due) tuples.
+    """
+    if not invoices:
+        return
+    db.session.execute(
+        Invoice.__table__.insert(),
+        [
+            {
+                "policy_id": policy_id,
+                "bill_date": bill_date,
+                "due_date": due_date,
+                "cancel_date": cancel_date,
+                "amount_due": amount_due,
+                "deleted": False,
+            }
+            for policy_id, bill_date, due_date, cancel_date, amount_due in invoices
+        ],
+    )
 
 
 ################################
@@ -270,8 +298,8 @@ class PolicyAccounting(object):
 # shouldn't need to be edited.
 ################################
 def build_or_refresh_db():
-    db.drop_all()
-    db.create_all()
+    shards.drop_all()
+    shards.create_all()
     insert_data()
     print "DB Ready!"
 
@@ -322,12 +350,14 @@ def insert_data():
     policies.append(p4)
 
     for policy in policies:
-        db.session.add(policy)
-    db.session.commit()
+        with shards.using(shards.place()):
+            db.session.add(policy)
+            db.session.commit()
 
     for policy in policies:
         PolicyAccounting(policy.id)
 
-    payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
-    db.session.add(payment_for_p2)
-    db.session.commit()
+    with shards.using_policy(p2.id):
+        payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
+        db.session.add(payment_for_p2)
+        db.session.commit()
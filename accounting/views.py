@@ -1,52 +1,365 @@
 # You will probably need more methods from flask but this one is a good start.
-from flask import render_template, jsonify, request
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
+import os
+from collections import OrderedDict
 from datetime import datetime
 
 # Import things from Flask that we need.
-from accounting import app, db
+from accounting import db
 
-# Import our models
-from models import Contact, Invoice, Policy, Payment
+# Import the ORM-free read path and the per-process caches
+import cache
+import events
+import profiling
+import queries
+import replica
+import shards
+from delinquency import pending_cancellation
+from quotes import SCHEDULES, quote
 
 # Import serializers
-from serializers import policy_serializer, invoice_serializer, payment_serializer
+from serializers import (
+    DateFormatter,
+    policy_serializer,
+    invoice_serializer,
+    payment_serializer,
+    pending_cancellation_serializer,
+    quote_serializer,
+)
 
 # Import PolicyAccounting
-from utils import PolicyAccounting
+from utils import PolicyAccounting, bill_policies
 
+# Most policies POST /policies/batch serves, so that each of its IN-list
+# queries stays within SQLite's limits.
+MAX_BATCH_SIZE = 500
 
-# Routing for the server.
-@app.route("/")
+# Seconds a client turned away from a full change feed waits to try again.
+STREAM_RETRY_SECONDS = 30
+
+
+# Routing for the server, registered on the app by create_app().
+blueprint = Blueprint("accounting", __name__)
+
+
+@blueprint.before_request
+def route_to_shard():
+    # Requests about one policy run on its shard; create_app resets it.
+    # Only they read cached policy rows, and only that shard's.
+    policy_id = (request.view_args or {}).get("policy_id")
+    if policy_id is not None:
+        shards.route(policy_id)
+        cache.sync([shards.shard_for(policy_id)])
+
+
+@blueprint.route("/")
 def index():
     # You will need to serve something up here.
     return render_template("index.html")
 
 
-@app.route("/policies", methods=["GET"])
+def wants_history():
+    """
+    Archived policies, invoices and payments are only read when the caller
+    asks for them with history=1.
+    """
+    return request.values.get("history") in ("1", "true")
+
+
+@blueprint.route("/policies", methods=["GET"])
 def get_policies():
-    policies = Policy.query.all()
-    policies_dictionary = []
-    for policy in policies:
-        policies_dictionary.append(policy_serializer(policy))
-    return jsonify({"policies": policies_dictionary})
+    format_date = DateFormatter()
+    with replica.reading():
+        rows = shards.merged(shards.gather(queries.policy_rows, wants_history()))
+    policies = [policy_serializer(row, format_date) for row in rows]
+    return jsonify({"policies": policies})
 
 
-@app.route("/policies/<int:policy_id>", methods=["POST"])
+@blueprint.route("/policies/<int:policy_id>", methods=["POST"])
 def get_policy(policy_id):
     date_cursor = datetime.strptime(request.values.get("dateCursor"), "%Y-%m-%d")
-    policy_object = Policy.query.filter_by(id=policy_id).one()
+    date_cursor = date_cursor.date()
+    history = wants_history()
+    if history:
+        policy_row = queries.policy_row(policy_id, history=True)
+    else:
+        policy_row = cache.policy_row(policy_id)
+    if policy_row is None:
+        abort(404)
+
+    invoice_rows = queries.invoice_rows(policy_id, history=history)
+    if not invoice_rows and not history:
+        # PolicyAccounting bills policies that have never been invoiced,
+        # which may set their invoiced_through.
+        PolicyAccounting(policy_id)
+        policy_row = queries.policy_row(policy_id)
+        invoice_rows = queries.invoice_rows(policy_id)
+    payment_rows = queries.payment_rows(policy_id, history=history)
+
+    return jsonify(
+        policy_detail(
+            policy_row, invoice_rows, payment_rows, date_cursor, DateFormatter()
+        )
+    )
+
+
+@blueprint.route("/policies/batch", methods=["POST"])
+def get_policies_batch():
+    """
+    Details of many policies in one response, with the same number of
+    queries per shard whatever their count. Takes policyIds (comma
+    separated and/or repeated) and dateCursor. Unknown ids are listed
+    under "missing".
+    """
+    try:
+        date_cursor = datetime.strptime(request.values.get("dateCursor"), "%Y-%m-%d")
+        date_cursor = date_cursor.date()
+        policy_ids = list(
+            OrderedDict.fromkeys(
+                int(policy_id)
+                for value in request.values.getlist("policyIds")
+                for policy_id in value.split(",")
+                if policy_id.strip()
+            )
+        )
+    except (TypeError, ValueError):
+        abort(400)
+    if not policy_ids or len(policy_ids) > MAX_BATCH_SIZE:
+        abort(400)
+    history = wants_history()
+
+    details = {}
+    by_shard = OrderedDict()
+    for policy_id in policy_ids:
+        by_shard.setdefault(shards.shard_for(policy_id), []).append(policy_id)
+    for shard, shard_policy_ids in by_shard.items():
+        with shards.using(shard):
+            details.update(batch_details(shard_policy_ids, date_cursor, history))
+
+    return jsonify(
+        {
+            "policies": [
+                details[policy_id] for policy_id in policy_ids if policy_id in details
+            ],
+            "missing": [
+                policy_id for policy_id in policy_ids if policy_id not in details
+            ],
+        }
+    )
+
+
+def batch_details(policy_ids, date_cursor, history):
+    """
+    :param policy_ids: Policies on the shard being used.
+    :return: Dict of policy id to its detail; unknown policies are left out.
+    """
+    policy_rows = dict(
+        (row[0], row)
+        for row in queries.policy_rows(history=history, policy_ids=policy_ids)
+    )
+    invoice_rows = queries.invoice_rows_by_policy(policy_rows, history=history)
+    unbilled = [policy_id for policy_id in policy_rows if policy_id not in invoice_rows]
+    if unbilled and not history:
+        # Bill the policies that have never been invoiced, as get_policy does.
+        bill_policies(
+            [
+                (row[0], row[2], row[6], row[7])
+                for row in (policy_rows[policy_id] for policy_id in unbilled)
+            ]
+        )
+        for row in queries.policy_rows(policy_ids=unbilled):
+            policy_rows[row[0]] = row
+        invoice_rows.update(queries.invoice_rows_by_policy(unbilled))
+    payment_rows = queries.payment_rows_by_policy(policy_rows, history=history)
+
+    format_date = DateFormatter()
+    return dict(
+        (
+            policy_id,
+            policy_detail(
+                policy_row,
+                invoice_rows.get(policy_id, []),
+                payment_rows.get(policy_id, []),
+                date_cursor,
+                format_date,
+            ),
+        )
+        for policy_id, policy_row in policy_rows.items()
+    )
+
+
+def policy_detail(policy_row, invoice_rows, payment_rows, date_cursor, format_date):
+    """
+    :return: A policy with its balance at date_cursor, invoices and payments,
+             as served by get_policy.
+    """
+    account_balance = queries.account_balance(
+        invoice_rows,
+        payment_rows,
+        date_cursor,
+        pending=queries.pending_invoices(policy_row),
+    )
+    return {
+        "policy": policy_serializer(policy_row, format_date, account_balance),
+        "payments": [payment_serializer(row, format_date) for row in payment_rows],
+        "invoices": [invoice_serializer(row, format_date) for row in invoice_rows],
+    }
+
+
+@blueprint.route("/policies/<int:policy_id>/payments", methods=["POST"])
+def post_payment(policy_id):
+    try:
+        amount = int(request.values.get("amount"))
+        transaction_date = request.values.get("transactionDate")
+        if transaction_date:
+            transaction_date = datetime.strptime(transaction_date, "%Y-%m-%d").date()
+        contact_id = request.values.get("contactId")
+        contact_id = int(contact_id) if contact_id else None
+    except (TypeError, ValueError):
+        abort(400)
+    if amount <= 0:
+        abort(400)
+    if cache.policy_row(policy_id) is None:
+        abort(404)
+
+    pa = PolicyAccounting(policy_id)
+    payment = pa.make_payment(
+        contact_id=contact_id, date_cursor=transaction_date, amount=amount
+    )
+    row = (payment.id, payment.amount_paid, payment.transaction_date)
+    return jsonify({"payment": payment_serializer(row, DateFormatter())}), 201
+
+
+@blueprint.route("/policies/<int:policy_id>/quotes", methods=["GET", "POST"])
+def get_quotes(policy_id):
+    """
+    What the policy would be billed under each billing schedule, without
+    changing it. Takes an optional dateCursor (defaults to today) and
+    billingSchedule (repeatable) to quote only some schedules.
+    """
+    try:
+        date_cursor = request.values.get("dateCursor")
+        if date_cursor:
+            date_cursor = datetime.strptime(date_cursor, "%Y-%m-%d").date()
+    except ValueError:
+        abort(400)
+    schedules = request.values.getlist("billingSchedule") or SCHEDULES
+    if any(schedule not in SCHEDULES for schedule in schedules):
+        abort(400)
+    history = wants_history()
+    if history:
+        policy_row = queries.policy_row(policy_id, history=True)
+    else:
+        policy_row = cache.policy_row(policy_id)
+    if policy_row is None:
+        abort(404)
+
+    payment_rows = queries.payment_rows(policy_id, history=history)
+    format_date = DateFormatter()
+    quotes = [
+        quote_serializer(policy_quote, format_date, policy_row[6])
+        for policy_quote in quote(policy_row, payment_rows, date_cursor, schedules)
+    ]
+    return jsonify(
+        {
+            "policy": policy_serializer(policy_row, format_date),
+            "quotes": quotes,
+        }
+    )
+
+
+@blueprint.route("/events", methods=["GET"])
+def get_events():
+    return event_stream()
+
+
+@blueprint.route("/policies/<int:policy_id>/events", methods=["GET"])
+def get_policy_events(policy_id):
+    if cache.policy_row(policy_id) is None:
+        abort(404)
+    return event_stream(policy_id)
+
+
+def event_stream(policy_id=None):
+    """
+    Server-sent events response for a change feed stream; see events. When
+    the process already serves as many streams as it may, answers 503 with a
+    Retry-After instead of holding another request thread.
+    :param policy_id: Policy to follow, None for every policy.
+    """
+    if not events.open_stream():
+        response = Response(
+            "Too many change feed streams, retry later.\n",
+            status=503,
+            mimetype="text/plain",
+        )
+        response.headers["Retry-After"] = str(STREAM_RETRY_SECONDS)
+        return response
+    events.follow()
+    response = Response(events.stream(policy_id), mimetype="text/event-stream")
+    response.call_on_close(events.close_stream)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@blueprint.route("/reports/pending-cancellation", methods=["GET"])
+def get_pending_cancellation():
+    try:
+        date_cursor = datetime.strptime(
+            request.args.get("date") or datetime.now().strftime("%Y-%m-%d"),
+            "%Y-%m-%d",
+        ).date()
+    except ValueError:
+        abort(400)
+    format_date = DateFormatter()
+    with replica.reading():
+        rows = shards.merged(shards.gather(pending_cancellation, date_cursor))
+    policies = [pending_cancellation_serializer(row, format_date) for row in rows]
+    return jsonify({"date": format_date(date_cursor), "policies": policies})
+
+
+def profile_directory():
+    """
+    The debug endpoints only exist while profiling is configured.
+    """
+    directory = current_app.config.get("PROFILE_DIR")
+    if not directory:
+        abort(404)
+    return directory
+
+
+@blueprint.route("/debug/profiles", methods=["GET"])
+def get_profiles():
+    return jsonify({"profiles": profiling.list_profiles(profile_directory())})
 
-    pa = PolicyAccounting(policy_object.id)
-    account_balance = pa.return_account_balance(date_cursor=date_cursor)
-    invoices_queryset = Invoice.query.filter_by(policy_id=policy_id).all()
-    payments_queryset = Payment.query.filter_by(policy_id=policy_id).all()
-    payments, invoices = [], []
-    policy = policy_serializer(policy_object, account_balance)
 
-    for payment in payments_queryset:
-        payments.append(payment_serializer(payment))
+@blueprint.route("/debug/profiles/<profile_id>", methods=["GET"])
+def get_profile(profile_id):
+    directory = profile_directory()
+    report = profiling.load_profile(directory, profile_id)
+    if report is None:
+        abort(404)
+    if request.args.get("format") == "pstats":
+        return send_from_directory(
+            os.path.abspath(directory), profile_id + ".prof", as_attachment=True
+        )
+    return jsonify(report)
 
-    for invoice in invoices_queryset:
-        invoices.append(invoice_serializer(invoice))
 
-    return jsonify({"policy": policy, "payments": payments, "invoices": invoices})
+@blueprint.route("/debug/replica", methods=["GET"])
+def get_replica():
+    """
+    Replica lag and, for this process, how reads were routed.
+    """
+    if not current_app.config.get("REPLICA_DIR"):
+        abort(404)
+    return jsonify(replica.status())
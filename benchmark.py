@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Compares the policy detail read path before and after the move to Core
+tuple queries, on a throwaway policy with thousands of invoices.
+
+    python benchmark.py --invoices 5000 --payments 500 --seconds 5
+"""
+import argparse
+import json
+import time
+from datetime import date, timedelta
+
+from accounting import create_app, db
+from accounting.models import Contact, Invoice, Payment, Policy
+from accounting.utils import PolicyAccounting
+from accounting.views import get_policy
+
+
+def seed(invoice_count, payment_count):
+    agent = Contact("Benchmark Agent", "Agent")
+    insured = Contact("Benchmark Insured", "Named Insured")
+    db.session.add(agent)
+    db.session.add(insured)
+    db.session.commit()
+
+    policy = Policy("Benchmark Policy", date(2015, 1, 1), invoice_count * 100)
+    policy.billing_schedule = "Monthly"
+    policy.named_insured = insured.id
+    policy.agent = agent.id
+    db.session.add(policy)
+    db.session.commit()
+
+    invoices = []
+    for i in range(invoice_count):
+        bill_date = policy.effective_date + timedelta(days=i)
+        invoices.append(
+            {
+                "policy_id": policy.id,
+                "bill_date": bill_date,
+                "due_date": bill_date + timedelta(days=30),
+                "cancel_date": bill_date + timedelta(days=44),
+                "amount_due": 100,
+                "deleted": False,
+            }
+        )
+    db.session.execute(Invoice.__table__.insert(), invoices)
+
+    payments = []
+    for i in range(payment_count):
+        payments.append(
+            {
+                "policy_id": policy.id,
+                "contact_id": insured.id,
+                "amount_paid": 100,
+                "transaction_date": policy.effective_date + timedelta(days=i),
+            }
+        )
+    if payments:
+        db.session.execute(Payment.__table__.insert(), payments)
+    db.session.commit()
+    return policy.id, [agent.id, insured.id]
+
+
+def cleanup(policy_id, contact_ids):
+    db.session.remove()
+    db.session.execute(
+        Invoice.__table__.delete().where(Invoice.policy_id == policy_id)
+    )
+    db.session.execute(
+        Payment.__table__.delete().where(Payment.policy_id == policy_id)
+    )
+    db.session.execute(Policy.__table__.delete().where(Policy.id == policy_id))
+    db.session.execute(Contact.__table__.delete().where(Contact.id.in_(contact_ids)))
+    db.session.commit()
+
+
+def orm_get_policy(policy_id, date_cursor):
+    """
+    The detail view as it was before the tuple query path: full ORM
+    instances, one strftime per date and two contact queries.
+    """
+    fmt = "%d/%m/%Y"
+    policy = Policy.query.filter_by(id=policy_id).one()
+    pa = PolicyAccounting(policy.id)
+    account_balance = pa.return_account_balance(date_cursor=date_cursor)
+    named_insured = Contact.query.filter_by(id=policy.named_insured).one()
+    agent = Contact.query.filter_by(id=policy.agent).one()
+    invoices = [
+        {
+            "id": invoice.id,
+            "billDate": invoice.bill_date.strftime(fmt),
+            "dueDate": invoice.due_date.strftime(fmt),
+            "cancelDate": invoice.cancel_date.strftime(fmt),
+            "amountDue": invoice.amount_due,
+        }
+        for invoice in Invoice.query.filter_by(policy_id=policy_id).all()
+    ]
+    payments = [
+        {
+            "id": payment.id,
+            "amountPaid": payment.amount_paid,
+            "transactionDate": payment.transaction_date.strftime(fmt),
+        }
+        for payment in Payment.query.filter_by(policy_id=policy_id).all()
+    ]
+    return json.dumps(
+        {
+            "policy": {
+                "id": policy.id,
+                "name": policy.policy_number,
+                "effectiveDate": policy.effective_date.strftime(fmt),
+                "status": policy.status,
+                "billingSchedule": policy.billing_schedule,
+                "annualPremium": policy.annual_premium,
+                "namedInsured": named_insured.name,
+                "agent": agent.name,
+                "accountBalance": account_balance,
+            },
+            "payments": payments,
+            "invoices": invoices,
+        }
+    )
+
+
+def requests_per_second(handler, seconds):
+    handler()  # warm up
+    db.session.remove()
+    count = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        handler()
+        db.session.remove()
+        count += 1
+    return count / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--invoices", type=int, default=5000)
+    parser.add_argument("--payments", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    app = create_app()
+    policy_id, contact_ids = seed(args.invoices, args.payments)
+    date_cursor = "2016-01-01"
+    form = {"dateCursor": date_cursor}
+    path = "/policies/%s" % policy_id
+
+    def before():
+        with app.test_request_context(path, method="POST", data=form):
+            orm_get_policy(policy_id, date(2016, 1, 1))
+
+    def after():
+        with app.test_request_context(path, method="POST", data=form):
+            get_policy(policy_id)
+
+    try:
+        results = {
+            "invoices": args.invoices,
+            "payments": args.payments,
+            "before_requests_per_second": round(
+                requests_per_second(before, args.seconds), 2
+            ),
+            "after_requests_per_second": round(
+                requests_per_second(after, args.seconds), 2
+            ),
+        }
+    finally:
+        cleanup(policy_id, contact_ids)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Batch jobs for the accounting database.
+
+    python jobs.py renew 2016-01-01 2016-01-31 --dry-run
+    python jobs.py archive 2015-01-01
+    python jobs.py snapshot snapshots/accounting
+    python jobs.py trim-changes
+    python jobs.py delinquency-index
+    python jobs.py extend-invoices --horizon-days 60
+    python jobs.py allocations
+    python jobs.py quotes quotes.jsonl --date 2016-01-01
+    python jobs.py replica
+    python jobs.py deliver-contacts
+
+With SHARDS configured every job runs on each shard in turn and reports
+per shard; snapshots go to a subdirectory and quotes to a file per shard.
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+from accounting import changelog, db, replica, shards
+from accounting.allocations import rebuild_allocations
+from accounting.archive import archive
+from accounting.delinquency import rebuild_delinquency_index
+from accounting.horizon import extend_invoices
+from accounting.quotes import export_quotes
+from accounting.renewals import renew_policies
+from accounting.snapshot import export_snapshot
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def renew(args):
+    return renew_policies(
+        args.term_end_from,
+        args.term_end_to,
+        dry_run=args.dry_run,
+        chunk_size=args.chunk_size,
+    )
+
+
+def archive_closed(args):
+    return archive(
+        args.closed_before, chunk_size=args.chunk_size, dry_run=args.dry_run
+    )
+
+
+def snapshot(args):
+    directory = args.directory
+    if shards.current():
+        directory = os.path.join(directory, shards.current())
+    manifest = export_snapshot(directory, full=args.full)
+    return {
+        "change_id": manifest["change_id"],
+        "segments": [segment["name"] for segment in manifest["segments"]],
+    }
+
+
+def trim_changes(args):
+    trimmed = changelog.trim()
+    db.session.commit()
+    return {"trimmed": trimmed}
+
+
+def delinquency_index(args):
+    return rebuild_delinquency_index(chunk_size=args.chunk_size)
+
+
+def allocations(args):
+    return rebuild_allocations(chunk_size=args.chunk_size)
+
+
+def extend(args):
+    return extend_invoices(
+        args.date,
+        horizon_days=args.horizon_days,
+        dry_run=args.dry_run,
+        chunk_size=args.chunk_size,
+    )
+
+
+def quotes(args):
+    output = args.output
+    if shards.current():
+        output = "%s.%s" % (output, shards.current())
+    return export_quotes(
+        output,
+        args.date,
+        status=args.status or None,
+        chunk_size=args.chunk_size,
+    )
+
+
+def refresh_replica(args):
+    return replica.refresh(shards.current())
+
+
+def deliver_contacts(args):
+    if not shards.current():
+        return {"contacts": {}, "failed": []}
+    return shards.deliver_contacts([shards.current()], chunk_size=args.chunk_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers()
+
+    renew_parser = subparsers.add_parser(
+        "renew", help="Renew active policies whose term ends in a window."
+    )
+    renew_parser.add_argument("term_end_from", type=parse_date)
+    renew_parser.add_argument("term_end_to", type=parse_date)
+    renew_parser.add_argument("--dry-run", action="store_true")
+    renew_parser.add_argument("--chunk-size", type=int, default=500)
+    renew_parser.set_defaults(job=renew)
+
+    archive_parser = subparsers.add_parser(
+        "archive",
+        help="Move deleted invoices and policies closed before a date to the archive.",
+    )
+    archive_parser.add_argument("closed_before", type=parse_date)
+    archive_parser.add_argument("--dry-run", action="store_true")
+    archive_parser.add_argument("--chunk-size", type=int, default=500)
+    archive_parser.set_defaults(job=archive_closed)
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="Export a columnar analytics snapshot, incrementally."
+    )
+    snapshot_parser.add_argument("directory")
+    snapshot_parser.add_argument("--full", action="store_true")
+    snapshot_parser.set_defaults(job=snapshot)
+
+    trim_parser = subparsers.add_parser(
+        "trim-changes",
+        help="Delete the change log entries every exporter and cache has read.",
+    )
+    trim_parser.set_defaults(job=trim_changes)
+
+    delinquency_parser = subparsers.add_parser(
+        "delinquency-index", help="Rebuild the pending cancellation index."
+    )
+    delinquency_parser.add_argument("--chunk-size", type=int, default=500)
+    delinquency_parser.set_defaults(job=delinquency_index)
+
+    extend_parser = subparsers.add_parser(
+        "extend-invoices",
+        help="Write the invoices that have come within the invoice horizon.",
+    )
+    extend_parser.add_argument("--date", type=parse_date, help="Defaults to today.")
+    extend_parser.add_argument(
+        "--horizon-days", type=int, help="Defaults to INVOICE_HORIZON_DAYS."
+    )
+    extend_parser.add_argument("--dry-run", action="store_true")
+    extend_parser.add_argument("--chunk-size", type=int, default=500)
+    extend_parser.set_defaults(job=extend)
+
+    allocations_parser = subparsers.add_parser(
+        "allocations", help="Rebuild the payment to invoice allocations."
+    )
+    allocations_parser.add_argument("--chunk-size", type=int, default=500)
+    allocations_parser.set_defaults(job=allocations)
+
+    quotes_parser = subparsers.add_parser(
+        "quotes",
+        help="Write every billing schedule's quote for each policy as JSON lines.",
+    )
+    quotes_parser.add_argument("output")
+    quotes_parser.add_argument(
+        "--date", type=parse_date, help="Balances are quoted at, defaults to today."
+    )
+    quotes_parser.add_argument(
+        "--status", default="Active", help='Policies quoted, "" for all.'
+    )
+    quotes_parser.add_argument("--chunk-size", type=int, default=500)
+    quotes_parser.set_defaults(job=quotes)
+
+    replica_parser = subparsers.add_parser(
+        "replica", help="Copy the database over its read replica in REPLICA_DIR."
+    )
+    replica_parser.set_defaults(job=refresh_replica)
+
+    contacts_parser = subparsers.add_parser(
+        "deliver-contacts",
+        help="Copy the contacts still queued for a shard to it.",
+    )
+    contacts_parser.add_argument("--chunk-size", type=int, default=500)
+    contacts_parser.set_defaults(job=deliver_contacts)
+
+    args = parser.parse_args()
+    results = shards.each(args.job, args)
+    result = results[0][1] if len(results) == 1 else dict(results)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
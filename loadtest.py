@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Load-tests a locally running accounting server.
+
+    python loadtest.py seed --policies 10000
+    python runserver.py
+    python loadtest.py run --url http://127.0.0.1:5000 --concurrency 8 \\
+        --seconds 30 --mix list=1,detail=8,payment=1 --label debug > debug.json
+
+Every run prints a JSON report with the run's parameters, overall
+throughput and, per endpoint, throughput, errors and p50/p95/p99 latency
+in milliseconds, so runs against different server setups can be diffed.
+"""
+import argparse
+import httplib
+import json
+import math
+import random
+import threading
+import time
+import urllib
+import urllib2
+from datetime import date, timedelta
+
+LOAD_POLICY_PREFIX = "Load Policy"
+SCHEDULES = ["Annual", "Two-Pay", "Quarterly", "Monthly"]
+ENDPOINTS = ["list", "detail", "payment"]
+PERCENTILES = [50, 95, 99]
+
+
+def seed(policy_count, contact_count, payments_per_policy, chunk_size):
+    """
+    Bulk loads policies, their invoices and payments into the database the
+    app is configured with, a chunk per shard in turn when sharded.
+    """
+    from sqlalchemy import func, select
+
+    from accounting import db, shards
+    from accounting.allocations import refresh_allocations
+    from accounting.delinquency import refresh_delinquency_windows
+    from accounting.models import Contact, Payment, Policy
+    from accounting.utils import insert_invoices, plan_invoices
+
+    contacts = Contact.__table__
+    policies = Policy.__table__
+    shards.create_all()
+
+    db.session.execute(
+        contacts.insert(),
+        [
+            {"name": "Load Agent %d" % i, "role": "Agent"}
+            for i in range(contact_count)
+        ]
+        + [
+            {"name": "Load Insured %d" % i, "role": "Named Insured"}
+            for i in range(contact_count)
+        ],
+    )
+    agent_ids = [
+        row[0]
+        for row in db.session.execute(
+            contacts.select().where(contacts.c.name.like("Load Agent %"))
+        )
+    ]
+    insured_ids = [
+        row[0]
+        for row in db.session.execute(
+            contacts.select().where(contacts.c.name.like("Load Insured %"))
+        )
+    ]
+    shards.queue_contacts(agent_ids + insured_ids)
+    db.session.commit()
+    failed = shards.deliver_contacts()["failed"]
+    if failed:
+        raise SystemExit("Contacts could not be copied to %s." % ", ".join(failed))
+
+    def loaded():
+        return db.session.execute(
+            select([func.count(policies.c.id)]).where(
+                policies.c.policy_number.like(LOAD_POLICY_PREFIX + " %")
+            )
+        ).scalar()
+
+    # Number on from earlier seed runs so that policy numbers stay unique.
+    first = sum(shards.gather(loaded))
+    rng = random.Random(first)
+    for start in range(first, first + policy_count, chunk_size):
+        numbers = [
+            "%s %d" % (LOAD_POLICY_PREFIX, i)
+            for i in range(start, min(start + chunk_size, first + policy_count))
+        ]
+        with shards.using(shards.place()):
+            values = [
+                {
+                    "policy_number": number,
+                    "effective_date": date(2015, 1, 1)
+                    + timedelta(days=rng.randint(0, 364)),
+                    "status": "Active",
+                    "billing_schedule": rng.choice(SCHEDULES),
+                    "annual_premium": rng.randint(1, 50) * 120,
+                    "named_insured": rng.choice(insured_ids),
+                    "agent": rng.choice(agent_ids),
+                }
+                for number in numbers
+            ]
+            for value, policy_id in zip(values, shards.new_policy_ids(len(values))):
+                value["id"] = policy_id
+            db.session.execute(policies.insert(), values)
+            rows = db.session.execute(
+                policies.select().where(policies.c.policy_number.in_(numbers))
+            ).fetchall()
+
+            invoices, payments = [], []
+            for row in rows:
+                plan = plan_invoices(
+                    row.effective_date, row.billing_schedule, row.annual_premium
+                )
+                invoices.extend((row.id,) + invoice for invoice in plan)
+                for bill_date, _, _, amount_due in plan[:payments_per_policy]:
+                    payments.append(
+                        {
+                            "policy_id": row.id,
+                            "contact_id": row.named_insured,
+                            "amount_paid": amount_due,
+                            "transaction_date": bill_date,
+                        }
+                    )
+            insert_invoices(invoices)
+            if payments:
+                db.session.execute(Payment.__table__.insert(), payments)
+            refresh_delinquency_windows([row.id for row in rows])
+            refresh_allocations([row.id for row in rows])
+            db.session.commit()
+
+    return {"policies": policy_count, "contacts": 2 * contact_count}
+
+
+def parse_mix(value):
+    """
+    :param value: e.g. "list=1,detail=8,payment=1".
+    :return: List of (endpoint, weight).
+    """
+    mix = []
+    for part in value.split(","):
+        endpoint, weight = part.split("=")
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError("Unknown endpoint %s" % endpoint)
+        mix.append((endpoint, float(weight)))
+    return mix
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class Worker(threading.Thread):
+    def __init__(self, url, mix, policy_ids, deadline, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.policy_ids = policy_ids
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.endpoints = [endpoint for endpoint, _ in mix]
+        total = sum(weight for _, weight in mix)
+        self.cumulative = []
+        running = 0.0
+        for _, weight in mix:
+            running += weight / total
+            self.cumulative.append(running)
+        self.samples = dict((endpoint, []) for endpoint in ENDPOINTS)
+        self.errors = dict((endpoint, 0) for endpoint in ENDPOINTS)
+
+    def pick(self):
+        draw = self.random.random()
+        for endpoint, bound in zip(self.endpoints, self.cumulative):
+            if draw <= bound:
+                return endpoint
+        return self.endpoints[-1]
+
+    def request(self, endpoint):
+        if endpoint == "list":
+            return urllib2.Request(self.url + "/policies")
+        policy_id = self.random.choice(self.policy_ids)
+        day = date(2015, 1, 1) + timedelta(days=self.random.randint(0, 729))
+        if endpoint == "detail":
+            data = {"dateCursor": day.strftime("%Y-%m-%d")}
+            path = "/policies/%d" % policy_id
+        else:
+            data = {
+                "amount": self.random.randint(1, 100),
+                "transactionDate": day.strftime("%Y-%m-%d"),
+            }
+            path = "/policies/%d/payments" % policy_id
+        return urllib2.Request(self.url + path, urllib.urlencode(data))
+
+    def run(self):
+        while time.time() < self.deadline:
+            endpoint = self.pick()
+            started = time.time()
+            try:
+                urllib2.urlopen(self.request(endpoint)).read()
+            except (urllib2.URLError, httplib.HTTPException, IOError):
+                self.errors[endpoint] += 1
+                continue
+            self.samples[endpoint].append((time.time() - started) * 1000.0)
+
+
+def run(url, concurrency, seconds, mix, label):
+    policies = json.load(urllib2.urlopen(url + "/policies"))["policies"]
+    policy_ids = [policy["id"] for policy in policies]
+    if not policy_ids:
+        raise SystemExit("The server has no policies; run 'loadtest.py seed' first.")
+
+    started = time.time()
+    workers = [
+        Worker(url, mix, policy_ids, started + seconds, seed)
+        for seed in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    endpoints = {}
+    total = 0
+    for endpoint in ENDPOINTS:
+        latencies = sorted(
+            sample for worker in workers for sample in worker.samples[endpoint]
+        )
+        errors = sum(worker.errors[endpoint] for worker in workers)
+        if not latencies and not errors:
+            continue
+        total += len(latencies)
+        report = {
+            "requests": len(latencies),
+            "errors": errors,
+            "requests_per_second": round(len(latencies) / elapsed, 2),
+        }
+        for percent in PERCENTILES:
+            value = percentile(latencies, percent)
+            report["p%d_ms" % percent] = round(value, 2) if value is not None else None
+        endpoints[endpoint] = report
+
+    return {
+        "label": label,
+        "url": url,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "mix": dict(mix),
+        "policies": len(policy_ids),
+        "requests": total,
+        "requests_per_second": round(total / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers()
+
+    seed_parser = subparsers.add_parser("seed", help="Bulk load test data.")
+    seed_parser.add_argument("--policies", type=int, default=10000)
+    seed_parser.add_argument("--contacts", type=int, default=100)
+    seed_parser.add_argument("--payments-per-policy", type=int, default=1)
+    seed_parser.add_argument("--chunk-size", type=int, default=500)
+    seed_parser.set_defaults(
+        job=lambda args: seed(
+            args.policies, args.contacts, args.payments_per_policy, args.chunk_size
+        )
+    )
+
+    run_parser = subparsers.add_parser("run", help="Drive a running server.")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--seconds", type=float, default=30.0)
+    run_parser.add_argument(
+        "--mix", type=parse_mix, default=parse_mix("list=1,detail=8,payment=1")
+    )
+    run_parser.add_argument("--label", default="")
+    run_parser.set_defaults(
+        job=lambda args: run(
+            args.url.rstrip("/"), args.concurrency, args.seconds, args.mix, args.label
+        )
+    )
+
+    args = parser.parse_args()
+    print(json.dumps(args.job(args), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
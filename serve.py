@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Production entry point: pre-forks worker processes sharing one listening
+socket.
+
+    python serve.py --workers 4 --threads 8 --port 5000 --warm-policies 5000
+
+The application is built once in the parent, so workers start with every
+module imported, the configuration read and the routes compiled. Each
+worker then drops the connections it inherited, warms the caches and only
+then starts accepting connections on a fixed set of threads, each keeping
+its own database connection. Threads let long-lived change feed streams
+share a worker with ordinary requests; each stream holds a thread for as
+long as it is open, so a worker serves at most --max-streams of them (half
+its threads by default) and turns the rest away with a 503. Dead workers
+are replaced; SIGINT or SIGTERM stops them all. With --replica-dir the
+parent also copies the database to its read replica every
+--replica-interval seconds, and when sharded it copies the contacts a
+failed write left queued for a shard every --contacts-interval seconds.
+"""
+import argparse
+import errno
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from accounting import cache, create_app, replica, shards
+
+
+class RequestHandler(WSGIRequestHandler):
+    access_log = False
+
+    def log_message(self, format, *args):
+        if self.access_log:
+            WSGIRequestHandler.log_message(self, format, *args)
+
+
+def handle_requests(server):
+    # Threads take turns accepting on the shared socket, like the workers.
+    while True:
+        server.handle_request()
+
+
+def worker(server, app, warm_policies, threads):
+    # Connections must not be shared with the parent or other workers.
+    for engine in shards.engines():
+        engine.dispose()
+    warmed = cache.warm(warm_policies)
+    sys.stderr.write(
+        "worker %d ready, %d policies and %d invoice plans cached, %d contacts read\n"
+        % (os.getpid(), warmed["policies"], warmed["plans"], warmed["contacts"])
+    )
+    for _ in range(threads - 1):
+        thread = threading.Thread(target=handle_requests, args=(server,))
+        thread.daemon = True
+        thread.start()
+    try:
+        handle_requests(server)
+    except KeyboardInterrupt:
+        pass
+    os._exit(0)
+
+
+def spawn(server, app, warm_policies, threads):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            worker(server, app, warm_policies, threads)
+        finally:
+            # Never fall back into the parent's loop.
+            os._exit(1)
+    return pid
+
+
+def refresh_replicas(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            replica.refresh_all()
+        except Exception as e:
+            # Reads fall back to the primary once the replicas are too old.
+            sys.stderr.write("replica refresh failed: %s\n" % e)
+
+
+def deliver_contacts(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            shards.deliver_contacts()
+        except Exception as e:
+            sys.stderr.write("contact delivery failed: %s\n" % e)
+
+
+def serve(
+    host,
+    port,
+    workers,
+    threads,
+    warm_policies,
+    config,
+    replica_interval,
+    contacts_interval,
+):
+    app = create_app(config)
+    server = make_server(host, port, app, handler_class=RequestHandler)
+    sys.stderr.write("listening on http://%s:%d/\n" % server.server_address)
+    if replica.directory:
+        replica.refresh_all()
+        thread = threading.Thread(target=refresh_replicas, args=(replica_interval,))
+        thread.daemon = True
+        thread.start()
+    if shards.names:
+        thread = threading.Thread(target=deliver_contacts, args=(contacts_interval,))
+        thread.daemon = True
+        thread.start()
+
+    children = set(
+        spawn(server, app, warm_policies, threads) for _ in range(workers)
+    )
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        try:
+            pid, _ = os.wait()
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        children.discard(pid)
+        if not stopping:
+            children.add(spawn(server, app, warm_policies, threads))
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Requests (or change feed streams) each worker serves at once",
+    )
+    parser.add_argument(
+        "--max-streams",
+        type=int,
+        help="EVENT_MAX_STREAMS: change feed streams each worker serves at once, "
+        "defaults to half of --threads",
+    )
+    parser.add_argument("--database", help="SQLAlchemy URI, defaults to config.py")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help="Connections kept open per worker, defaults to --threads; "
+        "0 reconnects on every request",
+    )
+    parser.add_argument("--policy-cache", type=int, help="POLICY_CACHE_SIZE")
+    parser.add_argument("--plan-cache", type=int, help="INVOICE_PLAN_CACHE_SIZE")
+    parser.add_argument(
+        "--warm-policies",
+        type=int,
+        default=1000,
+        help="Hot policies each worker loads before accepting traffic",
+    )
+    parser.add_argument("--access-log", action="store_true")
+    parser.add_argument(
+        "--profile-dir",
+        help="PROFILE_DIR: profile requests sent with X-Profile: 1 or ?profile=1",
+    )
+    parser.add_argument(
+        "--replica-dir",
+        help="REPLICA_DIR: serve list and report reads from a copy of the database",
+    )
+    parser.add_argument(
+        "--replica-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between replica refreshes",
+    )
+    parser.add_argument(
+        "--contacts-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between deliveries of the contacts still queued for a shard",
+    )
+    args = parser.parse_args()
+
+    # One pooled connection per thread keeps SQLite's page cache warm
+    # between requests; fewer would close connections still in use.
+    pool_size = args.threads if args.pool_size is None else args.pool_size
+    config = {"SQLALCHEMY_POOL_SIZE": pool_size or None}
+    # Streams hold their thread: keep the rest for ordinary requests.
+    max_streams = args.threads // 2 if args.max_streams is None else args.max_streams
+    config["EVENT_MAX_STREAMS"] = max_streams
+    if args.database:
+        config["SQLALCHEMY_DATABASE_URI"] = args.database
+    if args.policy_cache is not None:
+        config["POLICY_CACHE_SIZE"] = args.policy_cache
+    if args.plan_cache is not None:
+        config["INVOICE_PLAN_CACHE_SIZE"] = args.plan_cache
+    if args.profile_dir:
+        config["PROFILE_DIR"] = args.profile_dir
+    if args.replica_dir:
+        config["REPLICA_DIR"] = args.replica_dir
+    RequestHandler.access_log = args.access_log
+
+    serve(
+        args.host,
+        args.port,
+        args.workers,
+        args.threads,
+        args.warm_policies,
+        config,
+        args.replica_interval,
+        args.contacts_interval,
+    )
+
+
+if __name__ == "__main__":
+    main()
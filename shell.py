@@ -4,6 +4,8 @@ from accounting.models import *
 from accounting.utils import *
 from flask import *
 
+app = create_app()
+
 try:
     from IPython import embed
     embed()